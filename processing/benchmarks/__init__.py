@@ -0,0 +1,15 @@
+"""
+Benchmarks of the processing pipelines on synthetic data (see ``synthetic.py``),
+in the style of `asv <https://asv.readthedocs.io/>`_.
+
+Run them with ``asv run`` from ``processing/``, or without asv:
+
+    python -m benchmarks.run [-k scan]
+
+``NWM_BENCHMARK_SCALE`` sets the size of the synthetic files (default 0.01).
+"""
+import os
+import sys
+
+# The pipeline modules are scripts next to this package, not an installed package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
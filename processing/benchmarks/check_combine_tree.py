@@ -0,0 +1,43 @@
+"""
+Check that ``noaanwm.combine_tree`` gives the same references as one flat
+``noaanwm.assemble`` over the same cycles, on synthetic ``land`` files.
+
+    python -m benchmarks.check_combine_tree [--days 3]
+"""
+import argparse
+import json
+import sys
+
+import dask
+
+import noaanwm
+
+from .pipelines import land_cycles
+
+
+def check(cycles, dims) -> bool:
+    flat = noaanwm.assemble(list(cycles.values()), "file", {}, dims)
+    (tree,) = dask.compute(
+        noaanwm.combine_tree(cycles, "file", {}, dims), scheduler="sync"
+    )
+    return json.dumps(tree, sort_keys=True) == json.dumps(flat, sort_keys=True)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=3)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    cycles = land_cycles(args.days)
+    if not check(cycles, noaanwm.IDENTICAL_DIMS["land"]):
+        print("combine_tree differs from a flat assemble")
+        return 1
+    print(f"combine_tree matches a flat assemble over {len(cycles)} cycles")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
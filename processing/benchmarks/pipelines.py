@@ -0,0 +1,312 @@
+"""
+Benchmarks of each pipeline stage, on synthetic files on the local filesystem.
+"""
+import glob
+import os
+import tempfile
+
+import dask
+import fsspec
+import kerchunk.combine
+import kerchunk.hdf
+import xarray as xr
+import zarr
+from pangeo_forge_recipes.patterns import pattern_from_file_sequence
+from pangeo_forge_recipes.storage import StorageConfig
+
+import noaanwm
+import rechunk_nwm
+import run_zarr
+import scanner
+import sharding
+import synthetic
+from manifest import Manifest
+
+from . import reservoir_layout
+
+SCALE = float(os.environ.get("NWM_BENCHMARK_SCALE", "0.01"))
+CYCLES = 24
+
+
+def write_files(kinds, cycles=CYCLES, forecast_times=(1,)):
+    root = tempfile.mkdtemp(prefix="nwm-benchmark-")
+    paths = synthetic.write_files(
+        os.path.join(root, "nwm"),
+        cycles=cycles,
+        kinds=kinds,
+        forecast_times=forecast_times,
+        scale=SCALE,
+    )
+    return root, paths
+
+
+def files(root, kind):
+    return sorted(glob.glob(os.path.join(root, "nwm", "*", "*", f"*.{kind}.*.nc")))
+
+
+def land_cycles(days=3):
+    """
+    The forecast cube references of each cycle of ``days`` days of ``land``
+    files with three lead times, by ``reference_time``.
+    """
+    _, paths = write_files(("land",), cycles=days * 24, forecast_times=(1, 2, 3))
+    dims = noaanwm.IDENTICAL_DIMS["land"]
+    return {
+        t: noaanwm.build_cycle(group, "file", {}, dims)
+        for t, group in noaanwm.cycles(paths).items()
+    }
+
+
+def write_forcing_zarr():
+    """A day of ``forcing`` files as a Zarr store with one time step per chunk."""
+    root, _ = write_files(("forcing",))
+    ds = xr.open_mfdataset(
+        files(root, "forcing"),
+        engine="h5netcdf",
+        preprocess=lambda ds: ds.drop_vars("reference_time"),
+        combine="nested",
+        concat_dim="time",
+        data_vars="minimal",
+    )
+    for v in ds.variables.values():
+        v.encoding.pop("chunksizes", None)
+    ds.chunk({"time": 1}).to_zarr(os.path.join(root, "source.zarr"), mode="w")
+    return root
+
+
+class Scan:
+    """``SingleHdf5ToZarr`` and ``TemplateScanner`` on one file of each kind."""
+
+    params = ["channel_rt", "land", "forcing", "reservoir"]
+    param_names = ["kind"]
+    timeout = 600
+
+    def setup_cache(self):
+        root, _ = write_files(tuple(self.params), cycles=1)
+        return root
+
+    def setup(self, root, kind):
+        self.scanner = scanner.TemplateScanner()
+        self.scanner.scan(files(root, kind)[0])
+
+    def time_scan(self, root, kind):
+        kerchunk.hdf.SingleHdf5ToZarr(files(root, kind)[0]).translate()
+
+    def peakmem_scan(self, root, kind):
+        kerchunk.hdf.SingleHdf5ToZarr(files(root, kind)[0]).translate()
+
+    def time_scan_template(self, root, kind):
+        # The scanner already has a template for the file's schema.
+        self.scanner.scan(files(root, kind)[0])
+
+
+class Combine:
+    """``MultiZarrToZarr`` over a day of scanned ``channel_rt`` files."""
+
+    timeout = 600
+
+    def setup_cache(self):
+        _, paths = write_files(("channel_rt",))
+        return paths, [kerchunk.hdf.SingleHdf5ToZarr(p).translate() for p in paths]
+
+    def time_combine(self, cache):
+        _, references = cache
+        kerchunk.combine.MultiZarrToZarr(
+            references,
+            remote_protocol="file",
+            concat_dims=["time", "reference_time"],
+            identical_dims=["feature_id"],
+        ).translate()
+
+    def time_append(self, cache):
+        # Append the last cycle to the combined references of the others.
+        paths, references = cache
+        existing = kerchunk.combine.MultiZarrToZarr(
+            references[:-1],
+            remote_protocol="file",
+            concat_dims=["time", "reference_time"],
+            identical_dims=["feature_id"],
+        ).translate()
+        noaanwm.append_references(
+            existing, paths[-1:], "file", {}, identical_dims=["feature_id"]
+        )
+
+
+class CombineTree:
+    """
+    ``noaanwm.combine_tree`` and one flat ``noaanwm.assemble`` over the cycles of
+    three days of ``land`` forecast files. ``benchmarks.check_combine_tree``
+    checks that they give the same references.
+    """
+
+    timeout = 1200
+    dims = noaanwm.IDENTICAL_DIMS["land"]
+
+    def setup_cache(self):
+        return land_cycles()
+
+    def time_flat(self, cycles):
+        noaanwm.assemble(list(cycles.values()), "file", {}, self.dims)
+
+    def time_tree(self, cycles):
+        tree = noaanwm.combine_tree(cycles, "file", {}, self.dims)
+        dask.compute(tree, scheduler="sync")
+
+
+class Reservoir:
+    """The reservoir tabular pipeline."""
+
+    params = ["time", "feature", "space"]
+    param_names = ["layout"]
+    timeout = 600
+
+    def setup_cache(self):
+        root, _ = write_files(("reservoir",))
+        return root
+
+    def setup(self, root, layout):
+        self.paths = files(root, "reservoir")
+        self.ds = xr.open_dataset(self.paths[0]).load()
+        self.output = tempfile.mkdtemp(prefix="nwm-benchmark-")
+
+    def time_to_dataframe(self, root, layout):
+        noaanwm.to_dataframe(self.ds)
+
+    def time_process_day(self, root, layout):
+        noaanwm.process_day(self.paths[0])
+
+    def time_process_month(self, root, layout):
+        noaanwm.process_month(self.paths)
+
+    def time_write_reservoir(self, root, layout):
+        noaanwm.write_reservoir(
+            self.paths, os.path.join(self.output, "month.parquet"), layout=layout
+        )
+
+    def peakmem_write_reservoir(self, root, layout):
+        noaanwm.write_reservoir(
+            self.paths, os.path.join(self.output, "month.parquet"), layout=layout
+        )
+
+    def track_row_groups_read(self, root, layout):
+        noaanwm.write_reservoir(
+            self.paths,
+            os.path.join(self.output, "month.parquet"),
+            layout=layout,
+            row_group_size=max(1, len(self.ds.feature_id) * CYCLES // 8),
+        )
+        feature_id = int(self.ds.feature_id[0])
+        return reservoir_layout.scan(self.output, feature_id)["row_groups_read"]
+
+    def track_row_groups_read_bbox(self, root, layout):
+        noaanwm.write_reservoir(
+            self.paths,
+            os.path.join(self.output, "month.parquet"),
+            layout=layout,
+            row_group_size=max(1, len(self.ds.feature_id) * CYCLES // 8),
+        )
+        # The south-west quarter of the reservoirs' extent
+        x, y = self.ds.longitude.values, self.ds.latitude.values
+        bbox = (x.min(), y.min(), (x.min() + x.max()) / 2, (y.min() + y.max()) / 2)
+        return reservoir_layout.scan_bbox(self.output, bbox)["row_groups_read"]
+
+
+class ZarrRecipe:
+    """The ``run_zarr`` recipe storing a day of ``forcing`` files to Zarr."""
+
+    timeout = 1200
+
+    def setup_cache(self):
+        root, _ = write_files(("forcing",))
+        return root
+
+    def setup(self, root):
+        self.output = tempfile.mkdtemp(prefix="nwm-benchmark-")
+
+    def time_recipe(self, root):
+        fs = fsspec.filesystem("file")
+        pattern = pattern_from_file_sequence(
+            files(root, "forcing"), "time", nitems_per_file=1
+        )
+        recipe = run_zarr.CheckpointedXarrayZarrRecipe(
+            pattern,
+            cache_inputs=False,
+            process_input=run_zarr.process_input,
+            manifest=Manifest(os.path.join(self.output, "manifest")),
+        )
+        recipe.storage_config = StorageConfig(
+            target=run_zarr.MyTarget(fs, root_path=f"{self.output}/forcing.zarr"),
+            metadata=run_zarr.MyMetadataTarget(fs, root_path=f"{self.output}/meta"),
+        )
+        recipe.to_function()()
+
+
+class Rechunk:
+    """``rechunk_nwm.rechunk`` from one time step per chunk to time series."""
+
+    params = [2**22, 2**26]
+    param_names = ["max_mem"]
+    timeout = 1200
+
+    def setup_cache(self):
+        return write_forcing_zarr()
+
+    def setup(self, root, max_mem):
+        self.output = tempfile.mkdtemp(prefix="nwm-benchmark-")
+
+    def time_rechunk(self, root, max_mem):
+        stages = rechunk_nwm.rechunk(
+            os.path.join(root, "source.zarr"),
+            os.path.join(self.output, "target.zarr"),
+            {"time": CYCLES, "y": 64, "x": 64},
+            max_mem,
+            temp=os.path.join(self.output, "temp.zarr"),
+        )
+        for tasks in stages:
+            dask.compute(*tasks, scheduler="threads")
+
+
+class Shards:
+    """
+    Objects and reads of the rechunked ``forcing`` store, with one object per
+    chunk or with the chunks packed into shards.
+    """
+
+    params = ["chunks", "shards"]
+    param_names = ["layout"]
+    timeout = 1200
+
+    def setup_cache(self):
+        root = write_forcing_zarr()
+        for layout, shards in [("chunks", None), ("shards", {"y": 256, "x": 256})]:
+            stages = rechunk_nwm.rechunk(
+                os.path.join(root, "source.zarr"),
+                os.path.join(root, f"{layout}.zarr"),
+                {"time": CYCLES, "y": 64, "x": 64},
+                2**26,
+                shards=shards,
+            )
+            for tasks in stages:
+                dask.compute(*tasks, scheduler="threads")
+        return root
+
+    def setup(self, root, layout):
+        store = fsspec.get_mapper(os.path.join(root, f"{layout}.zarr"))
+        if layout == "shards":
+            self.array = sharding.ShardedArray.open(store, "T2D")
+        else:
+            self.array = zarr.open_group(store, mode="r")["T2D"]
+
+    def track_objects(self, root, layout):
+        path = os.path.join(root, f"{layout}.zarr")
+        return sum(
+            len(names)
+            for directory, _, names in os.walk(path)
+            if ".rechunk" not in directory
+        )
+
+    def time_read_series(self, root, layout):
+        self.array[:, 200, 300]
+
+    def time_read_all(self, root, layout):
+        self.array[...]
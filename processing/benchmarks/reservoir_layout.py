@@ -0,0 +1,136 @@
+"""
+Compare how much of the reservoir dataset a single-reservoir lookup reads under
+the "time" and "feature" layouts written by ``noaanwm.py --layout``.
+
+A reader like ``pd.read_parquet(..., filters=[("feature_id", "=", feature_id)])``
+reads every row group whose ``feature_id`` statistics might contain the value.
+This counts those row groups and the compressed bytes in them.
+
+    python benchmarks/reservoir_layout.py \\
+        abfs://ciroh/short-range-reservoir.parquet \\
+        abfs://ciroh/short-range-reservoir-by-feature.parquet \\
+        --feature-id 167299819 --account-name noaanwm
+
+With ``--bbox``, it counts the row groups a regional query with
+`noaanwm.bbox_filter` reads instead, which only the "space" layout can prune.
+This imports ``noaanwm``, so run it as a module of the ``benchmarks`` package:
+
+    python -m benchmarks.reservoir_layout \\
+        abfs://ciroh/short-range-reservoir.parquet \\
+        abfs://ciroh/short-range-reservoir-by-space.parquet \\
+        --bbox -109.1 36.9 -102.0 41.0 --account-name noaanwm
+"""
+import argparse
+import sys
+
+import fsspec
+import pyarrow.dataset
+import pyarrow.parquet as pq
+
+
+def _files(prefix, storage_options=None):
+    fs, root = fsspec.core.url_to_fs(prefix, **(storage_options or {}))
+    paths = [p for p in fs.find(root) if p.endswith(".parquet") and "/_" not in p]
+    return fs, paths
+
+
+def scan(prefix, feature_id, storage_options=None, column="feature_id") -> dict:
+    fs, paths = _files(prefix, storage_options)
+    result = dict(files=len(paths), row_groups=0, row_groups_read=0)
+    result.update(bytes=0, bytes_read=0)
+
+    for path in paths:
+        with fs.open(path) as f:
+            metadata = pq.ParquetFile(f).metadata
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            nbytes = sum(
+                row_group.column(j).total_compressed_size
+                for j in range(row_group.num_columns)
+            )
+            result["row_groups"] += 1
+            result["bytes"] += nbytes
+
+            stats = None
+            for j in range(row_group.num_columns):
+                if row_group.column(j).path_in_schema == column:
+                    stats = row_group.column(j).statistics
+            if (
+                stats is None
+                or not stats.has_min_max
+                or stats.min <= feature_id <= stats.max
+            ):
+                result["row_groups_read"] += 1
+                result["bytes_read"] += nbytes
+    return result
+
+
+def scan_bbox(prefix, bbox, storage_options=None) -> dict:
+    """
+    Like `scan`, for a `noaanwm.bbox_filter` query on ``bbox``. The row groups
+    read are the ones pyarrow keeps after checking the ``bbox`` statistics; all
+    of them without a ``bbox`` column.
+    """
+    import noaanwm
+
+    fs, paths = _files(prefix, storage_options)
+    result = dict(files=len(paths), row_groups=0, row_groups_read=0)
+    result.update(bytes=0, bytes_read=0)
+
+    expression = noaanwm.bbox_filter(bbox)
+    for path in paths:
+        fragment = next(pyarrow.dataset.dataset(path, filesystem=fs).get_fragments())
+        metadata = fragment.metadata
+        read = set(range(metadata.num_row_groups))
+        if "bbox" in fragment.physical_schema.names:
+            read = {rg.id for rg in fragment.subset(expression).row_groups}
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            nbytes = sum(
+                row_group.column(j).total_compressed_size
+                for j in range(row_group.num_columns)
+            )
+            result["row_groups"] += 1
+            result["bytes"] += nbytes
+            if i in read:
+                result["row_groups_read"] += 1
+                result["bytes_read"] += nbytes
+    return result
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("prefixes", nargs="+")
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument("--feature-id", type=int)
+    query.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        metavar=("MINX", "MINY", "MAXX", "MAXY"),
+        help="A regional query, in longitude and latitude",
+    )
+    parser.add_argument("--account-name", default=None)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    storage_options = {}
+    if args.account_name:
+        storage_options["account_name"] = args.account_name
+
+    for prefix in args.prefixes:
+        if args.bbox:
+            r = scan_bbox(prefix, args.bbox, storage_options)
+        else:
+            r = scan(prefix, args.feature_id, storage_options)
+        print(
+            f"{prefix}: {r['row_groups_read']}/{r['row_groups']} row groups, "
+            f"{r['bytes_read'] / 1e6:.1f}/{r['bytes'] / 1e6:.1f} MB read"
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Run the benchmarks without asv, timing each ``time_*`` benchmark once per
+parameter combination.
+
+    python -m benchmarks.run [-k PATTERN] [--repeat N]
+"""
+import argparse
+import importlib
+import inspect
+import itertools
+import pkgutil
+import sys
+import time
+
+import benchmarks
+
+
+def iter_benchmarks(pattern=None):
+    for module_info in pkgutil.iter_modules(benchmarks.__path__):
+        if module_info.name == "run":
+            continue
+        module = importlib.import_module(f"benchmarks.{module_info.name}")
+        for name, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            methods = [m for m in dir(cls) if m.startswith(("time_", "track_"))]
+            methods = [
+                m
+                for m in methods
+                if pattern is None or pattern in f"{module_info.name}.{name}.{m}"
+            ]
+            if methods:
+                yield f"{module_info.name}.{name}", cls, methods
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Run the benchmarks")
+    parser.add_argument("-k", "--pattern", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    for name, cls, methods in iter_benchmarks(args.pattern):
+        instance = cls()
+        cache = []
+        if hasattr(instance, "setup_cache"):
+            cache = [instance.setup_cache()]
+
+        params = getattr(cls, "params", [])
+        if params and not isinstance(params[0], list):
+            params = [params]
+        for values in itertools.product(*params):
+            for method in methods:
+                results = []
+                for _ in range(args.repeat if method.startswith("time_") else 1):
+                    if hasattr(instance, "setup"):
+                        instance.setup(*cache, *values)
+                    t0 = time.perf_counter()
+                    result = getattr(instance, method)(*cache, *values)
+                    results.append(time.perf_counter() - t0)
+                    if hasattr(instance, "teardown"):
+                        instance.teardown(*cache, *values)
+                label = f"{name}.{method}({', '.join(map(repr, values))})"
+                if method.startswith("time_"):
+                    print(f"{label:<60} {min(results):10.4f}s")
+                else:
+                    print(f"{label:<60} {result:>11}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+"""
+A local, size-bounded cache of chunk bytes.
+
+`ChunkCache` stores values as files under a directory, with a SQLite index of
+their sizes, checksums and last access times. When the cache grows past
+``max_size``, the least recently used values are evicted. Files are written to a
+temporary name and renamed into place, and the index uses SQLite's locking, so
+several processes on one node can share a cache directory.
+
+`CachingStore` puts a cache in front of a Zarr store or fsspec mapper:
+
+>>> cache = ChunkCache("/tmp/nwm-cache", max_size="20GB")
+>>> store = CachingStore(fsspec.get_mapper("az://ciroh/zarr/ts/..."), cache, "ts")
+>>> ds = xr.open_dataset(store, engine="zarr", chunks={})
+>>> cache.stats
+CacheStats(hits=0, misses=96, ...)
+"""
+import dataclasses
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Iterable, Mapping
+
+import dask.utils
+import zarr.storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+"""
+
+# Zarr metadata changes whenever a store is appended to, so it's always read from
+# the store.
+METADATA_KEYS = {".zmetadata", ".zarray", ".zattrs", ".zgroup", "zarr.json"}
+
+
+@dataclasses.dataclass
+class CacheStats:
+    """Counters for the lookups made through one `ChunkCache`."""
+
+    hits: int = 0
+    misses: int = 0
+    bytes_hit: int = 0
+    bytes_stored: int = 0
+    evictions: int = 0
+    corrupt: int = 0
+
+
+def _checksum(value: bytes) -> str:
+    return hashlib.blake2b(value, digest_size=16).hexdigest()
+
+
+class ChunkCache:
+    """
+    Parameters
+    ----------
+    path
+        The cache directory.
+    max_size
+        The most bytes of values to keep, as a number or a string like "20GB".
+    """
+
+    def __init__(self, path: str, max_size: int | str = "10GB"):
+        self.path = os.path.expanduser(path)
+        self.max_size = dask.utils.parse_bytes(max_size)
+        self.stats = CacheStats()
+        self._local = threading.local()
+        os.makedirs(self.path, exist_ok=True)
+        self.connection.executescript(SCHEMA)
+
+    def __repr__(self):
+        return f"ChunkCache<{self.path}, max_size={self.max_size}>"
+
+    def __getstate__(self):
+        return {"path": self.path, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads.
+        if not hasattr(self._local, "connection"):
+            connection = sqlite3.connect(
+                os.path.join(self.path, "index.sqlite"), timeout=60
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return self._local.connection
+
+    def _file(self, key: str, checksum: str) -> str:
+        # Each version of a value gets its own file, so a reader never sees a
+        # file replaced under it.
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, name[:2], f"{name}-{checksum}")
+
+    @property
+    def size(self) -> int:
+        (size,) = self.connection.execute("SELECT sum(size) FROM entries").fetchone()
+        return size or 0
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, bytes]:
+        """
+        The cached values of ``keys``. Missing or corrupt values are left out.
+        """
+        keys = list(keys)
+        checksums = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i : i + 500]
+            rows = self.connection.execute(
+                "SELECT key, checksum FROM entries WHERE key IN "
+                f"({', '.join('?' * len(batch))})",
+                batch,
+            )
+            checksums.update(rows.fetchall())
+
+        out = {}
+        corrupt = []
+        for key, checksum in checksums.items():
+            try:
+                with open(self._file(key, checksum), "rb") as f:
+                    value = f.read()
+            except FileNotFoundError:
+                # Evicted or replaced by another process
+                continue
+            if _checksum(value) != checksum:
+                corrupt.append((key, checksum))
+                continue
+            out[key] = value
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE entries SET accessed = ? WHERE key = ?",
+                [(now, key) for key in out],
+            )
+        if corrupt:
+            self.stats.corrupt += len(corrupt)
+            self._remove(corrupt)
+
+        self.stats.hits += len(out)
+        self.stats.misses += len(keys) - len(out)
+        self.stats.bytes_hit += sum(len(v) for v in out.values())
+        return out
+
+    def set_many(self, values: Mapping[str, bytes]) -> None:
+        """
+        Store ``values`` and evict the least recently used values beyond
+        ``max_size``.
+        """
+        rows = []
+        for key, value in values.items():
+            value = bytes(value)
+            if len(value) > self.max_size:
+                continue
+            checksum = _checksum(value)
+            path = self._file(key, checksum)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(tmp, path)
+            rows.append((key, len(value), checksum, time.time()))
+
+        replaced = []
+        with self.connection:
+            for row in rows:
+                old = self.connection.execute(
+                    "SELECT checksum FROM entries WHERE key = ?", row[:1]
+                ).fetchone()
+                if old is not None and old[0] != row[2]:
+                    replaced.append((row[0], old[0]))
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", row
+                )
+        self._remove_files(replaced)
+        self.stats.bytes_stored += sum(row[1] for row in rows)
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used values until the cache fits in
+        ``max_size``. Returns the number of values removed.
+        """
+        excess = self.size - self.max_size
+        if excess <= 0:
+            return 0
+        entries = []
+        for key, checksum, size in self.connection.execute(
+            "SELECT key, checksum, size FROM entries ORDER BY accessed"
+        ):
+            if excess <= 0:
+                break
+            entries.append((key, checksum))
+            excess -= size
+        self._remove(entries)
+        self.stats.evictions += len(entries)
+        return len(entries)
+
+    def _remove(self, entries: list[tuple[str, str]]) -> None:
+        # Drop the index entries first, so no process finds an entry without
+        # its file. An entry replaced since it was read is left alone.
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM entries WHERE key = ? AND checksum = ?", entries
+            )
+        self._remove_files(entries)
+
+    def _remove_files(self, entries: list[tuple[str, str]]) -> None:
+        for key, checksum in entries:
+            try:
+                os.remove(self._file(key, checksum))
+            except FileNotFoundError:
+                pass
+
+    def clear(self) -> None:
+        entries = self.connection.execute("SELECT key, checksum FROM entries")
+        self._remove(entries.fetchall())
+
+
+class CachingStore(zarr.storage.Store):
+    """
+    A read-only Zarr store reading through a `ChunkCache`.
+
+    Parameters
+    ----------
+    store
+        A Zarr store (e.g. `ranges.CoalescingStore`) or fsspec mapper (e.g. from
+        a reference filesystem).
+    cache
+        The cache.
+    namespace
+        Prefixed to the keys in the cache. It must identify the store, since the
+        same keys appear in every Zarr store.
+
+    Metadata keys (``.zmetadata``, ``.zarray``, ...) bypass the cache, so a store
+    that's been appended to since it was cached is seen with its new shape. Whole
+    chunks are assumed never to change, and are cached under their key. A chunk
+    at the edge of its array, which an append may rewrite, is cached under its
+    key and the array's shape, read again on every `getitems`, so it's read from
+    the store again once the array has grown.
+    """
+
+    def __init__(self, store: Any, cache: ChunkCache, namespace: str):
+        self.store = store
+        self.cache = cache
+        self.namespace = namespace
+
+    def __repr__(self):
+        return f"CachingStore<{self.namespace}, {self.cache}>"
+
+    def _read(self, keys: list[str]) -> dict[str, bytes]:
+        if isinstance(self.store, zarr.storage.BaseStore):
+            return dict(self.store.getitems(keys, contexts={}))
+        if hasattr(self.store, "getitems"):
+            return self.store.getitems(keys, on_error="omit")
+        return {key: self.store[key] for key in keys if key in self.store}
+
+    def _names(self, keys: list[str]) -> dict[str, str]:
+        # The cache names of the chunks in ``keys``. Keys that aren't chunks of a
+        # Zarr v2 array with "." separated chunk keys aren't cached.
+        arrays: dict[str, list[tuple[str, str]]] = {}
+        for key in keys:
+            array, _, chunk = key.rpartition("/")
+            if chunk not in METADATA_KEYS:
+                arrays.setdefault(array, []).append((key, chunk))
+        if not arrays:
+            return {}
+        paths = {array: f"{array}/.zarray" if array else ".zarray" for array in arrays}
+        zarrays = self._read(list(paths.values()))
+
+        names = {}
+        for array, chunks in arrays.items():
+            if paths[array] not in zarrays:
+                continue
+            zarray = json.loads(zarrays[paths[array]])
+            shape, sizes = zarray["shape"], zarray["chunks"]
+            for key, chunk in chunks:
+                try:
+                    index = [int(i) for i in chunk.split(".")] if shape else []
+                except ValueError:
+                    continue
+                if len(index) != len(shape):
+                    continue
+                name = f"{self.namespace}/{key}"
+                if any((i + 1) * c > n for i, c, n in zip(index, sizes, shape)):
+                    name += "@" + ",".join(map(str, shape))
+                names[name] = key
+        return names
+
+    def getitems(self, keys, *, contexts=None):
+        names = self._names(list(keys))
+        cached = self.cache.get_many(names)
+        out = {names[name]: value for name, value in cached.items()}
+
+        missing = [key for key in keys if key not in out]
+        if missing:
+            values = self._read(missing)
+            self.cache.set_many(
+                {name: values[key] for name, key in names.items() if key in values}
+            )
+            out.update(values)
+        return out
+
+    def __getitem__(self, key):
+        value = self.getitems([key]).get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __setitem__(self, key, value):
+        raise PermissionError("CachingStore is read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("CachingStore is read-only")
@@ -0,0 +1,473 @@
+"""
+A feature-major Zarr store of the channel_rt variables, for long hydrographs.
+
+The channel_rt files, and the Kerchunk references to them, hold one hour of
+every reach per chunk, so a year-long hydrograph of one reach takes ~8,700
+reads. This store is chunked along ``feature_id`` and long blocks of time
+instead. The reaches are ordered depth-first up the river network from each
+outlet (from the NWM ``RouteLink`` file), so the reaches of a basin, and the
+gauges on them, share chunks:
+
+    python channel_timeseries.py update \\
+        az://ciroh/zarr/ts/short-range-channel_rt-timeseries \\
+        --route-link az://ciroh/metadata/RouteLink_CONUS.nc
+
+The target holds
+
+- ``main.zarr``: the finished blocks of ``TIME_CHUNK`` hours, in chunks of
+  ``FEATURE_CHUNK`` reaches by ``TIME_CHUNK`` hours
+- ``recent/{start}.zarr``: the blocks still being filled, in chunks of
+  ``RECENT_FEATURE_CHUNK`` reaches by a day, so that an hourly update rewrites a
+  day of each chunk rather than a whole block
+- ``features.npz``: a `features.FeatureIndex` of the store's order
+
+Each update writes the hours after the last one written, and moves finished
+blocks into ``main.zarr``. `open_timeseries` joins the two:
+
+>>> ds = open_timeseries("az://ciroh/zarr/ts/short-range-channel_rt-timeseries")
+>>> index = features.FeatureIndex.load(".../features.npz")
+>>> ds.streamflow.isel(feature_id=np.sort(index.positions(gauges)))
+"""
+import argparse
+import os
+import sys
+from typing import Any
+
+import dask
+import dask.array as da
+import fsspec
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+
+import encoding
+import executor
+import features
+import inventory
+import metrics
+import noaanwm
+import validate
+
+VARIABLES = [
+    "streamflow",
+    "nudge",
+    "velocity",
+    "qSfcLatRunoff",
+    "qBucket",
+    "qBtmVertRunoff",
+]
+
+# The chunks of main.zarr: about 3 MB of int32 each, and a year in 13 chunks
+FEATURE_CHUNK = 1024
+TIME_CHUNK = 24 * 30
+
+# The chunks of the blocks being filled
+RECENT_FEATURE_CHUNK = 8192
+RECENT_TIME_CHUNK = 24
+
+# Blocks start at multiples of TIME_CHUNK hours since the epoch
+EPOCH = pd.Timestamp("1970-01-01")
+HOUR = pd.Timedelta(hours=1)
+
+
+def network_order(link: np.ndarray, to: np.ndarray) -> np.ndarray:
+    """
+    The positions of the reaches ``link`` (flowing into ``to``) in depth-first
+    order up the network from each outlet, so that every sub-basin is
+    contiguous. Reaches on a cycle, if any, come last.
+    """
+    n = len(link)
+    by_link = np.argsort(link)
+    i = np.minimum(np.searchsorted(link[by_link], to), n - 1)
+    parent = np.where(link[by_link][i] == to, by_link[i], -1)
+
+    # The upstream reaches of each reach are children[starts[i]:starts[i + 1]].
+    children = np.argsort(parent, kind="stable")
+    starts = np.searchsorted(parent[children], np.arange(n + 1))
+    order = np.empty(n, dtype="int64")
+    visited = np.zeros(n, dtype=bool)
+    k = 0
+    stack = np.flatnonzero(parent < 0)[::-1].tolist()
+    while stack:
+        node = stack.pop()
+        order[k] = node
+        visited[node] = True
+        k += 1
+        stack.extend(children[starts[node] : starts[node + 1]][::-1].tolist())
+    order[k:] = np.flatnonzero(~visited)
+    return order
+
+
+def feature_order(
+    feature_id: np.ndarray,
+    route_link: str | None = None,
+    storage_options: dict[str, Any] | None = None,
+) -> np.ndarray:
+    """
+    The store's order of the reaches ``feature_id``: `network_order` with a
+    ``RouteLink`` file, and otherwise the order of the files. Reaches missing
+    from the ``RouteLink`` file come last.
+    """
+    if route_link is None:
+        return np.arange(len(feature_id))
+    with fsspec.open(route_link, "rb", **(storage_options or {})) as f:
+        rl = xr.open_dataset(f, engine="h5netcdf")[["link", "to"]].load()
+    link = rl["link"].values
+    ranked = link[network_order(link, rl["to"].values)]
+    by_id = np.argsort(ranked)
+    i = np.minimum(np.searchsorted(ranked[by_id], feature_id), len(ranked) - 1)
+    rank = np.where(ranked[by_id][i] == feature_id, by_id[i], len(ranked))
+    return np.argsort(rank, kind="stable")
+
+
+def block_start(time: pd.Timestamp) -> pd.Timestamp:
+    """The start of the block of ``TIME_CHUNK`` hours holding ``time``."""
+    hours = (time - EPOCH) // HOUR
+    return EPOCH + (hours // TIME_CHUNK) * TIME_CHUNK * HOUR
+
+
+def read_hour(
+    url: str,
+    feature_id: np.ndarray,
+    variables: list[str],
+    storage_options: dict[str, Any] | None = None,
+) -> dict[str, np.ndarray]:
+    """The values of ``variables`` in one channel_rt file, in the store's order."""
+    with fsspec.open(url, "rb", **(storage_options or {})) as f:
+        ds = xr.open_dataset(f, engine="h5netcdf")[variables].load()
+    index = features.FeatureIndex(ds["feature_id"].values, chunk_size=1)
+    positions = index.positions(feature_id)
+    return {name: ds[name].values[positions] for name in variables}
+
+
+def _block_url(target: str, start: pd.Timestamp) -> str:
+    return f"{target}/recent/{start:%Y%m%dT%H}.zarr"
+
+
+def _blocks(target: str, storage_options: dict[str, Any]) -> list[pd.Timestamp]:
+    fs, path = fsspec.core.url_to_fs(f"{target}/recent", **storage_options)
+    if not fs.exists(path):
+        return []
+    names = [p.rstrip("/").rsplit("/", 1)[-1] for p in fs.ls(path, detail=False)]
+    return sorted(
+        pd.Timestamp(n[: -len(".zarr")]) for n in names if n.endswith(".zarr")
+    )
+
+
+def _open(store) -> xr.Dataset | None:
+    if ".zgroup" not in store:
+        return None
+    return xr.open_dataset(store, engine="zarr", chunks={})
+
+
+def create_block(
+    store, start: pd.Timestamp, feature_id: np.ndarray, template: xr.Dataset
+) -> None:
+    """
+    Create the store of the block starting at ``start``, empty, with the
+    variables, attributes and packing of the channel_rt file ``template``.
+    """
+    time = pd.date_range(start, periods=TIME_CHUNK, freq="h")
+    chunks = (min(RECENT_FEATURE_CHUNK, len(feature_id)), RECENT_TIME_CHUNK)
+    data_vars = {}
+    encodings = {}
+    for name, v in template.data_vars.items():
+        data_vars[name] = xr.Variable(
+            ("feature_id", "time"),
+            da.full((len(feature_id), TIME_CHUNK), np.nan, chunks=chunks),
+            attrs=v.attrs,
+        )
+        encodings[name] = dict(
+            encoding.variable_encoding(v.variable, encoding.Profile()), chunks=chunks
+        )
+    ds = xr.Dataset(data_vars, coords={"feature_id": feature_id, "time": time})
+    ds.attrs = {"block_start": str(start)}
+    encodings["time"] = {"units": "hours since 1970-01-01", "dtype": "int64"}
+    ds.to_zarr(store, mode="w", encoding=encodings, compute=False, consolidated=True)
+
+
+def write_hours(
+    store,
+    start: pd.Timestamp,
+    urls: dict[pd.Timestamp, str],
+    feature_id: np.ndarray,
+    variables: list[str],
+    storage_options: dict[str, Any] | None = None,
+) -> None:
+    """
+    Write the files ``urls`` (by valid time, all in one day of the block) into
+    the block's store. Each task writes one chunk.
+    """
+    times = sorted(urls)
+    i0 = (times[0] - start) // HOUR
+    i1 = (times[-1] - start) // HOUR + 1
+    read = dask.delayed(metrics.task("read_hour", read_hour), pure=True)
+    columns = {t: read(urls[t], feature_id, variables, storage_options) for t in times}
+    data_vars = {}
+    for name in variables:
+        parts = [
+            da.from_delayed(columns[t][name], (len(feature_id),), dtype="float64")
+            if t in columns
+            else da.full((len(feature_id),), np.nan)
+            for t in pd.date_range(times[0], times[-1], freq="h")
+        ]
+        data = da.stack(parts, axis=1).rechunk(
+            (min(RECENT_FEATURE_CHUNK, len(feature_id)), i1 - i0)
+        )
+        data_vars[name] = (("feature_id", "time"), data)
+    # Only one task writes each chunk, so partial chunks along time are safe.
+    xr.Dataset(data_vars).to_zarr(
+        store, region={"time": slice(i0, i1)}, safe_chunks=False
+    )
+
+
+def fold(target: str, start: pd.Timestamp, storage_options: dict[str, Any]) -> None:
+    """
+    Append the finished block starting at ``start`` to ``main.zarr`` and delete
+    its store. Missing blocks before it are appended empty.
+    """
+    main = fsspec.get_mapper(f"{target}/main.zarr", **storage_options)
+    block = xr.open_dataset(
+        fsspec.get_mapper(_block_url(target, start), **storage_options),
+        engine="zarr",
+        chunks={"feature_id": RECENT_FEATURE_CHUNK, "time": -1},
+    ).chunk({"feature_id": FEATURE_CHUNK})
+    existing = _open(main)
+    end = None if existing is None else existing.time.values[-1] + HOUR
+    # A block after main.zarr's end, unless it was folded before its store was
+    # deleted
+    if end is None or end <= start:
+        while end is not None and end < start:
+            gap = xr.full_like(block, np.nan).assign_coords(
+                time=pd.date_range(end, periods=TIME_CHUNK, freq="h")
+            )
+            _append(main, gap)
+            end += TIME_CHUNK * HOUR
+        _append(main, block)
+    fs, path = fsspec.core.url_to_fs(_block_url(target, start), **storage_options)
+    fs.rm(path, recursive=True)
+
+
+def _append(main, ds: xr.Dataset) -> None:
+    ds = ds.copy()
+    ds.attrs = {}
+    if ".zgroup" in main:
+        ds.drop_vars("feature_id").to_zarr(main, append_dim="time", consolidated=True)
+        return
+    chunks = (min(FEATURE_CHUNK, ds.sizes["feature_id"]), TIME_CHUNK)
+    encodings = {}
+    for name, v in ds.variables.items():
+        encodings[name] = {
+            k: x
+            for k, x in v.encoding.items()
+            if k not in {"chunks", "preferred_chunks"}
+        }
+        if v.dims == ("feature_id", "time"):
+            encodings[name]["chunks"] = chunks
+    ds.to_zarr(main, mode="w", encoding=encodings, consolidated=True)
+
+
+def _through(target: str, storage_options: dict[str, Any]) -> pd.Timestamp | None:
+    """The last hour written."""
+    blocks = _blocks(target, storage_options)
+    if blocks:
+        store = fsspec.get_mapper(_block_url(target, blocks[-1]), **storage_options)
+        through = zarr.open_group(store, mode="r").attrs.get("through")
+        if through is not None:
+            return pd.Timestamp(through)
+    main = _open(fsspec.get_mapper(f"{target}/main.zarr", **storage_options))
+    return None if main is None else pd.Timestamp(main.time.values[-1])
+
+
+def _feature_ids(target: str, storage_options: dict[str, Any]) -> np.ndarray | None:
+    urls = [f"{target}/main.zarr"] + [
+        _block_url(target, start) for start in _blocks(target, storage_options)
+    ]
+    for url in urls:
+        ds = _open(fsspec.get_mapper(url, **storage_options))
+        if ds is not None:
+            return ds["feature_id"].values
+    return None
+
+
+def update(
+    urls: list[str],
+    target: str,
+    variables: list[str] | None = None,
+    route_link: str | None = None,
+    storage_options: dict[str, Any] | None = None,
+    source_options: dict[str, Any] | None = None,
+) -> int:
+    """
+    Write the channel_rt files ``urls`` valid after the last hour in the store
+    at ``target``, then move the finished blocks to ``main.zarr``. Returns the
+    number of hours written.
+
+    The first update orders the reaches (see `feature_order`) and writes the
+    ``features.npz`` index. The files are read with ``source_options``, and the
+    store and ``route_link`` with ``storage_options``.
+    """
+    storage_options = storage_options or {}
+    variables = variables or VARIABLES
+    through = _through(target, storage_options)
+    new = {}
+    for url in urls:
+        time = noaanwm.parse_url(url).valid_time
+        if through is None or time > through:
+            new[time] = url
+    if not new:
+        return 0
+
+    first = new[min(new)]
+    with fsspec.open(first, "rb", **(source_options or {})) as f:
+        template = xr.open_dataset(f, engine="h5netcdf")[variables].load()
+    feature_id = _feature_ids(target, storage_options)
+    if feature_id is None:
+        file_ids = template["feature_id"].values
+        with metrics.stage("order"):
+            order = feature_order(file_ids, route_link, storage_options)
+        feature_id = file_ids[order]
+        lon = lat = None
+        if route_link is not None:
+            lon, lat = features.route_link_locations(
+                route_link, feature_id, storage_options
+            )
+        index = features.FeatureIndex(feature_id, FEATURE_CHUNK, lon, lat)
+        index.save(f"{target}/features.npz", storage_options)
+    template = template.drop_vars("feature_id")
+
+    # One batch of tasks per day of each block
+    days = {}
+    for time, url in sorted(new.items()):
+        start = block_start(time)
+        day = (time - start) // HOUR // RECENT_TIME_CHUNK * RECENT_TIME_CHUNK
+        day = start + day * HOUR
+        days.setdefault((start, day), {})[time] = url
+    for (start, day), group in days.items():
+        url = _block_url(target, start)
+        store = fsspec.get_mapper(url, **storage_options)
+        if ".zgroup" not in store:
+            create_block(store, start, feature_id, template)
+        with metrics.stage("write_hours", day=str(day)):
+            write_hours(store, start, group, feature_id, variables, source_options)
+        zarr.open_group(store, mode="r+").attrs["through"] = str(max(group))
+        zarr.consolidate_metadata(store)
+        print(f"Wrote {len(group)} hours to {url}")
+
+    through = max(new)
+    for start in _blocks(target, storage_options):
+        if start + (TIME_CHUNK - 1) * HOUR <= through:
+            with metrics.stage("fold", block=str(start)):
+                fold(target, start, storage_options)
+            print(f"Moved the block starting {start} to main.zarr")
+    return len(new)
+
+
+def open_timeseries(
+    target: str, storage_options: dict[str, Any] | None = None
+) -> xr.Dataset:
+    """
+    The store at ``target`` as one lazy Dataset, through the last hour written.
+    Select reaches with ``isel`` and the positions from ``features.npz``.
+    """
+    storage_options = storage_options or {}
+    urls = [f"{target}/main.zarr"] + [
+        _block_url(target, start) for start in _blocks(target, storage_options)
+    ]
+    parts = [_open(fsspec.get_mapper(url, **storage_options)) for url in urls]
+    parts = [ds for ds in parts if ds is not None]
+    if not parts:
+        raise FileNotFoundError(f"No channel_rt time series at {target}")
+    ds = xr.concat(
+        parts, "time", data_vars="minimal", coords="minimal", compat="override"
+    )
+    return ds.sel(time=slice(None, _through(target, storage_options)))
+
+
+def get_storage_options(url):
+    if url.split("://")[0] in ("az", "abfs"):
+        return {
+            "account_name": "noaanwm",
+            "credential": os.environ["AZURE_SAS_TOKEN"],
+        }
+    return {}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    update = subparsers.add_parser(
+        "update", help="Write the new channel_rt files into the time series store"
+    )
+    update.add_argument("target", help="The directory of the store")
+    update.add_argument("--variables", nargs="+", default=VARIABLES)
+    update.add_argument(
+        "--route-link",
+        default=None,
+        help="An NWM RouteLink file, to order the reaches by the river network",
+    )
+    update.add_argument(
+        "--start", default=None, help="The first day (YYYYMMDD) of a new store"
+    )
+    update.add_argument(
+        "--metrics",
+        default="metrics/channel_timeseries",
+        help="Write per-stage metrics to {metrics}.json and {metrics}.prom",
+    )
+    executor.add_arguments(update)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    source_options = {"account_name": "noaanwm"}
+    inv = inventory.Inventory("nwm-inventory.sqlite", "abfs", source_options)
+    print("Refreshing inventory")
+    inv.refresh()
+    storage_options = get_storage_options(args.target)
+    through = _through(args.target, storage_options)
+    start = through.date() if through is not None else args.start
+    paths = inv.files(
+        product="short_range", kind="channel_rt", forecast_time=1, start=start
+    )
+    urls = ["abfs://" + path for path in paths]
+    etags = {"abfs://" + k: v for k, v in inv.etags(kind="channel_rt").items()}
+    with dask.config.set(scheduler="processes"), metrics.stage("validate"):
+        bad = validate.find_bad(
+            urls, etags, validate.Verdicts(inv.path), source_options
+        )
+    urls = [url for url in urls if url not in bad]
+
+    upload = [
+        "metrics.py",
+        "executor.py",
+        "encoding.py",
+        "features.py",
+        "scanner.py",
+        "noaanwm.py",
+        "inventory.py",
+        "validate.py",
+        "channel_timeseries.py",
+    ]
+    with executor.from_args(args, upload=upload) as client:
+        with dask.annotate(retries=10):
+            hours = update(
+                urls,
+                args.target,
+                args.variables,
+                args.route_link,
+                storage_options,
+                source_options,
+            )
+        print(f"Wrote {hours} hours")
+        records = metrics.gather(client)
+
+    metrics.report(records)
+    metrics.write(args.metrics, records)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""
+Hour-of-day and monthly climatologies and daily extremes of the forcing
+variables, maintained incrementally.
+
+    python climatology.py update \\
+        az://ciroh/zarr/ts/short-range-forcing-rechunked-test.zarr \\
+        az://ciroh/zarr/climatology/short-range-forcing
+
+Each aggregate is a small Zarr store under the target:
+
+- ``hourly.zarr``: ``{name}_sum`` and ``{name}_count`` over ``(hour, y, x)``
+- ``monthly.zarr``: ``{name}_sum`` and ``{name}_count`` over ``(month, y, x)``
+- ``daily.zarr``: ``{name}_min`` and ``{name}_max`` over ``(date, y, x)``
+
+Means are kept as running sums and counts (of the valid values), so an update
+only reads the times after the store's ``folded_through`` attribute and adds
+them in. `open_climatology` gives the means and `anomalies` subtracts them from a
+selection, reading a few chunks of the aggregate instead of the whole archive.
+"""
+import argparse
+import os
+import sys
+
+import dask
+import fsspec
+import numpy as np
+import xarray as xr
+import zarr
+
+import executor
+import metrics
+
+VARIABLES = ["U2D", "V2D", "LWDOWN", "RAINRATE", "T2D", "Q2D", "PSFC", "SWDOWN"]
+
+# The group of each climatology and its labels.
+GROUPS = {"hourly": ("hour", np.arange(24)), "monthly": ("month", np.arange(1, 13))}
+
+DAILY_CHUNK = 32
+
+
+def sums(ds: xr.Dataset, kind: str, variables: list[str]) -> xr.Dataset:
+    """The sums and counts of the valid values of ``variables`` by hour or month."""
+    group, labels = GROUPS[kind]
+    by = ds[f"time.{group}"]
+    out = {}
+    for name in variables:
+        v = ds[name]
+        out[f"{name}_sum"] = v.astype("float64").groupby(by).sum("time")
+        out[f"{name}_count"] = v.notnull().groupby(by).sum("time").astype("int32")
+        out[f"{name}_sum"].attrs = v.attrs
+    return xr.Dataset(out).reindex({group: labels}, fill_value=0)
+
+
+def extremes(ds: xr.Dataset, variables: list[str]) -> xr.Dataset:
+    """The daily minimum and maximum of ``variables``."""
+    daily = ds[variables].resample(time="1D")
+    lo, hi = daily.min(), daily.max()
+    out = {}
+    for name in variables:
+        out[f"{name}_min"] = lo[name].assign_attrs(ds[name].attrs)
+        out[f"{name}_max"] = hi[name].assign_attrs(ds[name].attrs)
+    return xr.Dataset(out).rename(time="date")
+
+
+def _state(store) -> dict:
+    if ".zgroup" not in store:
+        return {}
+    return dict(zarr.open_group(store, mode="r").attrs)
+
+
+def _set_state(store, **attrs) -> None:
+    group = zarr.open_group(store, mode="r+")
+    group.attrs.update(attrs)
+    zarr.consolidate_metadata(store)
+
+
+def _new_times(ds: xr.Dataset, state: dict, name: str) -> xr.Dataset:
+    if state.get("pending"):
+        raise RuntimeError(
+            f"An earlier update of {name} through {state['pending']} didn't finish, "
+            "so its sums may be partly updated. Rebuild it with --rebuild."
+        )
+    if "folded_through" not in state:
+        return ds
+    return ds.isel(time=ds.time.values > np.datetime64(state["folded_through"]))
+
+
+def _chunks(ds: xr.Dataset, dims: dict[str, int]) -> dict[str, dict]:
+    return {
+        name: {"chunks": tuple(dims.get(d, v.sizes[d]) for d in v.dims)}
+        for name, v in ds.data_vars.items()
+    }
+
+
+def update_sums(ds, store, kind, variables, chunks):
+    """Add the times of ``ds`` not yet in the ``kind`` store to its sums."""
+    new = _new_times(ds, _state(store), kind)
+    if not new.sizes["time"]:
+        return 0
+    through = str(new.time.values.max())
+    partial = sums(new, kind, variables)
+    group, labels = GROUPS[kind]
+    chunks = dict(chunks, **{group: len(labels)})
+
+    if ".zgroup" not in store:
+        partial.chunk(chunks).to_zarr(
+            store, mode="w", encoding=_chunks(partial, chunks), consolidated=True
+        )
+    else:
+        _set_state(store, pending=through)
+        existing = xr.open_dataset(store, engine="zarr", chunks={})
+        # Each task reads and writes the same chunk of the store.
+        total = (existing[list(partial)] + partial).chunk(existing.chunks)
+        total.drop_vars(list(total.coords)).to_zarr(store, mode="r+")
+    _set_state(store, folded_through=through, pending=None)
+    return new.sizes["time"]
+
+
+def update_extremes(ds, store, variables, chunks):
+    """Fold the times of ``ds`` not yet in the daily store into its extremes."""
+    new = _new_times(ds, _state(store), "daily")
+    if not new.sizes["time"]:
+        return 0
+    through = str(new.time.values.max())
+    daily = extremes(new, variables)
+    chunks = dict(chunks, date=DAILY_CHUNK)
+
+    if ".zgroup" not in store:
+        daily.chunk(chunks).to_zarr(
+            store, mode="w", encoding=_chunks(daily, chunks), consolidated=True
+        )
+    else:
+        _set_state(store, pending=through)
+        existing = xr.open_dataset(store, engine="zarr", chunks={})
+        # The first new day may already be partly in the store.
+        overlap = daily.date.isin(existing.date.values)
+        if overlap.any():
+            old = daily.isel(date=overlap.values)
+            start = int(np.searchsorted(existing.date.values, old.date.values[0]))
+            region = {"date": slice(start, start + old.sizes["date"])}
+            lo = [v for v in old if v.endswith("_min")]
+            hi = [v for v in old if v.endswith("_max")]
+            current = existing[list(old)].isel(region)
+            merged = xr.merge(
+                [
+                    np.fmin(old[lo], current[lo]),
+                    np.fmax(old[hi], current[hi]),
+                ]
+            )
+            # Only one task writes each chunk, so partial chunks along date are safe.
+            merged.drop_vars(list(merged.coords)).chunk(chunks).to_zarr(
+                store, region=region, safe_chunks=False
+            )
+        rest = daily.isel(date=~overlap.values)
+        if rest.sizes["date"]:
+            # Align the dask chunks to the store's, so no two tasks write the same
+            # chunk: the first fills the store's last, partial chunk.
+            n = rest.sizes["date"]
+            first = DAILY_CHUNK - existing.sizes["date"] % DAILY_CHUNK
+            dates = [min(first, n)]
+            dates += [min(DAILY_CHUNK, n - i) for i in range(first, n, DAILY_CHUNK)]
+            rest.chunk(dict(chunks, date=tuple(dates))).to_zarr(
+                store, append_dim="date"
+            )
+    _set_state(store, folded_through=through, pending=None)
+    return new.sizes["time"]
+
+
+def update(
+    source: str,
+    target: str,
+    variables: list[str] | None = None,
+    storage_options: dict | None = None,
+    rebuild: bool = False,
+) -> dict[str, int]:
+    """
+    Fold the times of the Zarr store at ``source`` not yet in the aggregates
+    under ``target`` into them. Returns the number of times folded into each.
+    """
+    storage_options = storage_options or {}
+    variables = variables or VARIABLES
+    ds = xr.open_dataset(
+        fsspec.get_mapper(source, **storage_options), engine="zarr", chunks={}
+    )
+    ds = ds[variables]
+    chunks = {d: c[0] for d, c in ds.chunks.items() if d in ("y", "x")}
+
+    folded = {}
+    for kind in [*GROUPS, "daily"]:
+        url = f"{target}/{kind}.zarr"
+        if rebuild:
+            fs, path = fsspec.core.url_to_fs(url, **storage_options)
+            if fs.exists(path):
+                fs.rm(path, recursive=True)
+        store = fsspec.get_mapper(url, **storage_options)
+        with metrics.stage(kind):
+            if kind == "daily":
+                folded[kind] = update_extremes(ds, store, variables, chunks)
+            else:
+                folded[kind] = update_sums(ds, store, kind, variables, chunks)
+        print(f"{kind}: folded in {folded[kind]} times")
+    return folded
+
+
+def open_climatology(
+    target: str, kind: str = "hourly", storage_options: dict | None = None
+) -> xr.Dataset:
+    """The ``hourly`` or ``monthly`` means, as a lazy Dataset of each variable."""
+    store = fsspec.get_mapper(f"{target}/{kind}.zarr", **(storage_options or {}))
+    ds = xr.open_dataset(store, engine="zarr", chunks={})
+    names = [name[: -len("_sum")] for name in ds.data_vars if name.endswith("_sum")]
+    means = xr.Dataset(
+        {
+            name: (ds[f"{name}_sum"] / ds[f"{name}_count"])
+            .astype("float32")
+            .assign_attrs(ds[f"{name}_sum"].attrs)
+            for name in names
+        }
+    )
+    means.attrs = ds.attrs
+    return means
+
+
+def anomalies(da: xr.DataArray, means: xr.Dataset | xr.DataArray) -> xr.DataArray:
+    """
+    ``da`` minus its hour-of-day or monthly mean from `open_climatology`.
+
+    Only the part of the means under ``da`` is loaded.
+    """
+    if isinstance(means, xr.Dataset):
+        means = means[da.name]
+    group = next(d for d in means.dims if d in ("hour", "month"))
+    means = means.sel({d: da[d] for d in means.dims if d in da.dims}).load()
+    return da.groupby(f"time.{group}") - means
+
+
+def get_storage_options(url):
+    if url.split("://")[0] in ("az", "abfs"):
+        return {
+            "account_name": "noaanwm",
+            "credential": os.environ["AZURE_SAS_TOKEN"],
+        }
+    return {}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    update = subparsers.add_parser(
+        "update", help="Fold new times into the climatology stores"
+    )
+    update.add_argument("source", help="The (rechunked) forcing Zarr store")
+    update.add_argument("target", help="The directory of the climatology stores")
+    update.add_argument("--variables", nargs="+", default=VARIABLES)
+    update.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Delete the stores and rebuild them from the whole source",
+    )
+    update.add_argument(
+        "--metrics",
+        default="metrics/climatology",
+        help="Write per-stage metrics to {metrics}.json and {metrics}.prom",
+    )
+    executor.add_arguments(update)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    storage_options = get_storage_options(args.target)
+
+    with executor.from_args(args, upload=["metrics.py"]) as client:
+        with dask.annotate(retries=10):
+            update(
+                args.source,
+                args.target,
+                args.variables,
+                storage_options=storage_options,
+                rebuild=args.rebuild,
+            )
+        records = metrics.gather(client)
+
+    metrics.report(records)
+    metrics.write(args.metrics, records)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
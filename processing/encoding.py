@@ -0,0 +1,289 @@
+"""
+Per-variable codec profiles for the Zarr outputs, and a tool to measure them.
+
+A `Profile` says how to store a variable: its compressor, whether to keep the
+``scale_factor`` / ``add_offset`` packing of the source NetCDF files (lossless,
+since the values were packed to begin with), and optionally how many mantissa
+bits of a float to keep (lossy). Time coordinates are stored as integers with a
+``Delta`` filter.
+
+>>> profiles = parse_profiles({"*": {"compressor": "blosc-zstd-bitshuffle"},
+...                            "RAINRATE": {"keepbits": 10}})
+>>> ds = apply(ds, profiles)
+>>> ds.to_zarr(store)
+
+``python encoding.py report STORE`` samples chunks of a Zarr store and reports
+the compression ratio and the encode and decode throughput of each candidate:
+
+    python encoding.py report \\
+        az://ciroh/zarr/ts/short-range-forcing-rechunked-test.zarr \\
+        --variables RAINRATE T2D --keepbits 8 12
+"""
+import argparse
+import dataclasses
+import itertools
+import math
+import os
+import sys
+import time
+from typing import Any
+
+import fsspec
+import numcodecs
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+COMPRESSORS = {
+    "blosc-zstd": numcodecs.Blosc(
+        cname="zstd", clevel=5, shuffle=numcodecs.Blosc.SHUFFLE
+    ),
+    "blosc-zstd-bitshuffle": numcodecs.Blosc(
+        cname="zstd", clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE
+    ),
+    "blosc-lz4": numcodecs.Blosc(
+        cname="lz4", clevel=5, shuffle=numcodecs.Blosc.SHUFFLE
+    ),
+    "zstd": numcodecs.Zstd(level=5),
+}
+
+# The encoding of the source files kept when repacking
+PACKING = ["dtype", "scale_factor", "add_offset", "_FillValue"]
+
+
+@dataclasses.dataclass(frozen=True)
+class Profile:
+    """
+    Parameters
+    ----------
+    compressor
+        One of `COMPRESSORS`.
+    pack
+        Keep the source's ``scale_factor`` / ``add_offset`` packing, if any.
+    keepbits
+        Round floats to this many mantissa bits before compressing (lossy).
+    """
+
+    compressor: str = "blosc-zstd"
+    pack: bool = True
+    keepbits: int | None = None
+
+    def __str__(self):
+        name = self.compressor + ("+pack" if self.pack else "")
+        return name + (f"+keepbits={self.keepbits}" if self.keepbits else "")
+
+
+def parse_profiles(spec: dict[str, dict[str, Any]] | None) -> dict[str, Profile]:
+    """
+    The profile of each variable from a mapping of variable name (or ``"*"``, for
+    the rest) to `Profile` fields. Fields not given for a variable come from
+    ``"*"``.
+    """
+    spec = spec or {}
+    default = spec.get("*", {})
+    profiles = {
+        name: Profile(**{**default, **fields})
+        for name, fields in spec.items()
+        if name != "*"
+    }
+    profiles["*"] = Profile(**default)
+    return profiles
+
+
+def _is_time(v: xr.Variable) -> bool:
+    return v.dtype.kind in "mM"
+
+
+def variable_encoding(v: xr.Variable, profile: Profile) -> dict[str, Any]:
+    """
+    The Zarr encoding of ``v`` with ``profile``. The packing comes from the
+    source encoding still on ``v``.
+    """
+    encoding = {"compressor": COMPRESSORS[profile.compressor], "filters": None}
+    source = v.encoding
+    if _is_time(v):
+        for key in ["units", "calendar"]:
+            if key in source:
+                encoding[key] = source[key]
+        encoding["dtype"] = "int64"
+        encoding["filters"] = [numcodecs.Delta(dtype="<i8")]
+    elif profile.pack and "scale_factor" in source and "dtype" in source:
+        encoding.update({key: source[key] for key in PACKING if key in source})
+    elif profile.keepbits is not None and v.dtype.kind == "f":
+        encoding["filters"] = [numcodecs.BitRound(keepbits=profile.keepbits)]
+    return encoding
+
+
+def apply(ds: xr.Dataset, profiles: dict[str, Profile] | None = None) -> xr.Dataset:
+    """
+    Replace the encoding of each variable of ``ds`` with its profile's (or the
+    ``"*"`` profile's), keeping the chunks.
+    """
+    profiles = profiles or {}
+    default = profiles.get("*", Profile())
+    for name, v in ds.variables.items():
+        encoding = variable_encoding(v, profiles.get(name, default))
+        if "chunks" in v.encoding:
+            encoding["chunks"] = v.encoding["chunks"]
+        v.encoding = encoding
+    return ds
+
+
+def sample(ds: xr.Dataset, name: str, n: int = 8, seed: int = 0) -> list[xr.DataArray]:
+    """``n`` random chunks of ``ds[name]``, decoded, with the source encoding."""
+    v = ds[name]
+    chunks = v.encoding.get("chunks") or v.encoding.get("chunksizes") or v.shape
+    grid = [math.ceil(s / c) for s, c in zip(v.shape, chunks)]
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(math.prod(grid), min(n, math.prod(grid)), replace=False)
+    out = []
+    for flat in picks:
+        index = np.unravel_index(flat, grid)
+        slices = {
+            d: slice(i * c, (i + 1) * c) for d, i, c in zip(v.dims, index, chunks)
+        }
+        part = v.isel(slices).load()
+        part.encoding = v.encoding
+        out.append(part)
+    return out
+
+
+def measure(parts: list[xr.DataArray], profile: Profile) -> dict[str, Any]:
+    """
+    The compression ratio (against the decoded values), the encode and decode
+    throughput (MB/s of decoded values) and the largest error of ``profile`` on
+    ``parts``.
+    """
+    nbytes = compressed = 0
+    encode_seconds = decode_seconds = 0.0
+    max_error = 0.0
+    # The first chunk is measured twice, to leave out the codecs' warm-up.
+    for i, part in enumerate(parts[:1] + parts):
+        encoding = variable_encoding(part.variable, profile)
+        cf = {k: encoding[k] for k in PACKING + ["units", "calendar"] if k in encoding}
+        filters = encoding["filters"] or []
+        compressor = encoding["compressor"]
+
+        t0 = time.perf_counter()
+        stored = xr.conventions.encode_cf_variable(
+            xr.Variable(part.dims, part.values, attrs={}, encoding=cf)
+        )
+        buf = np.ascontiguousarray(stored.values)
+        for f in filters:
+            buf = f.encode(buf)
+        data = compressor.encode(buf)
+        t1 = time.perf_counter()
+        buf = compressor.decode(data)
+        for f in filters[::-1]:
+            buf = f.decode(buf)
+        raw = np.frombuffer(buf, dtype=stored.dtype).reshape(stored.shape)
+        decoded = xr.conventions.decode_cf_variable(
+            part.name, xr.Variable(part.dims, raw, attrs=stored.attrs)
+        ).values
+        t2 = time.perf_counter()
+        if i == 0:
+            continue
+
+        nbytes += part.values.nbytes
+        compressed += len(data)
+        encode_seconds += t1 - t0
+        decode_seconds += t2 - t1
+        if part.dtype.kind == "f":
+            error = np.nanmax(np.abs(decoded - part.values), initial=0.0)
+            max_error = max(max_error, float(error))
+    return dict(
+        profile=str(profile),
+        ratio=nbytes / compressed,
+        encode_mb_s=nbytes / encode_seconds / 1e6,
+        decode_mb_s=nbytes / decode_seconds / 1e6,
+        max_error=max_error,
+    )
+
+
+def candidates(
+    compressors: list[str], keepbits: list[int], packed: bool
+) -> list[Profile]:
+    """Each compressor unpacked, packed (if the source is) and bit-rounded."""
+    out = []
+    for compressor in compressors:
+        out.append(Profile(compressor, pack=False))
+        if packed:
+            out.append(Profile(compressor, pack=True))
+    for compressor, bits in itertools.product(compressors, keepbits):
+        out.append(Profile(compressor, pack=False, keepbits=bits))
+    return out
+
+
+def report(
+    ds: xr.Dataset,
+    variables: list[str] | None = None,
+    compressors: list[str] | None = None,
+    keepbits: list[int] | None = None,
+    samples: int = 8,
+) -> pd.DataFrame:
+    """`measure` each candidate profile on ``samples`` chunks of ``variables``."""
+    variables = variables or [
+        name for name, v in ds.data_vars.items() if v.dtype.kind in "fiu"
+    ]
+    rows = []
+    for name in variables:
+        parts = sample(ds, name, samples)
+        packed = "scale_factor" in ds[name].encoding
+        for profile in candidates(
+            compressors or list(COMPRESSORS), keepbits or [], packed
+        ):
+            rows.append(dict(variable=name, **measure(parts, profile)))
+    return pd.DataFrame(rows)
+
+
+def get_storage_options(url):
+    if url.split("://")[0] in ("az", "abfs"):
+        return {
+            "account_name": "noaanwm",
+            "credential": os.environ["AZURE_SAS_TOKEN"],
+        }
+    return {}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    report = subparsers.add_parser(
+        "report", help="Measure the candidate profiles on sampled chunks"
+    )
+    report.add_argument("store", help="A Zarr store, or a NetCDF file")
+    report.add_argument("--variables", nargs="+", default=None)
+    report.add_argument(
+        "--compressors", nargs="+", choices=list(COMPRESSORS), default=None
+    )
+    report.add_argument(
+        "--keepbits",
+        nargs="+",
+        type=int,
+        default=[],
+        help="Also try bit rounding to these numbers of mantissa bits",
+    )
+    report.add_argument("--samples", type=int, default=8, help="Chunks per variable")
+    report.add_argument("--output", default=None, help="Also write a CSV file")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    storage_options = get_storage_options(args.store)
+    if args.store.endswith(".nc"):
+        ds = xr.open_dataset(fsspec.open(args.store, **storage_options).open())
+    else:
+        ds = xr.open_dataset(
+            fsspec.get_mapper(args.store, **storage_options), engine="zarr", chunks=None
+        )
+    df = report(ds, args.variables, args.compressors, args.keepbits, args.samples)
+    print(df.to_string(index=False, float_format="{:.3g}".format))
+    if args.output:
+        df.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
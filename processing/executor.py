@@ -0,0 +1,201 @@
+"""
+Where the pipelines run.
+
+Each command line takes the same options (see `add_arguments`):
+
+- ``--executor serial``: one task at a time in this process, for debugging and
+  profiling
+- ``--executor threads`` or ``processes``: Dask's local thread or process pool
+- ``--executor local``: a ``distributed.LocalCluster`` on this machine, with a
+  dashboard
+- ``--executor remote --scheduler-address tcp://...``: an existing Dask cluster
+- ``--executor kube`` (the default): a new ``KubeCluster``
+
+``--workers`` defaults to a size for the job: no more workers than tasks and,
+locally, no more than the machine's cores and memory allow.
+
+>>> with executor.connect("local", tasks=len(files)) as client:
+...     dask.compute(*tasks)
+...     records = metrics.gather(client)
+
+With ``serial``, ``threads`` and ``processes`` there's no client, and the
+``processes`` backend loses the metrics recorded in its worker processes.
+"""
+import argparse
+import contextlib
+import sys
+from typing import Any, Iterator, Sequence
+
+import dask
+import dask.system
+import dask.utils
+import distributed
+import psutil
+from dask_kubernetes.operator import KubeCluster
+
+BACKENDS = ["serial", "threads", "processes", "local", "remote", "kube"]
+
+# The most workers a job scales a Kubernetes cluster to
+MAX_WORKERS = 64
+
+WORKER_MEMORY = "8GB"
+
+
+def size(
+    tasks: int | None,
+    backend: str = "local",
+    worker_memory: str = WORKER_MEMORY,
+    max_workers: int = MAX_WORKERS,
+) -> int:
+    """
+    The number of workers for ``tasks`` tasks: at most one per task and, for the
+    local backends, at most one per core and per ``worker_memory`` available.
+    """
+    if backend == "serial":
+        return 1
+    limit = max_workers
+    if backend not in ("kube", "remote"):
+        memory = psutil.virtual_memory().available
+        limit = min(
+            limit,
+            dask.system.CPU_COUNT,
+            memory // dask.utils.parse_bytes(worker_memory),
+        )
+    limit = max(limit, 1)
+    return min(tasks, limit) if tasks else limit
+
+
+def _upload(client: distributed.Client, upload: Sequence[str]) -> None:
+    for path in upload:
+        client.upload_file(path)
+
+
+@contextlib.contextmanager
+def connect(
+    backend: str = "kube",
+    tasks: int | None = None,
+    workers: int | None = None,
+    address: str | None = None,
+    upload: Sequence[str] = (),
+    worker_memory: str = WORKER_MEMORY,
+    threads_per_worker: int = 1,
+    max_workers: int = MAX_WORKERS,
+    kube_options: dict[str, Any] | None = None,
+) -> Iterator[distributed.Client | None]:
+    """
+    Run the ``with`` block's Dask computations on ``backend``, yielding the
+    ``distributed.Client`` (or None for the schedulers without one).
+
+    Parameters
+    ----------
+    tasks
+        The number of tasks in the job, to size the workers (see `size`).
+    workers
+        The number of workers, instead of sizing them from ``tasks``.
+    address
+        The scheduler of the ``remote`` cluster.
+    upload
+        Modules to upload to the workers of ``remote`` and ``kube`` clusters.
+    kube_options
+        Keyword arguments for ``KubeCluster``. Defaults to ``cluster.yaml``.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    if backend == "remote" and address is None:
+        raise ValueError("The remote backend needs a scheduler address")
+    if workers is None and backend != "remote" and (tasks or backend != "kube"):
+        workers = size(tasks, backend, worker_memory, max_workers)
+    print(f"Running on {backend}" + (f" with {workers} workers" if workers else ""))
+
+    if backend == "serial":
+        with dask.config.set(scheduler="sync"):
+            yield None
+    elif backend in ("threads", "processes"):
+        with dask.config.set(scheduler=backend, num_workers=workers):
+            yield None
+    elif backend == "local":
+        with distributed.LocalCluster(
+            n_workers=workers,
+            threads_per_worker=threads_per_worker,
+            memory_limit=worker_memory,
+        ) as cluster, cluster.get_client() as client:
+            print("Dashboard Link:", client.dashboard_link)
+            yield client
+    elif backend == "remote":
+        with distributed.Client(address) as client:
+            print("Dashboard Link:", client.dashboard_link)
+            _upload(client, upload)
+            yield client
+    else:
+        kube_options = kube_options or {"custom_cluster_spec": "cluster.yaml"}
+        with KubeCluster(**kube_options) as cluster:
+            if workers is not None:
+                cluster.scale(workers)
+            with cluster.get_client() as client:
+                print("Dashboard Link:", client.dashboard_link)
+                _upload(client, upload)
+                yield client
+
+
+def add_arguments(parser: argparse.ArgumentParser, default: str = "kube") -> None:
+    """Add the ``--executor``, ``--workers`` and ``--scheduler-address`` options."""
+    parser.add_argument(
+        "--executor",
+        choices=BACKENDS,
+        default=default,
+        help="Where to run the Dask computations",
+    )
+    # The old spelling of --executor threads
+    parser.add_argument(
+        "--local",
+        dest="executor",
+        action="store_const",
+        const="threads",
+        help=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="The number of workers (by default, sized from the job and machine)",
+    )
+    parser.add_argument(
+        "--scheduler-address",
+        default=None,
+        help="The scheduler of an existing cluster, for --executor remote",
+    )
+
+
+def from_args(args: argparse.Namespace, **kwargs) -> contextlib.AbstractContextManager:
+    """`connect` with the options from `add_arguments`."""
+    return connect(
+        args.executor,
+        workers=args.workers,
+        address=args.scheduler_address,
+        **kwargs,
+    )
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Show the workers a job of TASKS tasks would get"
+    )
+    parser.add_argument("tasks", type=int)
+    parser.add_argument("--executor", choices=BACKENDS, default="local")
+    parser.add_argument("--worker-memory", default=WORKER_MEMORY)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    workers = size(args.tasks, args.executor, args.worker_memory)
+    print(
+        f"{args.executor}: {workers} workers for {args.tasks} tasks "
+        f"({dask.system.CPU_COUNT} cores, "
+        f"{psutil.virtual_memory().available / 2**30:.1f} GiB available)"
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+"""
+Lookup and spatial indexes of the channel_rt reaches.
+
+Selecting reaches by ``feature_id`` through xarray scans the 2.7 million entry
+coordinate, and finding the reaches in an area means loading every reach's
+location. `FeatureIndex` holds the ``feature_id``s sorted, with their positions
+in the arrays, and a grid index over the reach locations (from the NWM
+``RouteLink`` file). It's small enough to load whole, and turns ``feature_id``s
+or a geometry into positions and then into the chunk keys that hold them:
+
+>>> index = FeatureIndex.load("abfs://ciroh/short-range-channel_rt-kerchunk/features.npz")
+>>> positions = index.positions(gauges)
+>>> index.chunk_keys("streamflow", positions)
+['streamflow/0.3', 'streamflow/0.17', ...]
+>>> ds.isel(feature_id=positions)
+
+Build one with ``python features.py REFERENCES OUTPUT --route-link RouteLink.nc``.
+`run_kerchunk.py` writes one next to the channel_rt references.
+"""
+import argparse
+import io
+import os
+import sys
+from typing import Any, Iterable
+
+import fsspec
+import numpy as np
+import shapely
+import xarray as xr
+
+# The size of the grid index's cells, in degrees
+CELL_SIZE = 0.25
+
+
+class FeatureIndex:
+    """
+    Parameters
+    ----------
+    feature_id
+        The ``feature_id`` coordinate, in array order.
+    chunk_size
+        The length of the chunks along ``feature_id``.
+    lon, lat
+        The location of each reach, in array order, for spatial queries.
+    cell_size
+        The size of the grid index's cells, in degrees.
+    """
+
+    def __init__(
+        self,
+        feature_id: np.ndarray,
+        chunk_size: int,
+        lon: np.ndarray | None = None,
+        lat: np.ndarray | None = None,
+        cell_size: float = CELL_SIZE,
+    ):
+        feature_id = np.asarray(feature_id)
+        self.size = len(feature_id)
+        self.chunk_size = int(chunk_size)
+        self.order = np.argsort(feature_id, kind="stable").astype("int32")
+        self.sorted_ids = feature_id[self.order]
+        self.lon = self.lat = None
+        self.cell_size = cell_size
+        if lon is not None and lat is not None:
+            self._build_grid(np.asarray(lon), np.asarray(lat))
+
+    def __repr__(self):
+        spatial = ", spatial" if self.lon is not None else ""
+        return (
+            f"FeatureIndex<{self.size} features, chunk_size={self.chunk_size}{spatial}>"
+        )
+
+    def _cells(self, lon, lat):
+        col = np.floor((lon - self.origin[0]) / self.cell_size).astype("int64")
+        row = np.floor((lat - self.origin[1]) / self.cell_size).astype("int64")
+        return row, col
+
+    def _build_grid(self, lon, lat):
+        # A CSR-style grid: the positions of the reaches in cell i (row-major)
+        # are members[starts[i]:starts[i + 1]].
+        self.lon, self.lat = lon.astype("float32"), lat.astype("float32")
+        valid = np.isfinite(lon) & np.isfinite(lat)
+        self.origin = (
+            np.floor(lon[valid].min() / self.cell_size) * self.cell_size,
+            np.floor(lat[valid].min() / self.cell_size) * self.cell_size,
+        )
+        row, col = self._cells(lon[valid], lat[valid])
+        self.shape = (int(row.max()) + 1, int(col.max()) + 1)
+        cell = row * self.shape[1] + col
+        order = np.argsort(cell, kind="stable")
+        self.members = np.flatnonzero(valid)[order].astype("int32")
+        counts = np.bincount(cell, minlength=self.shape[0] * self.shape[1])
+        self.starts = np.concatenate([[0], np.cumsum(counts)]).astype("int64")
+
+    def positions(self, feature_ids: Iterable[int], missing: str = "raise"):
+        """
+        The array positions of ``feature_ids``, in the same order.
+
+        With ``missing="drop"``, unknown ids are left out instead of raising a
+        ``KeyError``.
+        """
+        ids = np.asarray(feature_ids, dtype=self.sorted_ids.dtype)
+        i = np.searchsorted(self.sorted_ids, ids)
+        i = np.minimum(i, self.size - 1)
+        found = self.sorted_ids[i] == ids
+        if not found.all():
+            if missing == "drop":
+                i = i[found]
+            else:
+                raise KeyError(ids[~found][:10].tolist())
+        return self.order[i]
+
+    def within(self, geometry: Any) -> np.ndarray:
+        """
+        The sorted array positions of the reaches within ``geometry``, a shapely
+        geometry or a ``(minx, miny, maxx, maxy)`` box in longitude and latitude.
+        """
+        if self.lon is None:
+            raise ValueError("This index has no reach locations")
+        if not isinstance(geometry, shapely.Geometry):
+            geometry = shapely.box(*geometry)
+        minx, miny, maxx, maxy = geometry.bounds
+        (r0, r1), (c0, c1) = self._cells(np.array([minx, maxx]), np.array([miny, maxy]))
+        r0, c0 = max(r0, 0), max(c0, 0)
+        r1, c1 = min(r1, self.shape[0] - 1), min(c1, self.shape[1] - 1)
+        if r0 > r1 or c0 > c1:
+            return np.array([], dtype="int32")
+        rows = np.arange(r0, r1 + 1) * self.shape[1]
+        first = self.starts[rows + c0]
+        last = self.starts[rows + c1 + 1]
+        candidates = np.concatenate([self.members[a:b] for a, b in zip(first, last)])
+        lon, lat = self.lon[candidates], self.lat[candidates]
+        if shapely.equals(geometry, shapely.box(*geometry.bounds)):
+            inside = (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+        else:
+            shapely.prepare(geometry)
+            inside = shapely.intersects_xy(geometry, lon, lat)
+        return np.sort(candidates[inside])
+
+    def chunks(self, positions: np.ndarray) -> np.ndarray:
+        """
+        The sorted indices of the chunks along ``feature_id`` holding
+        ``positions``.
+        """
+        return np.unique(np.asarray(positions) // self.chunk_size)
+
+    def chunk_keys(
+        self, variable: str, positions: np.ndarray, time_chunks: Iterable[int] = (0,)
+    ) -> list[str]:
+        """
+        The Zarr keys of the chunks of a ``(time, feature_id)`` ``variable``
+        holding ``positions``, for each of ``time_chunks``.
+        """
+        return [
+            f"{variable}/{t}.{c}" for t in time_chunks for c in self.chunks(positions)
+        ]
+
+    def save(self, path: str, storage_options: dict[str, Any] | None = None) -> None:
+        """Write the index to ``path`` as a ``.npz`` file."""
+        arrays = dict(
+            order=self.order,
+            sorted_ids=self.sorted_ids,
+            chunk_size=self.chunk_size,
+            cell_size=self.cell_size,
+        )
+        if self.lon is not None:
+            arrays.update(
+                lon=self.lon,
+                lat=self.lat,
+                origin=self.origin,
+                shape=self.shape,
+                members=self.members,
+                starts=self.starts,
+            )
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        with fsspec.open(path, "wb", **(storage_options or {})) as f:
+            f.write(buf.getvalue())
+
+    @classmethod
+    def load(
+        cls, path: str, storage_options: dict[str, Any] | None = None
+    ) -> "FeatureIndex":
+        """Read an index written by `save`."""
+        with fsspec.open(path, "rb", **(storage_options or {})) as f:
+            arrays = np.load(io.BytesIO(f.read()))
+        self = cls.__new__(cls)
+        self.order = arrays["order"]
+        self.sorted_ids = arrays["sorted_ids"]
+        self.size = len(self.order)
+        self.chunk_size = int(arrays["chunk_size"])
+        self.cell_size = float(arrays["cell_size"])
+        self.lon = self.lat = None
+        if "lon" in arrays:
+            self.lon, self.lat = arrays["lon"], arrays["lat"]
+            self.origin = tuple(arrays["origin"].tolist())
+            self.shape = tuple(arrays["shape"].tolist())
+            self.members, self.starts = arrays["members"], arrays["starts"]
+        return self
+
+
+def route_link_locations(
+    url: str, feature_id: np.ndarray, storage_options: dict[str, Any] | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The longitude and latitude of each of ``feature_id`` from an NWM
+    ``RouteLink`` file (NaN for reaches missing from it).
+    """
+    with fsspec.open(url, "rb", **(storage_options or {})) as f:
+        rl = xr.open_dataset(f, engine="h5netcdf")[["link", "lon", "lat"]].load()
+    link = rl["link"].values
+    order = np.argsort(link)
+    i = np.minimum(np.searchsorted(link[order], feature_id), len(link) - 1)
+    found = link[order][i] == feature_id
+    lon = np.where(found, rl["lon"].values[order][i], np.nan)
+    lat = np.where(found, rl["lat"].values[order][i], np.nan)
+    return lon, lat
+
+
+def build(
+    ds: xr.Dataset,
+    route_link: str | None = None,
+    variable: str = "streamflow",
+    storage_options: dict[str, Any] | None = None,
+) -> FeatureIndex:
+    """
+    Build the index of a channel_rt Dataset, e.g. from `noaanwm.open_references`,
+    with reach locations from the ``route_link`` file if given.
+    """
+    feature_id = ds["feature_id"].values
+    encoding = ds[variable].encoding
+    chunks = encoding.get("chunks") or encoding.get("preferred_chunks", {})
+    if isinstance(chunks, dict):
+        chunk_size = chunks.get("feature_id", len(feature_id))
+    else:
+        chunk_size = chunks[ds[variable].dims.index("feature_id")]
+    lon = lat = None
+    if route_link is not None:
+        lon, lat = route_link_locations(route_link, feature_id, storage_options)
+    return FeatureIndex(feature_id, chunk_size, lon, lat)
+
+
+def get_storage_options(url):
+    if url.split("://")[0] in ("az", "abfs"):
+        return {
+            "account_name": "noaanwm",
+            "credential": os.environ["AZURE_SAS_TOKEN"],
+        }
+    return {}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Build a channel_rt feature index")
+    parser.add_argument("references", help="The channel_rt reference.json")
+    parser.add_argument("output", help="Where to write the index (.npz)")
+    parser.add_argument("--protocol", default="abfs")
+    parser.add_argument("--account-name", default="noaanwm")
+    parser.add_argument("--route-link", default=None, help="An NWM RouteLink file")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    import noaanwm
+
+    args = parse_args(args)
+    storage_options = {"account_name": args.account_name}
+    ds = noaanwm.open_references(
+        args.references,
+        args.protocol,
+        storage_options,
+        target_options=storage_options,
+    )
+    index = build(ds, args.route_link, storage_options=storage_options)
+    index.save(args.output, get_storage_options(args.output))
+    print(f"Wrote {index} to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""
+A persistent inventory of the National Water Model files.
+
+The inventory is a SQLite table with one row per file, keyed by date, product,
+kind, cycle, forecast hour and domain (``conus``, ``hawaii``, ...), recording the
+size and etag of each file. Queries return the ``conus`` files by default. It's
+refreshed incrementally: only the day prefixes at or after the newest day already
+in the table are listed again.
+
+>>> inv = Inventory("nwm-inventory.sqlite", "abfs", {"account_name": "noaanwm"})
+>>> inv.refresh()
+>>> inv.files(product="short_range", kind="channel_rt", forecast_time=1)
+"""
+import argparse
+import concurrent.futures
+import datetime
+import posixpath
+import sqlite3
+import sys
+from typing import Any
+
+import fsspec
+
+import noaanwm
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    product TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    cycle_runtime INTEGER NOT NULL,
+    forecast_time INTEGER NOT NULL,
+    size INTEGER,
+    etag TEXT,
+    domain TEXT NOT NULL DEFAULT 'conus'
+);
+CREATE INDEX IF NOT EXISTS files_key
+    ON files (product, kind, date, cycle_runtime, forecast_time);
+"""
+
+
+def fingerprint(info: dict[str, Any]) -> str:
+    """
+    A value that changes when the file changes, from an fsspec ``info`` dict.
+
+    Blob storage provides an etag. Other filesystems fall back to the size and
+    modification time.
+    """
+    for key in ["etag", "ETag", "md5", "content_md5"]:
+        if info.get(key):
+            return str(info[key]).strip('"')
+    mtime = info.get("mtime", info.get("last_modified", info.get("created")))
+    return f"{info.get('size')}-{mtime}"
+
+
+def list_prefix(fs: fsspec.AbstractFileSystem, prefix: str) -> list[tuple]:
+    """
+    List the NWM files under a day prefix as inventory rows.
+    """
+    rows = []
+    for path, info in fs.find(prefix, detail=True).items():
+        if not path.endswith(".nc"):
+            continue
+        try:
+            file = noaanwm.parse_url(path)
+        except ValueError:
+            # Not an NWM output file (e.g. usgs_timeslices)
+            continue
+        rows.append(
+            (
+                path,
+                f"{file.date:%Y%m%d}",
+                file.product,
+                file.kind,
+                file.cycle_runtime,
+                file.forecast_time,
+                info.get("size"),
+                fingerprint(info),
+                file.domain,
+            )
+        )
+    return rows
+
+
+class Inventory:
+    def __init__(
+        self,
+        path: str = "nwm-inventory.sqlite",
+        protocol: str = "abfs",
+        storage_options: dict[str, Any] | None = None,
+        root: str = "nwm",
+    ):
+        self.path = path
+        self.protocol = protocol
+        self.storage_options = storage_options or {}
+        self.root = root
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self._add_domain()
+
+    def __repr__(self):
+        return f"Inventory<{self.path}, {self.protocol}://{self.root}>"
+
+    def _add_domain(self) -> None:
+        # Inventories from before the domain column listed every domain as one
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(files)")
+        ]
+        if "domain" in columns:
+            return
+        with self.connection:
+            self.connection.execute(
+                "ALTER TABLE files ADD COLUMN domain TEXT NOT NULL DEFAULT 'conus'"
+            )
+            paths = [
+                row[0] for row in self.connection.execute("SELECT path FROM files")
+            ]
+            self.connection.executemany(
+                "UPDATE files SET domain = ? WHERE path = ?",
+                [(posixpath.basename(p).split(".")[-2], p) for p in paths],
+            )
+
+    @property
+    def fs(self) -> fsspec.AbstractFileSystem:
+        return fsspec.filesystem(self.protocol, **self.storage_options)
+
+    @property
+    def high_water_mark(self) -> str | None:
+        """The newest day (``YYYYMMDD``) in the inventory."""
+        (date,) = self.connection.execute("SELECT max(date) FROM files").fetchone()
+        return date
+
+    def refresh(self, max_workers: int = 32) -> int:
+        """
+        List new files and add them to the inventory.
+
+        Day prefixes at or after the high-water mark are listed. The newest day may
+        have been incomplete the last time it was listed, so it's listed again.
+
+        Returns
+        -------
+        The number of files that are new or changed.
+        """
+        fs = self.fs
+        hwm = self.high_water_mark or ""
+        prefixes = [
+            prefix
+            for prefix in fs.ls(self.root, detail=False)
+            if posixpath.basename(prefix.rstrip("/")).startswith("nwm.")
+            and posixpath.basename(prefix.rstrip("/"))[4:] >= hwm
+        ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            rows = [
+                row
+                for rows in pool.map(lambda p: list_prefix(fs, p), prefixes)
+                for row in rows
+            ]
+
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET size=excluded.size, "
+                "etag=excluded.etag WHERE etag IS NOT excluded.etag",
+                rows,
+            )
+            return self.connection.total_changes - before
+
+    def query(
+        self,
+        product: str | None = None,
+        kind: str | None = None,
+        start: datetime.date | str | None = None,
+        end: datetime.date | str | None = None,
+        cycle_runtime: int | None = None,
+        forecast_time: int | None = None,
+        domain: str | None = "conus",
+    ) -> list[sqlite3.Row]:
+        """
+        Find the files matching some filters. ``start`` and ``end`` are inclusive.
+        Pass ``domain=None`` for the files of every domain.
+        """
+        clauses = []
+        params: list[Any] = []
+        for column, value in [
+            ("product", product),
+            ("kind", kind),
+            ("cycle_runtime", cycle_runtime),
+            ("forecast_time", forecast_time),
+            ("domain", domain),
+        ]:
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if start is not None:
+            clauses.append("date >= ?")
+            params.append(_format_date(start))
+        if end is not None:
+            clauses.append("date <= ?")
+            params.append(_format_date(end))
+
+        sql = "SELECT * FROM files"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY date, cycle_runtime, forecast_time, path"
+        cursor = self.connection.cursor()
+        cursor.row_factory = sqlite3.Row
+        return cursor.execute(sql, params).fetchall()
+
+    def files(self, *args, **kwargs) -> list[str]:
+        """
+        The paths (without a protocol) of the files matching the filters.
+        See `Inventory.query` for the filters.
+        """
+        return [row["path"] for row in self.query(*args, **kwargs)]
+
+    def etags(self, *args, **kwargs) -> dict[str, str]:
+        """
+        The etags of the files matching the filters, keyed by path.
+        """
+        return {row["path"]: row["etag"] for row in self.query(*args, **kwargs)}
+
+
+def _format_date(date: datetime.date | str) -> str:
+    if isinstance(date, str):
+        return date.replace("-", "")
+    return f"{date:%Y%m%d}"
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Refresh the NWM file inventory")
+    parser.add_argument("-o", "--output", default="nwm-inventory.sqlite")
+    parser.add_argument("--protocol", default="abfs")
+    parser.add_argument("--account-name", default="noaanwm")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    storage_options = {}
+    if args.protocol in ("abfs", "az"):
+        storage_options["account_name"] = args.account_name
+    inv = Inventory(args.output, args.protocol, storage_options)
+    print(f"Refreshing from {inv.high_water_mark}")
+    n = inv.refresh()
+    print(f"Found {n} new or changed files")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""
+A durable record of the inputs a pipeline has finished processing.
+
+Each finished input is recorded as a small JSON object holding the input's URL
+and etag (see `inventory.fingerprint`). Records are written by the worker that
+processed the input as soon as it's done, so they survive lost workers and a
+killed driver. On the next run, inputs whose etag matches their record are
+skipped and only new or changed inputs are processed.
+"""
+import hashlib
+import json
+import posixpath
+import time
+from typing import Any, Iterable
+
+import fsspec
+
+
+class Manifest:
+    def __init__(self, url: str, storage_options: dict[str, Any] | None = None):
+        self.url = url.rstrip("/")
+        self.storage_options = storage_options or {}
+
+    def __repr__(self):
+        return f"Manifest<{self.url}>"
+
+    @property
+    def sha256(self) -> bytes:
+        # Lets pangeo-forge-recipes hash recipes holding a Manifest.
+        return hashlib.sha256(self.url.encode()).digest()
+
+    @property
+    def fs(self) -> fsspec.AbstractFileSystem:
+        return fsspec.core.url_to_fs(self.url, **self.storage_options)[0]
+
+    @property
+    def root(self) -> str:
+        return fsspec.core.url_to_fs(self.url, **self.storage_options)[1]
+
+    def _path(self, input_url: str) -> str:
+        name = hashlib.sha256(input_url.encode()).hexdigest()
+        return posixpath.join(self.root, f"{name}.json")
+
+    def record(self, input_url: str, etag: str | None, **info) -> None:
+        """
+        Record that ``input_url`` (at version ``etag``) has been processed.
+        """
+        record = dict(url=input_url, etag=etag, time=time.time(), **info)
+        fs = self.fs
+        path = self._path(input_url)
+        try:
+            fs.pipe_file(path, json.dumps(record).encode())
+        except FileNotFoundError:
+            # Local filesystems need the directory to exist.
+            fs.makedirs(self.root, exist_ok=True)
+            fs.pipe_file(path, json.dumps(record).encode())
+
+    def load(self) -> dict[str, dict]:
+        """
+        All the records, keyed by input URL.
+        """
+        fs = self.fs
+        try:
+            paths = fs.find(self.root)
+        except FileNotFoundError:
+            return {}
+        records = [json.loads(v) for v in fs.cat(paths).values()] if paths else []
+        return {record["url"]: record for record in records}
+
+    def pending(
+        self, input_urls: Iterable[str], etags: dict[str, str | None] | None = None
+    ) -> list[str]:
+        """
+        The inputs that haven't been processed, or that changed since they were.
+
+        Inputs without an etag in ``etags`` are only checked for a record.
+        """
+        etags = etags or {}
+        records = self.load()
+        pending = []
+        for url in input_urls:
+            record = records.get(url)
+            if (
+                record is None
+                or etags.get(url) is not None
+                and record["etag"] != etags[url]
+            ):
+                pending.append(url)
+        return pending
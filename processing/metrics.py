@@ -0,0 +1,306 @@
+"""
+Lightweight instrumentation of the pipelines.
+
+Work is recorded in named stages. Each stage records its wall time, the files it
+processed, the bytes read and written and the requests made through fsspec, and
+the peak resident memory of the process while it ran, sampled by a background
+thread every ``SAMPLE_INTERVAL`` seconds:
+
+>>> with metrics.stage("combine", files=len(indices)):
+...     combined = MultiZarrToZarr(indices, ...).translate()
+
+Functions run as Dask tasks are wrapped with `task`, which records each call
+on the worker that runs it. `gather` collects the records from every worker of
+a distributed cluster, and `write` saves them as JSON and in the Prometheus
+text format:
+
+>>> scan = dask.delayed(metrics.task("scan", scan_file))
+>>> dask.compute(*[scan(f) for f in files])
+>>> metrics.write("metrics/run_kerchunk", metrics.gather(client))
+
+Bytes and requests are counted for the whole process, so they're attributed to
+every stage running at the time, and are approximate when tasks run in threads.
+"""
+import collections
+import contextlib
+import functools
+import itertools
+import json
+import threading
+import time
+from typing import Any, Callable
+
+import fsspec
+import fsspec.mapping
+import fsspec.spec
+import psutil
+
+_lock = threading.Lock()
+_counters = collections.Counter()
+_records: list[dict[str, Any]] = []
+_instrumented = False
+# The peak RSS seen during each running stage, and the thread sampling it
+_peaks: dict[int, int] = {}
+_ids = itertools.count()
+_sampler: threading.Thread | None = None
+
+FIELDS = ["files", "bytes_read", "bytes_written", "requests"]
+SAMPLE_INTERVAL = 0.05
+
+
+def _add(**counts) -> None:
+    with _lock:
+        _counters.update(counts)
+
+
+def _sample() -> None:
+    # Runs while any stage is running, so it never outlives the work it measures.
+    global _sampler
+    process = psutil.Process()
+    while True:
+        rss = process.memory_info().rss
+        with _lock:
+            if not _peaks:
+                _sampler = None
+                return
+            for key, peak in _peaks.items():
+                _peaks[key] = max(peak, rss)
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def _start_peak() -> int:
+    global _sampler
+    rss = psutil.Process().memory_info().rss
+    with _lock:
+        key = next(_ids)
+        _peaks[key] = rss
+        # A forked child inherits _sampler without its thread
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = threading.Thread(target=_sample, daemon=True)
+            _sampler.start()
+    return key
+
+
+def _stop_peak(key: int) -> int:
+    rss = psutil.Process().memory_info().rss
+    with _lock:
+        return max(_peaks.pop(key), rss)
+
+
+def instrument_fsspec() -> None:
+    """
+    Count the requests and bytes going through fsspec file objects and mappers.
+    Calling it again does nothing.
+    """
+    global _instrumented
+    with _lock:
+        if _instrumented:
+            return
+        _instrumented = True
+
+    init = fsspec.spec.AbstractBufferedFile.__init__
+    write = fsspec.spec.AbstractBufferedFile.write
+
+    @functools.wraps(init)
+    def __init__(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        cache = getattr(self, "cache", None)
+        if cache is None or getattr(cache, "fetcher", None) is None:
+            return
+        fetcher = cache.fetcher
+
+        def fetch(start, end):
+            data = fetcher(start, end)
+            _add(requests=1, bytes_read=len(data))
+            return data
+
+        cache.fetcher = fetch
+
+    @functools.wraps(write)
+    def _write(self, data):
+        n = write(self, data)
+        _add(bytes_written=len(data))
+        return n
+
+    getitem = fsspec.mapping.FSMap.__getitem__
+    getitems = fsspec.mapping.FSMap.getitems
+    setitem = fsspec.mapping.FSMap.__setitem__
+    setitems = fsspec.mapping.FSMap.setitems
+
+    @functools.wraps(getitem)
+    def _getitem(self, key, default=None):
+        value = getitem(self, key, default)
+        _add(requests=1, bytes_read=len(value) if isinstance(value, bytes) else 0)
+        return value
+
+    @functools.wraps(getitems)
+    def _getitems(self, keys, on_error="raise"):
+        out = getitems(self, keys, on_error=on_error)
+        values = [v for v in out.values() if isinstance(v, bytes)]
+        _add(requests=len(values), bytes_read=sum(map(len, values)))
+        return out
+
+    @functools.wraps(setitem)
+    def _setitem(self, key, value):
+        setitem(self, key, value)
+        _add(requests=1, bytes_written=len(value))
+
+    @functools.wraps(setitems)
+    def _setitems(self, values_dict):
+        setitems(self, values_dict)
+        _add(
+            requests=len(values_dict),
+            bytes_written=sum(map(len, values_dict.values())),
+        )
+
+    fsspec.spec.AbstractBufferedFile.__init__ = __init__
+    fsspec.spec.AbstractBufferedFile.write = _write
+    fsspec.mapping.FSMap.__getitem__ = _getitem
+    fsspec.mapping.FSMap.getitems = _getitems
+    fsspec.mapping.FSMap.__setitem__ = _setitem
+    fsspec.mapping.FSMap.setitems = _setitems
+
+
+@contextlib.contextmanager
+def stage(name: str, files: int = 0, **info):
+    """
+    Record the work done in the ``with`` block as one call of stage ``name``.
+    Extra keyword arguments are stored with the record.
+    """
+    instrument_fsspec()
+    with _lock:
+        before = dict(_counters)
+    peak = _start_peak()
+    t0 = time.perf_counter()
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        peak_rss = _stop_peak(peak)
+        with _lock:
+            counts = {k: _counters[k] - before.get(k, 0) for k in FIELDS}
+            counts["files"] += files
+            _records.append(
+                dict(
+                    stage=name,
+                    start=start,
+                    seconds=seconds,
+                    peak_rss=peak_rss,
+                    **counts,
+                    **info,
+                )
+            )
+
+
+def task(name: str, func: Callable, files: int = 1) -> Callable:
+    """
+    Wrap ``func`` so that each call is recorded as processing ``files`` files in
+    stage ``name``.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(name, files=files):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def collect(reset: bool = False) -> list[dict[str, Any]]:
+    """The records made in this process."""
+    with _lock:
+        records = list(_records)
+        if reset:
+            _records.clear()
+    return records
+
+
+def gather(client=None, local: bool = True) -> list[dict[str, Any]]:
+    """
+    The records made in this process (unless ``local`` is False) and, with a
+    ``distributed.Client``, on each of its workers. The records gathered are
+    cleared, so gathering again after another run only returns the new ones.
+    """
+    records = collect(reset=True) if local else []
+    if client is not None:
+        for worker, worker_records in client.run(collect, reset=True).items():
+            records.extend(dict(r, worker=worker) for r in worker_records)
+    return records
+
+
+def summarize(records: list[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """Totals per stage."""
+    stages: dict[str, dict[str, Any]] = {}
+    for record in records:
+        summary = stages.setdefault(
+            record["stage"],
+            dict(
+                calls=0,
+                seconds=0.0,
+                max_seconds=0.0,
+                peak_rss=0,
+                **dict.fromkeys(FIELDS, 0),
+            ),
+        )
+        summary["calls"] += 1
+        summary["seconds"] += record["seconds"]
+        summary["max_seconds"] = max(summary["max_seconds"], record["seconds"])
+        summary["peak_rss"] = max(summary["peak_rss"], record["peak_rss"])
+        for field in FIELDS:
+            summary[field] += record[field]
+    return stages
+
+
+PROMETHEUS = [
+    ("calls", "counter", "Calls of the stage (tasks, for Dask stages)"),
+    ("seconds", "counter", "Wall time spent in the stage, summed over calls"),
+    ("max_seconds", "gauge", "Wall time of the stage's slowest call"),
+    ("files", "counter", "Files processed"),
+    ("bytes_read", "counter", "Bytes read through fsspec"),
+    ("bytes_written", "counter", "Bytes written through fsspec"),
+    ("requests", "counter", "Requests made through fsspec"),
+    ("peak_rss", "gauge", "Peak resident memory of a process while running the stage"),
+]
+
+
+def to_prometheus(records: list[dict[str, Any]], prefix: str = "nwm_stage") -> str:
+    """The per-stage totals in the Prometheus text exposition format."""
+    stages = summarize(records)
+    lines = []
+    for field, kind, description in PROMETHEUS:
+        name = f"{prefix}_{field}"
+        if kind == "counter":
+            name += "_total"
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for stage_name, summary in stages.items():
+            lines.append(f'{name}{{stage="{stage_name}"}} {summary[field]}')
+    return "\n".join(lines) + "\n"
+
+
+def write(
+    path: str,
+    records: list[dict[str, Any]],
+    storage_options: dict[str, Any] | None = None,
+) -> None:
+    """
+    Write ``{path}.json`` (the per-stage totals and every record) and
+    ``{path}.prom`` (the totals, for Prometheus' textfile collector).
+    """
+    fs, path = fsspec.core.url_to_fs(path, **(storage_options or {}))
+    fs.makedirs(fs._parent(path), exist_ok=True)
+    document = {"stages": summarize(records), "records": records}
+    fs.pipe_file(f"{path}.json", json.dumps(document, indent=2).encode())
+    fs.pipe_file(f"{path}.prom", to_prometheus(records).encode())
+
+
+def report(records: list[dict[str, Any]]) -> None:
+    """Print the per-stage totals."""
+    for name, s in summarize(records).items():
+        print(
+            f"{name}: {s['calls']} calls, {s['seconds']:.1f}s, {s['files']} files, "
+            f"{s['bytes_read'] / 2**20:.1f} MiB read, "
+            f"{s['bytes_written'] / 2**20:.1f} MiB written, "
+            f"{s['requests']} requests, peak RSS {s['peak_rss'] / 2**20:.0f} MiB"
+        )
@@ -1,21 +1,37 @@
 import os
 import sys
-import pathlib
+import base64
+import concurrent.futures
+import hashlib
+import json
 import argparse
+import re
+import warnings
 from typing import Any
 import typing
 
-from dask_kubernetes.operator import KubeCluster
-import azure.storage.blob
+if typing.TYPE_CHECKING:
+    import cache
+
 import dask.dataframe
 import datetime
+import executor
 import fsspec
 import geopandas
+import h5py
 import kerchunk.combine
+import kerchunk.df
 import kerchunk.hdf
+import metrics
+import numcodecs
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute
+import pyarrow.parquet as pq
 import pyproj
+import scanner
+import shapely
 import tlz
 import xarray as xr
 
@@ -23,6 +39,16 @@ __version__ = "0.1.0"
 
 STORAGE_OPTIONS = dict(account_name="noaanwm")
 CYCLE_RUNTIMES = list(range(23))
+RESERVOIR_VARIABLES = ["reservoir_type", "water_sfc_elev", "inflow", "outflow"]
+# The fields of the GeoParquet bbox covering column
+BBOX_FIELDS = ["xmin", "ymin", "xmax", "ymax"]
+# The dimensions with the same coordinates in every file of each kind
+IDENTICAL_DIMS = {
+    "channel_rt": ["feature_id"],
+    "reservoir": ["feature_id"],
+    "land": ["x", "y"],
+    "forcing": ["x", "y", "crs"],
+}
 
 
 def make_prefix(date, product, cycle_runtime):
@@ -42,25 +68,266 @@ def make_url(date, product, cycle_runtime, kind, forecast_time):
     return ".".join([prefix, kind, f"f{forecast_time:0>3d}", "conus.nc"])
 
 
+class FileInfo(typing.NamedTuple):
+    date: datetime.date
+    product: str
+    cycle_runtime: int
+    kind: str
+    forecast_time: int
+    domain: str = "conus"
+
+    @property
+    def reference_time(self) -> pd.Timestamp:
+        return pd.Timestamp(self.date) + pd.Timedelta(hours=self.cycle_runtime)
+
+    @property
+    def valid_time(self) -> pd.Timestamp:
+        return self.reference_time + pd.Timedelta(hours=self.forecast_time)
+
+    @property
+    def member(self) -> int | None:
+        """The ensemble member of medium and long range files (``channel_rt_1``)."""
+        m = re.fullmatch(r".*_(\d+)", self.kind)
+        return int(m[1]) if m else None
+
+
+def parse_url(url: str) -> FileInfo:
+    """
+    Parse the components out of an NWM file URL. The inverse of `make_url`.
+
+    >>> info = parse_url(
+    ...     "abfs://nwm/nwm.20230123/short_range/"
+    ...     "nwm.t00z.short_range.channel_rt.f001.conus.nc"
+    ... )
+    >>> info.valid_time
+    Timestamp('2023-01-23 01:00:00')
+    """
+    *_, day, _, name = url.split("/")
+    _, cycle, product, kind, forecast, domain, _ = name.split(".")
+    if forecast.startswith("tm"):
+        # analysis_assim files look back from the cycle time
+        forecast_time = -int(forecast[2:])
+    else:
+        forecast_time = int(forecast[1:])
+    return FileInfo(
+        date=datetime.datetime.strptime(day[4:], "%Y%m%d").date(),
+        product=product,
+        cycle_runtime=int(cycle[1:3]),
+        kind=kind,
+        forecast_time=forecast_time,
+        domain=domain,
+    )
+
+
+def product_directory(product: str, kind: str) -> str:
+    """
+    The directory of the ``kind`` files of ``product`` under ``nwm.{date}/``.
+
+    >>> product_directory("medium_range", "channel_rt_1")
+    'medium_range_mem1'
+    """
+    if kind == "forcing":
+        return f"forcing_{product}"
+    m = re.fullmatch(r".*_(\d+)", kind)
+    return f"{product}_mem{m[1]}" if m else product
+
+
 def list_date(
-    protocol: str, storage_options: dict[str, Any], date: datetime.date, product: str
+    protocol: str,
+    storage_options: dict[str, Any],
+    date: datetime.date,
+    product: str,
+    kind: str = "channel_rt",
+    cycle_runtime: int | None = 0,
 ) -> list[str]:
+    """
+    The ``kind`` files of every lead time of the ``cycle_runtime`` cycle of
+    ``product`` on ``date``, or of every cycle if it's None.
+    """
     fs = fsspec.filesystem(protocol, **storage_options)
+    directory = product_directory(product, kind)
+    cycle = "*" if cycle_runtime is None else f"{cycle_runtime:0>2d}"
     paths = fs.glob(
-        f"nwm/nwm.{date:%Y%m%d}/{product}/nwm.t00z.{product}.channel_rt.f*.conus.nc"
+        f"nwm/nwm.{date:%Y%m%d}/{directory}/nwm.t{cycle}z.{product}.{kind}.f*.conus.nc"
     )
-    paths = [f"{fs.protocol}://{p}" for p in paths]
+    protocol = fs.protocol if isinstance(fs.protocol, str) else fs.protocol[0]
+    paths = [f"{protocol}://{p}" for p in paths]
     return paths
 
 
-def list_day(date: datetime.date, kind):
-    cc = azure.storage.blob.ContainerClient(
-        "https://noaanwm.blob.core.windows.net", "nwm"
+def scan(url: str, storage_options: dict[str, Any], templates: bool = True) -> dict:
+    """
+    The references of a single file. With ``templates``, files with the same
+    schema as one already scanned by this process reuse its metadata (see
+    `scanner.TemplateScanner`).
+    """
+    if templates:
+        return scanner.shared().scan(url, storage_options)
+    return kerchunk.hdf.SingleHdf5ToZarr(
+        url, storage_options=storage_options
+    ).translate()
+
+
+def to_cube(references: dict, forecast_time: int) -> dict:
+    """
+    Reshape the references of one forecast file for the forecast cube.
+
+    Variables along ``time`` get ``(reference_time, lead_time)`` dimensions
+    instead and a ``lead_time`` coordinate (in hours) is inlined. The chunks are
+    unchanged. ``time`` itself is dropped: it's ``reference_time + lead_time``.
+    """
+    refs = dict(references.get("refs", references))
+    for key in [k for k in refs if k.startswith("time/")]:
+        del refs[key]
+    for key in [k for k in refs if k.endswith("/.zattrs")]:
+        name = key[: -len("/.zattrs")]
+        attrs = json.loads(refs[key])
+        dims = attrs.get("_ARRAY_DIMENSIONS", [])
+        if "time" not in dims:
+            continue
+        i = dims.index("time")
+        zarray = json.loads(refs.pop(f"{name}/.zarray"))
+        del refs[key]
+        attrs["_ARRAY_DIMENSIONS"] = (
+            ["reference_time", "lead_time"] + dims[:i] + dims[i + 1 :]
+        )
+        for field in ["shape", "chunks"]:
+            zarray[field] = [1, 1] + zarray[field][:i] + zarray[field][i + 1 :]
+
+        chunks = [k for k in refs if k.startswith(f"{name}/")]
+        for chunk in chunks:
+            index = chunk[len(name) + 1 :].split(".")
+            del index[i]
+            refs[".".join([f"{name}/0", "0", *index])] = refs.pop(chunk)
+        refs[f"{name}/.zarray"] = json.dumps(zarray)
+        refs[f"{name}/.zattrs"] = json.dumps(attrs)
+
+    refs["lead_time/.zarray"] = json.dumps(
+        dict(
+            chunks=[1],
+            compressor=None,
+            dtype="<i4",
+            fill_value=None,
+            filters=None,
+            order="C",
+            shape=[1],
+            zarr_format=2,
+        )
     )
-    names = list(cc.list_blob_names(name_starts_with=f"nwm.{date:%Y%m%d}/short_range"))
-    names = [x for x in names if x.endswith(f"{kind}.f001.conus.nc")]
-    urls = [f"https://noaanwm.blob.core.windows.net/nwm/{name}" for name in names]
-    return urls
+    refs["lead_time/.zattrs"] = json.dumps(
+        {"_ARRAY_DIMENSIONS": ["lead_time"], "long_name": "lead time", "units": "hours"}
+    )
+    value = np.array(forecast_time, dtype="<i4").tobytes()
+    refs["lead_time/0"] = "base64:" + base64.b64encode(value).decode()
+    return {"version": 1, "refs": refs}
+
+
+def scan_cube(url: str, storage_options: dict[str, Any]) -> dict:
+    """The forecast cube references of a single file (see `to_cube`)."""
+    return to_cube(scan(url, storage_options), parse_url(url).forecast_time)
+
+
+def _identical_dims(kind: str) -> list[str]:
+    # Ensemble members (channel_rt_1, ...) have the dimensions of their kind.
+    return IDENTICAL_DIMS.get(re.sub(r"_\d+$", "", kind), [])
+
+
+def cycles(files: typing.Iterable[str]) -> dict[pd.Timestamp, list[str]]:
+    """Group ``files`` by their ``reference_time``, sorted by lead time."""
+    groups: dict[pd.Timestamp, list[str]] = {}
+    for f in sorted(files, key=lambda f: parse_url(f).forecast_time):
+        groups.setdefault(parse_url(f).reference_time, []).append(f)
+    return dict(sorted(groups.items()))
+
+
+def build_cycle(
+    files: typing.Sequence[str],
+    protocol: str,
+    storage_options: dict[str, Any],
+    identical_dims: typing.Sequence[str] = (),
+    max_workers: int = 16,
+) -> dict:
+    """
+    The forecast cube references of one cycle, from its files (one per lead
+    time). The files are scanned concurrently in threads.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        indices = list(pool.map(lambda f: scan_cube(f, storage_options), files))
+    return assemble(indices, protocol, storage_options, identical_dims)
+
+
+def assemble(
+    references: typing.Sequence[dict],
+    protocol: str,
+    storage_options: dict[str, Any],
+    identical_dims: typing.Sequence[str] = (),
+) -> dict:
+    """
+    Merge forecast cube references (of files, cycles or whole cubes) along
+    ``reference_time`` and ``lead_time``. Cycles with missing lead times are
+    filled with missing values.
+    """
+    with warnings.catch_warnings():
+        # Every lead time of a cycle has the same reference_time.
+        warnings.filterwarnings("ignore", "Concatenated coordinate 'reference_time'")
+        return kerchunk.combine.MultiZarrToZarr(
+            list(references),
+            remote_protocol=protocol,
+            remote_options=storage_options,
+            concat_dims=["reference_time", "lead_time"],
+            identical_dims=list(identical_dims),
+        ).translate()
+
+
+def combine_tree(
+    references: dict[pd.Timestamp, Any],
+    protocol: str,
+    storage_options: dict[str, Any],
+    identical_dims: typing.Sequence[str] = (),
+    levels: typing.Sequence[str] = ("D", "M"),
+):
+    """
+    Merge the (delayed) forecast cube references of each cycle, keyed by
+    ``reference_time``, in a tree: by day, then by month (the pandas period
+    ``levels``), then all together. Returns the delayed result.
+
+    Each merge is a task over one group, so no task holds more than a group's
+    references and none of them reach the client until the end. The result is
+    the same as `assemble` over every cycle.
+    """
+    merge = dask.delayed(metrics.task("combine", assemble), pure=True)
+    parts = dict(references)
+    for freq in levels:
+        groups: dict[pd.Timestamp, list] = {}
+        for t, part in sorted(parts.items()):
+            groups.setdefault(pd.Timestamp(t).to_period(freq).start_time, []).append(
+                part
+            )
+        parts = {
+            t: group[0]
+            if len(group) == 1
+            else merge(group, protocol, storage_options, identical_dims)
+            for t, group in groups.items()
+        }
+    return merge(list(parts.values()), protocol, storage_options, identical_dims)
+
+
+def open_cube(
+    url: str | dict,
+    protocol: str,
+    storage_options: dict[str, Any],
+    **kwargs,
+) -> xr.Dataset:
+    """
+    Open forecast cube references from `generate_cube`, with the 2-D ``valid_time``
+    (``reference_time + lead_time``) coordinate.
+
+    >>> cube = open_cube(references, "abfs", {"account_name": "noaanwm"})
+    >>> # How the 18-hour forecast for a time evolved across cycles
+    >>> cube.streamflow.where(cube.valid_time == target).sel(feature_id=gauge)
+    """
+    ds = open_references(url, protocol, storage_options, **kwargs)
+    return ds.assign_coords(valid_time=ds.reference_time + ds.lead_time)
 
 
 def generate(
@@ -68,39 +335,350 @@ def generate(
     storage_options: dict[str, Any],
     dates: datetime.date | typing.Sequence[datetime.date],
     product: str,
+    parquet_url: str | None = None,
+    parquet_options: dict[str, Any] | None = None,
 ) -> dict:
+    """
+    Generate combined references for ``product`` on ``dates``.
+
+    If ``parquet_url`` is given, the references are also written there as a
+    Parquet reference store (see `write_parquet_references`). For every cycle
+    and lead time, see `generate_cube`.
+    """
     if isinstance(dates, datetime.date):
         dates = [dates]
 
     list_dates_ = dask.delayed(list_date)
-    single = dask.delayed(kerchunk.hdf.SingleHdf5ToZarr)
+    scan_ = dask.delayed(metrics.task("scan", scan))
 
     print("listing files")
-    files = list(
-        tlz.concat(
-            dask.compute(
-                *[
-                    list_dates_(protocol, storage_options, date, product)
-                    for date in dates
-                ]
+    with metrics.stage("list"):
+        files = list(
+            tlz.concat(
+                dask.compute(
+                    *[
+                        list_dates_(protocol, storage_options, date, product)
+                        for date in dates
+                    ]
+                )
             )
         )
-    )
 
     print("generating indices")
-    indices = dask.compute(
-        *[single(f, storage_options=storage_options).translate() for f in files]
-    )
+    with metrics.stage("generate", files=len(files)):
+        indices = dask.compute(*[scan_(f, storage_options) for f in files])
 
     print("merging indices")
-    d = kerchunk.combine.MultiZarrToZarr(
-        indices,
+    with metrics.stage("combine"):
+        d = kerchunk.combine.MultiZarrToZarr(
+            indices,
+            remote_protocol=protocol,
+            concat_dims=["time", "reference_time"],
+            remote_options=storage_options,
+        ).translate()
+
+    if parquet_url is not None:
+        print("writing parquet references")
+        with metrics.stage("write_parquet_references"):
+            write_parquet_references(d, parquet_url, storage_options=parquet_options)
+
+    return d
+
+
+def generate_cube(
+    protocol: str,
+    storage_options: dict[str, Any],
+    dates: datetime.date | typing.Sequence[datetime.date],
+    product: str,
+    parquet_url: str | None = None,
+    parquet_options: dict[str, Any] | None = None,
+    kind: str = "channel_rt",
+    identical_dims: typing.Sequence[str] | None = None,
+) -> dict:
+    """
+    Generate forecast cube references for the ``kind`` files of ``product``
+    (``short_range``, ``medium_range``, ``long_range``, ...) on ``dates``.
+
+    The cube has ``reference_time`` and ``lead_time`` dimensions, with every cycle
+    and lead time of the files (see `open_cube`). Each
+    cycle's files are scanned and combined by one task, and the cycles are then
+    merged by day and by month on the workers (see `build_cycle` and
+    `combine_tree`), so only the final references come back.
+
+    If ``parquet_url`` is given, the references are also written there as a
+    Parquet reference store (see `write_parquet_references`).
+    """
+    if isinstance(dates, datetime.date):
+        dates = [dates]
+    if identical_dims is None:
+        identical_dims = _identical_dims(kind)
+
+    list_dates_ = dask.delayed(list_date)
+
+    print("listing files")
+    with metrics.stage("list"):
+        files = list(
+            tlz.concat(
+                dask.compute(
+                    *[
+                        list_dates_(
+                            protocol, storage_options, date, product, kind, None
+                        )
+                        for date in dates
+                    ]
+                )
+            )
+        )
+
+    print("generating indices")
+    indices = {
+        t: dask.delayed(metrics.task("cycle", build_cycle, len(group)))(
+            group, protocol, storage_options, identical_dims
+        )
+        for t, group in cycles(files).items()
+    }
+    with metrics.stage("generate", files=len(files)):
+        (d,) = dask.compute(
+            combine_tree(indices, protocol, storage_options, identical_dims)
+        )
+
+    if parquet_url is not None:
+        print("writing parquet references")
+        with metrics.stage("write_parquet_references"):
+            write_parquet_references(d, parquet_url, storage_options=parquet_options)
+
+    return d
+
+
+def write_parquet_references(
+    references: dict,
+    url: str,
+    storage_options: dict[str, Any] | None = None,
+    record_size: int = 10_000,
+) -> None:
+    """
+    Write combined references as a partitioned Parquet reference store.
+
+    Each variable gets its own directory of Parquet files holding ``record_size``
+    chunk references each. Chunk keys are laid out in C order, so with ``time`` as
+    the leading dimension each file covers a contiguous range of times. Readers
+    (see `open_references`) load only the metadata up front and then fetch just
+    the partitions covering the chunks they access.
+    """
+    kerchunk.df.refs_to_dataframe(
+        references, url, storage_options=storage_options, record_size=record_size
+    )
+
+
+def open_references(
+    url: str | dict,
+    protocol: str,
+    storage_options: dict[str, Any],
+    target_options: dict[str, Any] | None = None,
+    coalesce: bool = False,
+    cache: "cache.ChunkCache | None" = None,
+    **kwargs,
+) -> xr.Dataset:
+    """
+    Open a JSON or Parquet reference store as an xarray Dataset.
+
+    With ``coalesce=True``, the chunks of each read are fetched through a
+    `ranges.CoalescingStore`, merging nearby byte ranges of the same file into
+    one request. This needs JSON references. The Dataset isn't chunked by default
+    so that a selection reads all its chunks at once; pass large ``chunks`` to
+    use Dask.
+
+    With a `cache.ChunkCache`, chunks are read through the local cache.
+
+    >>> channel_rt = open_references(
+    ...     "abfs://ciroh/short-range-channel_rt-kerchunk/reference.parquet",
+    ...     "abfs",
+    ...     {"account_name": "noaanwm"},
+    ...     target_options={"account_name": "noaanwm"},
+    ... )
+    """
+    if isinstance(url, str):
+        namespace = url
+    else:
+        namespace = hashlib.sha256(json.dumps(url, sort_keys=True).encode()).hexdigest()
+
+    if coalesce:
+        import ranges
+
+        if isinstance(url, str):
+            if url.endswith(".parquet"):
+                raise ValueError("coalesce=True needs JSON references")
+            url = read_references(url, target_options)
+        store = ranges.CoalescingStore(url, protocol, storage_options)
+    else:
+        fs = fsspec.filesystem(
+            "reference",
+            fo=url,
+            remote_protocol=protocol,
+            remote_options=storage_options,
+            target_options=target_options,
+            skip_instance_cache=True,
+        )
+        store = fs.get_mapper()
+        kwargs.setdefault("chunks", {})
+
+    if cache is not None:
+        store = _cached(store, cache, namespace)
+    return xr.open_dataset(store, engine="zarr", consolidated=False, **kwargs)
+
+
+def open_zarr(
+    url: str,
+    storage_options: dict[str, Any] | None = None,
+    cache: "cache.ChunkCache | None" = None,
+    **kwargs,
+) -> xr.Dataset:
+    """
+    Open a Zarr store, e.g. ``az://ciroh/zarr/ts/...``, optionally reading
+    through a `cache.ChunkCache`.
+    """
+    store = fsspec.get_mapper(url, **(storage_options or {}))
+    if cache is not None:
+        store = _cached(store, cache, url)
+    kwargs.setdefault("chunks", {})
+    return xr.open_dataset(store, engine="zarr", **kwargs)
+
+
+def _cached(store, cache, namespace):
+    import cache as cache_
+
+    return cache_.CachingStore(store, cache, namespace)
+
+
+def read_references(url: str, storage_options: dict[str, Any] | None = None) -> dict:
+    with fsspec.open(url, "rt", **(storage_options or {})) as f:
+        return json.load(f)
+
+
+def indexed_times(
+    references: dict, protocol: str, storage_options: dict[str, Any]
+) -> pd.DatetimeIndex:
+    """
+    The ``time`` coordinate of a set of combined references.
+
+    The coordinates are inlined in the references by ``MultiZarrToZarr``, so this
+    doesn't make any requests to the remote files.
+    """
+    ds = xr.open_dataset(
+        "reference://",
+        engine="zarr",
+        backend_kwargs=dict(
+            consolidated=False,
+            storage_options=dict(
+                fo=references,
+                remote_protocol=protocol,
+                remote_options=storage_options,
+            ),
+        ),
+        chunks={},
+    )
+    return ds.indexes["time"]
+
+
+def append_references(
+    references: dict,
+    files: typing.Sequence[str],
+    protocol: str,
+    storage_options: dict[str, Any],
+    concat_dims: typing.Sequence[str] = ("time", "reference_time"),
+    identical_dims: typing.Sequence[str] | None = None,
+) -> dict:
+    """
+    Merge the files newer than the last indexed ``time`` onto ``references``.
+
+    Only the new files are scanned. ``MultiZarrToZarr`` reads the existing time
+    axis from ``references``, so the coordinate arrays are rewritten to cover the
+    old and new files.
+    """
+    last = indexed_times(references, protocol, storage_options).max()
+    files = [f for f in files if parse_url(f).valid_time > last]
+    if not files:
+        return references
+
+    scan_ = dask.delayed(metrics.task("scan", scan))
+    indices = dask.compute(*[scan_(f, storage_options) for f in files])
+    # Combine the new files first so that they have the same structure (e.g. the
+    # new concat dimensions) as the existing references.
+    kwargs = dict(
         remote_protocol=protocol,
-        concat_dims=["time", "reference_time"],
+        concat_dims=list(concat_dims),
+        identical_dims=list(identical_dims or []),
         remote_options=storage_options,
-    ).translate()
+    )
+    with metrics.stage("combine"):
+        new = kerchunk.combine.MultiZarrToZarr(indices, **kwargs).translate()
+        return kerchunk.combine.MultiZarrToZarr([references, new], **kwargs).translate()
 
-    return d
+
+def append(
+    references: dict,
+    protocol: str,
+    storage_options: dict[str, Any],
+    product: str,
+    until: datetime.date | None = None,
+) -> dict:
+    """
+    Incrementally update the references from `generate` with newer files.
+
+    Only the days from the last indexed ``time`` through ``until`` (today, by
+    default) are listed and only files newer than the last ``time`` are scanned.
+    """
+    last = indexed_times(references, protocol, storage_options).max()
+    until = until or datetime.datetime.utcnow().date()
+    dates = pd.date_range(last.normalize(), pd.Timestamp(until), freq="D")
+    files = list(
+        tlz.concat(
+            list_date(protocol, storage_options, date, product) for date in dates
+        )
+    )
+    return append_references(references, files, protocol, storage_options)
+
+
+def append_cube(
+    references: dict,
+    protocol: str,
+    storage_options: dict[str, Any],
+    product: str,
+    until: datetime.date | None = None,
+    kind: str = "channel_rt",
+    identical_dims: typing.Sequence[str] | None = None,
+) -> dict:
+    """
+    Incrementally update the forecast cube from `generate_cube` with newer cycles.
+
+    Only the days from the last indexed ``reference_time`` through ``until``
+    (today, by default) are listed, and only the newer cycles and the last indexed
+    one are scanned.
+    """
+    ds = open_references(references, protocol, storage_options)
+    last = ds.indexes["reference_time"].max()
+    until = until or datetime.datetime.utcnow().date()
+    if identical_dims is None:
+        identical_dims = _identical_dims(kind)
+    dates = pd.date_range(last.normalize(), pd.Timestamp(until), freq="D")
+    files = tlz.concat(
+        list_date(protocol, storage_options, date, product, kind, None)
+        for date in dates
+    )
+    # The last cycle is scanned again, in case it was incomplete.
+    groups = [group for t, group in cycles(files).items() if t >= last]
+    if not groups:
+        return references
+    new = dask.compute(
+        *[
+            dask.delayed(metrics.task("cycle", build_cycle, len(group)))(
+                group, protocol, storage_options, identical_dims
+            )
+            for group in groups
+        ]
+    )
+    with metrics.stage("combine"):
+        return assemble([references, *new], protocol, storage_options, identical_dims)
 
 
 def to_dataframe(ds):
@@ -140,45 +718,544 @@ def process_day(url):
 
 
 def process_month(urls):
-    dfs = [process_day(url) for url in urls]
-    df = pd.concat(dfs).set_index("time")
+    with metrics.stage("process_month", files=len(urls)):
+        dfs = [process_day(url) for url in urls]
+        df = pd.concat(dfs).set_index("time")
+    return df
+
+
+def geo_metadata(geometry_types=("Point",), covering=False) -> dict[bytes, bytes]:
+    """
+    The GeoParquet metadata for a table with a WKB ``geometry`` column in EPSG:4326.
+
+    With ``covering=True``, the table also has a ``bbox`` column (see
+    `bbox_column`), declared as a GeoParquet 1.1 bounding box covering.
+    """
+    column = {
+        "encoding": "WKB",
+        "geometry_types": list(geometry_types),
+        "crs": pyproj.CRS.from_epsg(4326).to_json_dict(),
+    }
+    if covering:
+        column["covering"] = {"bbox": {field: ["bbox", field] for field in BBOX_FIELDS}}
+    geo = {
+        "version": "1.1.0" if covering else "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": column},
+    }
+    return {b"geo": json.dumps(geo).encode()}
+
+
+def bbox_column(geometry: geopandas.GeoSeries) -> pa.StructArray:
+    """The ``bbox`` covering column of ``geometry``."""
+    bounds = geometry.bounds.to_numpy()
+    return pa.StructArray.from_arrays(
+        [pa.array(bounds[:, i]) for i in range(4)], names=BBOX_FIELDS
+    )
+
+
+def bbox_filter(geometry) -> pyarrow.compute.Expression:
+    """
+    A Parquet filter on the ``bbox`` column for the rows that may intersect
+    ``geometry``, a shapely geometry or a ``(minx, miny, maxx, maxy)`` box in
+    longitude and latitude. Readers skip the row groups whose ``bbox``
+    statistics fall outside it.
+
+    >>> pq.read_table(path, filters=bbox_filter((-105.2, 39.9, -104.6, 40.3)))
+    """
+    if isinstance(geometry, shapely.Geometry):
+        geometry = geometry.bounds
+    minx, miny, maxx, maxy = geometry
+    field = pyarrow.compute.field
+    return (
+        (field("bbox", "xmin") <= maxx)
+        & (field("bbox", "xmax") >= minx)
+        & (field("bbox", "ymin") <= maxy)
+        & (field("bbox", "ymax") >= miny)
+    )
+
+
+def read_within(path, geometry, storage_options=None, **kwargs):
+    """
+    The rows of a reservoir GeoParquet file written with ``layout="space"``
+    within ``geometry`` (see `bbox_filter`), as a GeoDataFrame. Only the row
+    groups that may intersect ``geometry`` are read. Additional keyword
+    arguments (``columns``, ``filters``, ...) are passed to
+    ``geopandas.read_parquet``.
+    """
+    filters = bbox_filter(geometry)
+    if "filters" in kwargs:
+        filters = filters & kwargs.pop("filters")
+    df = geopandas.read_parquet(
+        path, storage_options=storage_options, filters=filters, **kwargs
+    )
+    if isinstance(geometry, shapely.Geometry):
+        df = df[df.intersects(geometry)]
     return df
 
 
+def read_reservoir(url, storage_options=None, normalized=False) -> pa.Table:
+    """
+    Read a single reservoir file as an Arrow Table.
+
+    Only the reservoir variables and the coordinates are read. The columns match
+    `to_dataframe`, with ``time`` as a column and WKB-encoded geometries.
+
+    With ``normalized=True``, only the time-varying columns (``time``,
+    ``feature_id``, ``water_sfc_elev``, ``inflow`` and ``outflow``) are read, as
+    compact dtypes. The static columns are in `read_reservoir_dimension`.
+    """
+    variables = ["water_sfc_elev", "inflow", "outflow", "time"]
+    if not normalized:
+        variables += ["reservoir_type", "latitude", "longitude"]
+
+    with fsspec.open(url, **(storage_options or {})) as f:
+        ds = xr.open_dataset(f, engine="h5netcdf")[variables].load()
+
+    n = ds.sizes["feature_id"]
+    flow_dtype = "float32" if normalized else "float64"
+    columns = {
+        "time": pa.array(np.repeat(ds.time.data, n)),
+        "feature_id": pa.array(ds.feature_id.data.astype("int32")),
+    }
+    if not normalized:
+        geometry = geopandas.GeoSeries.from_xy(ds.longitude.data, ds.latitude.data)
+        columns["geometry"] = pa.array(geometry.to_wkb().values, type=pa.binary())
+        columns["reservoir_type"] = pa.array(
+            pd.Categorical(ds.reservoir_type.data, categories=[1, 2])
+        )
+    columns["water_sfc_elev"] = pa.array(ds.water_sfc_elev.data.astype("float32"))
+    columns["inflow"] = pa.array(ds.inflow.data.astype(flow_dtype))
+    columns["outflow"] = pa.array(ds.outflow.data.astype(flow_dtype))
+    return pa.table(columns)
+
+
+def read_reservoir_dimension(url, storage_options=None) -> pa.Table:
+    """
+    Read the static attributes of the reservoirs in a file: one row per
+    ``feature_id`` with its geometry and ``reservoir_type``.
+    """
+    with fsspec.open(url, **(storage_options or {})) as f:
+        ds = xr.open_dataset(f, engine="h5netcdf")
+        ds = ds[["reservoir_type", "latitude", "longitude"]].load()
+
+    geometry = geopandas.GeoSeries.from_xy(ds.longitude.data, ds.latitude.data)
+    return pa.table(
+        {
+            "feature_id": pa.array(ds.feature_id.data.astype("int32")),
+            "geometry": pa.array(geometry.to_wkb().values, type=pa.binary()),
+            "reservoir_type": pa.array(ds.reservoir_type.data.astype("int8")),
+        }
+    )
+
+
+def write_reservoir(
+    urls,
+    path,
+    storage_options=None,
+    target_options=None,
+    compression="zstd",
+    normalized=False,
+    layout="time",
+    row_group_size=131_072,
+    bloom_filter=False,
+) -> str:
+    """
+    Stream reservoir files to a single GeoParquet file.
+
+    Each input file is read, converted, and appended as one row group, so peak
+    memory is about one file's worth of data regardless of ``len(urls)``.
+    With ``normalized=True`` the file holds just the time-varying columns (see
+    `read_reservoir`) and is plain Parquet.
+
+    With ``layout="space"``, the rows are sorted along a Hilbert curve of the
+    reservoir locations (then by ``feature_id`` and ``time``) and written in
+    row groups of ``row_group_size`` rows, with a ``bbox`` covering column (see
+    `bbox_column`). Each row group then covers a small area, so readers can skip
+    the row groups outside a region (see `read_within`). This needs the
+    geometry, so it can't be ``normalized``, and holds all of ``urls`` in memory.
+
+    With ``layout="feature"`` the rows are instead sorted by ``feature_id`` and
+    then ``time`` and written in row groups of ``row_group_size`` rows, along with
+    a page index (and optionally a Bloom filter) on ``feature_id``. Each row group
+    then covers a narrow range of ``feature_id``, so a lookup for a single
+    reservoir can skip most of the file. This holds all of ``urls`` in memory.
+    """
+    if layout not in ("time", "feature", "space"):
+        raise ValueError(f"Unknown layout {layout}")
+    if layout == "space" and normalized:
+        raise ValueError("The space layout needs the geometry, so not normalized")
+
+    if layout == "space":
+        table = pa.concat_tables([read_reservoir(url, storage_options) for url in urls])
+        points = geopandas.GeoSeries.from_wkb(np.asarray(table["geometry"]))
+        table = table.append_column(
+            "hilbert", pa.array(points.hilbert_distance())
+        ).append_column("bbox", bbox_column(points))
+        table = table.sort_by(
+            [
+                ("hilbert", "ascending"),
+                ("feature_id", "ascending"),
+                ("time", "ascending"),
+            ]
+        ).drop_columns(["hilbert"])
+        table = table.replace_schema_metadata(geo_metadata(covering=True))
+        with fsspec.open(path, "wb", **(target_options or {})) as f:
+            pq.write_table(
+                table,
+                f,
+                compression=compression,
+                row_group_size=row_group_size,
+                write_page_index=True,
+            )
+        return path
+
+    if layout == "feature":
+        table = pa.concat_tables(
+            [read_reservoir(url, storage_options, normalized) for url in urls]
+        )
+        table = table.sort_by([("feature_id", "ascending"), ("time", "ascending")])
+        if not normalized:
+            table = table.replace_schema_metadata(geo_metadata())
+        kwargs = {}
+        if bloom_filter:
+            n = len(pa.compute.unique(table["feature_id"]))
+            kwargs["bloom_filter_options"] = {"feature_id": {"ndv": n}}
+        with fsspec.open(path, "wb", **(target_options or {})) as f:
+            pq.write_table(
+                table,
+                f,
+                compression=compression,
+                row_group_size=row_group_size,
+                write_page_index=True,
+                sorting_columns=[
+                    pq.SortingColumn(table.schema.get_field_index("feature_id")),
+                    pq.SortingColumn(table.schema.get_field_index("time")),
+                ],
+                **kwargs,
+            )
+        return path
+
+    tables = (read_reservoir(url, storage_options, normalized) for url in urls)
+    first = next(tables, None)
+    if first is None:
+        raise ValueError("No reservoir files to write")
+    schema = first.schema
+    if not normalized:
+        schema = schema.with_metadata(geo_metadata())
+    fs, fs_path = fsspec.core.url_to_fs(path, **(target_options or {}))
+    try:
+        with fs.open(fs_path, "wb") as f, pq.ParquetWriter(
+            f, schema, compression=compression
+        ) as writer:
+            for table in tlz.concat([[first], tables]):
+                writer.write_table(table.cast(schema), row_group_size=len(table))
+    except BaseException:
+        # Don't leave a partial file behind for readers of the dataset
+        if fs.exists(fs_path):
+            fs.rm(fs_path)
+        raise
+    return path
+
+
+def write_reservoir_dimension(
+    urls, path, storage_options=None, target_options=None
+) -> str:
+    """
+    Write the ``reservoirs`` GeoParquet file, with one row per ``feature_id``.
+
+    ``urls`` should include a file from each period where the set of reservoirs
+    may have changed (e.g. the first file of every month). The most recent
+    attributes for each ``feature_id`` are kept.
+    """
+    tables = [read_reservoir_dimension(url, storage_options) for url in urls]
+    df = (
+        pa.concat_tables(tables)
+        .to_pandas()
+        .drop_duplicates("feature_id", keep="last")
+        .sort_values("feature_id")
+    )
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, **geo_metadata()})
+    with fsspec.open(path, "wb", **(target_options or {})) as f:
+        pq.write_table(table, f, compression="zstd")
+    return path
+
+
+def _join_reservoirs(df, reservoirs):
+    df = df.merge(reservoirs, on="feature_id", how="left")
+    return geopandas.GeoDataFrame(df, geometry="geometry", crs=reservoirs.crs)
+
+
+def read_reservoirs(prefix, storage_options=None, **kwargs):
+    """
+    Read the normalized reservoir dataset written by ``noaanwm.py --normalized``.
+
+    The ``reservoirs`` table is small and read eagerly. The time series are read
+    lazily with Dask and joined to the reservoirs one partition at a time.
+    Additional keyword arguments (``columns``, ``filters``, ...) are passed to
+    ``dask.dataframe.read_parquet`` for the time series.
+
+    >>> df = read_reservoirs(
+    ...     "abfs://ciroh/short-range-reservoir-normalized",
+    ...     storage_options={"account_name": "noaanwm"},
+    ... )
+    >>> df.groupby("feature_id").inflow.agg(["min", "max", "mean"])
+    """
+    storage_options = storage_options or {}
+    reservoirs = geopandas.read_parquet(
+        f"{prefix}/reservoirs.parquet", storage_options=storage_options
+    )
+    facts = dask.dataframe.read_parquet(
+        f"{prefix}/facts", storage_options=storage_options, **kwargs
+    )
+    return facts.map_partitions(_join_reservoirs, reservoirs)
+
+
+def point_urls(
+    start, end, product="short_range", kind="channel_rt", forecast_time=1
+) -> list[str]:
+    """The URLs of the ``forecast_time`` files valid each hour from start to end."""
+    lead = pd.Timedelta(hours=forecast_time)
+    return [
+        make_url(t - lead, product, (t - lead).hour, kind, forecast_time)
+        for t in pd.date_range(start, end, freq="h")
+    ]
+
+
+def _codecs(dset) -> list:
+    """The codecs decoding the chunks of the HDF5 dataset ``dset``, in order."""
+    plist = dset.id.get_create_plist()
+    codecs = []
+    for i in range(plist.get_nfilters()):
+        code = plist.get_filter(i)[0]
+        if code == h5py.h5z.FILTER_DEFLATE:
+            codecs.append(numcodecs.Zlib())
+        elif code == h5py.h5z.FILTER_SHUFFLE:
+            codecs.append(numcodecs.Shuffle(dset.dtype.itemsize))
+        elif code != h5py.h5z.FILTER_FLETCHER32:
+            raise ValueError(f"Unsupported HDF5 filter {code} on {dset.name}")
+    return codecs[::-1]
+
+
+def _read_points(url, positions, variables, storage_options):
+    """
+    The values of ``variables`` at the sorted ``positions`` along ``feature_id``
+    in one file, decoded. h5py only reads the chunk locations. The
+    chunks holding ``positions`` are then fetched concurrently with
+    ``cat_ranges``, outside h5py's global lock.
+    """
+    fs, path = fsspec.core.url_to_fs(url, **storage_options)
+    try:
+        f = fs.open(path, block_size=2**16, cache_type="readahead")
+    except FileNotFoundError:
+        return None
+    plans = {}
+    with f, h5py.File(f, "r") as h5:
+        for name in variables:
+            dset = h5[name]
+            size = dset.chunks[0] if dset.chunks else dset.shape[0]
+            chunks = scanner._chunks(dset)
+            keys = np.unique(positions // size)
+            index = [(int(k),) for k in keys]
+            attrs = {
+                k: np.asarray(dset.attrs[k]).item()
+                for k in ["scale_factor", "add_offset", "_FillValue"]
+                if k in dset.attrs
+            }
+            trim = 4 if dset.fletcher32 else 0
+            ranges = [(chunks[k][0], chunks[k][0] + chunks[k][1] - trim) for k in index]
+            plans[name] = (size, keys, ranges, _codecs(dset), dset.dtype, attrs)
+
+    starts = [start for plan in plans.values() for start, _ in plan[2]]
+    ends = [end for plan in plans.values() for _, end in plan[2]]
+    blobs = iter(fs.cat_ranges([path] * len(starts), starts, ends))
+    time = parse_url(url).valid_time.to_datetime64()
+    out = {"time": np.full(len(positions), time)}
+    for name, (size, keys, _, codecs, dtype, attrs) in plans.items():
+        values = np.empty(len(positions), dtype=dtype)
+        for key in keys:
+            buf = next(blobs)
+            for codec in codecs:
+                buf = codec.decode(buf)
+            chunk = np.frombuffer(buf, dtype=dtype)
+            i0, i1 = np.searchsorted(positions, [key * size, (key + 1) * size])
+            values[i0:i1] = chunk[positions[i0:i1] - key * size]
+        raw = xr.Variable(("feature_id",), values, attrs=attrs)
+        out[name] = xr.conventions.decode_cf_variable(name, raw).values
+    return out
+
+
+def extract_points(
+    feature_ids,
+    start,
+    end,
+    kind="channel_rt",
+    variables=None,
+    product="short_range",
+    forecast_time=1,
+    storage_options=None,
+    max_workers=16,
+) -> pd.DataFrame:
+    """
+    The values of ``variables`` (by default, every variable along
+    ``feature_id``) at ``feature_ids`` in the ``kind`` files (``channel_rt`` or
+    ``reservoir``) valid each hour from ``start`` to ``end``, as a DataFrame
+    with ``time`` and ``feature_id`` columns.
+
+    The files come from `make_url`, and are read in a thread pool. The positions
+    of ``feature_ids`` are looked up once, in the first file, and only the
+    chunks holding them are read from each file, so memory use is about the
+    size of the result. Hours without a file are left out.
+
+    >>> df = extract_points([101, 179], "2023-01-01T01", "2023-01-08T00")
+    >>> df.pivot(index="time", columns="feature_id", values="streamflow")
+    """
+    import features
+
+    storage_options = storage_options or {}
+    urls = point_urls(start, end, product, kind, forecast_time)
+    ids = np.asarray(feature_ids)
+    for i, url in enumerate(urls):
+        try:
+            f = fsspec.open(url, "rb", **storage_options).open()
+        except FileNotFoundError:
+            continue
+        with f, xr.open_dataset(f, engine="h5netcdf") as ds:
+            index = features.FeatureIndex(ds["feature_id"].values, chunk_size=1)
+            variables = variables or [
+                name for name, v in ds.data_vars.items() if v.dims == ("feature_id",)
+            ]
+        urls = urls[i:]
+        break
+    else:
+        raise FileNotFoundError(f"No {kind} files from {start} to {end}")
+
+    # Read in the files' order, then put the rows back in the order asked for.
+    positions = index.positions(ids)
+    order = np.argsort(positions)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        parts = list(
+            pool.map(
+                lambda url: _read_points(
+                    url, positions[order], variables, storage_options
+                ),
+                urls,
+            )
+        )
+    parts = [p for p in parts if p is not None]
+    if len(parts) < len(urls):
+        print(f"Skipped {len(urls) - len(parts)} missing files")
+    ranks = np.argsort(order)
+    columns = {
+        "time": np.concatenate([p["time"] for p in parts]),
+        "feature_id": np.tile(ids, len(parts)),
+    }
+    for name in variables:
+        columns[name] = np.concatenate([p[name][ranks] for p in parts])
+    return pd.DataFrame(columns)
+
+
 def parse_args(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--prefix", default="ciroh/short-range-reservoir.parquet")
+    parser.add_argument(
+        "--inventory",
+        default="nwm-inventory.sqlite",
+        help="Path to the file inventory, which is refreshed before processing",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream each month to a GeoParquet file with one row group per hour",
+    )
+    parser.add_argument(
+        "--normalized",
+        action="store_true",
+        help=(
+            "Write a 'reservoirs' table with the static attributes and a compact "
+            "'facts' table with the time series. Implies --streaming."
+        ),
+    )
+    parser.add_argument(
+        "--layout",
+        choices=["time", "feature", "space"],
+        default="time",
+        help=(
+            "Sort rows within each partition by time, by feature_id and then "
+            "time for fast single-reservoir lookups, or along a Hilbert curve of "
+            "the locations, with bbox columns, for regional queries. 'feature' and "
+            "'space' imply --streaming."
+        ),
+    )
+    parser.add_argument("--row-group-size", type=int, default=131_072)
+    parser.add_argument(
+        "--bloom-filter",
+        action="store_true",
+        help="Write a Bloom filter on feature_id (with --layout=feature)",
+    )
+    parser.add_argument(
+        "--metrics",
+        default="metrics/noaanwm",
+        help="Write per-stage metrics to {metrics}.json and {metrics}.prom",
+    )
+    executor.add_arguments(parser)
 
-    return parser.parse_args()
+    subparsers = parser.add_subparsers(dest="command")
+    extract = subparsers.add_parser(
+        "extract", help="Write the values at some reaches or reservoirs to a file"
+    )
+    extract.add_argument("feature_ids", help="A text file with one feature_id a line")
+    extract.add_argument("start", help="The first valid time, e.g. 2023-01-01T01")
+    extract.add_argument("end", help="The last valid time")
+    extract.add_argument("output", help="A Parquet or CSV file")
+    extract.add_argument(
+        "--kind", choices=["channel_rt", "reservoir"], default="channel_rt"
+    )
+    extract.add_argument("--variables", nargs="+", default=None)
+    extract.add_argument("--product", default="short_range")
+    extract.add_argument("--max-workers", type=int, default=16)
+
+    return parser.parse_args(args)
 
 
 def main(args=None):
     args = parse_args(args)
+    if args.command == "extract":
+        ids = np.loadtxt(args.feature_ids, dtype="int64", ndmin=1)
+        df = extract_points(
+            ids,
+            args.start,
+            args.end,
+            args.kind,
+            args.variables,
+            args.product,
+            max_workers=args.max_workers,
+        )
+        if args.output.endswith(".csv"):
+            df.to_csv(args.output, index=False)
+        else:
+            df.to_parquet(args.output, index=False)
+        print(f"Wrote {len(df)} rows to {args.output}")
+        return
+
     prefix = args.prefix
 
     credential = os.environ["AZURE_SAS_TOKEN"]
 
-    p = pathlib.Path("urls.txt")
-    if not p.exists():
-        print("Listing files")
+    import inventory
 
-        cc = azure.storage.blob.ContainerClient(
-            "https://noaanwm.blob.core.windows.net", "nwm"
-        )
-        roots = [x.name for x in cc.walk_blobs("nwm")]
-        dates = [pd.Timestamp(root[4:-1]) for root in roots]
-        with dask.distributed.Client() as client:
-            print("Dashboard Link", client.dashboard_link)
-            urls = dask.compute(
-                *[dask.delayed(list_day)(date, "reservoir") for date in dates]
-            )
-        with open("urls.txt", "w") as f:
-            f.write("\n".join(tlz.concat(list(urls))))
+    inv = inventory.Inventory(args.inventory, "abfs", STORAGE_OPTIONS)
+    print("Refreshing inventory")
+    inv.refresh()
 
     def month_key(x):
-        return x.split("/")[4].split(".")[1][:6]
+        return f"{parse_url(x).date:%Y%m}"
 
-    urls = sorted(open("urls.txt").read().split())
+    urls = [
+        f"https://noaanwm.blob.core.windows.net/{path}"
+        for path in inv.files(product="short_range", kind="reservoir", forecast_time=1)
+    ]
     by_month = list(tlz.partitionby(month_key, urls))
 
     months = []
@@ -191,41 +1268,90 @@ def main(args=None):
         "credential": credential,
     }
 
-    schema = geopandas.GeoDataFrame(
-        {
-            "feature_id": np.array([], dtype="int32"),
-            "geometry": geopandas.array.GeometryArray(np.array([]), crs="epsg:4326"),
-            "reservoir_type": pd.Categorical([], categories=[1, 2]),
-            "water_sfc_elev": np.array([], dtype="float32"),
-            "inflow": np.array([], dtype="float64"),
-            "outflow": np.array([], dtype="float64"),
-        },
-        index=pd.DatetimeIndex([], dtype="datetime64[ns]", name="time", freq=None),
-    )
+    if args.streaming or args.normalized or args.layout != "time":
+        # Memory use is bounded by a single file (or month, with the "feature"
+        # and "space" layouts), so run many threads per worker.
+        nthreads = 8 if args.layout == "time" else 2
+        root = f"abfs://{prefix}/facts" if args.normalized else f"abfs://{prefix}"
+        jobs = [
+            dask.delayed(metrics.task("write_reservoir", write_reservoir, len(chunk)))(
+                chunk,
+                f"{root}/part.{i}.parquet",
+                target_options=storage_options,
+                normalized=args.normalized,
+                layout=args.layout,
+                row_group_size=args.row_group_size,
+                bloom_filter=args.bloom_filter,
+            )
+            for i, chunk in enumerate(by_month)
+        ]
+        if args.normalized:
+            jobs.append(
+                dask.delayed(write_reservoir_dimension)(
+                    [chunk[0] for chunk in by_month],
+                    f"abfs://{prefix}/reservoirs.parquet",
+                    target_options=storage_options,
+                )
+            )
+    else:
+        nthreads = 1
+        schema = geopandas.GeoDataFrame(
+            {
+                "feature_id": np.array([], dtype="int32"),
+                "geometry": geopandas.array.GeometryArray(
+                    np.array([]), crs="epsg:4326"
+                ),
+                "reservoir_type": pd.Categorical([], categories=[1, 2]),
+                "water_sfc_elev": np.array([], dtype="float32"),
+                "inflow": np.array([], dtype="float64"),
+                "outflow": np.array([], dtype="float64"),
+            },
+            index=pd.DatetimeIndex([], dtype="datetime64[ns]", name="time", freq=None),
+        )
 
-    last = months[-1] + pd.tseries.offsets.MonthEnd() + pd.tseries.offsets.Hour(n=24)
-    divisions = tuple([month + pd.tseries.offsets.Hour() for month in months]) + (last,)
+        last = (
+            months[-1] + pd.tseries.offsets.MonthEnd() + pd.tseries.offsets.Hour(n=24)
+        )
+        divisions = tuple([month + pd.tseries.offsets.Hour() for month in months]) + (
+            last,
+        )
 
-    df = dask.dataframe.from_map(
-        process_month, by_month, meta=schema, divisions=divisions
-    )
+        df = dask.dataframe.from_map(
+            process_month, by_month, meta=schema, divisions=divisions
+        )
+        jobs = [
+            df.to_parquet(
+                f"abfs://{prefix}",
+                write_metadata_file=True,
+                storage_options=storage_options,
+                compute=False,
+            )
+        ]
 
-    with KubeCluster(
+    kube_options = dict(
         image="mcr.microsoft.com/planetary-computer/python:2023.3.19.0",
         resources={
             "requests": {"memory": "7Gi", "cpu": "0.9"},
             "limit": {"memory": "8Gi", "cpu": "1"},
         },
-        worker_command="dask-worker --nthreads 1 --nworkers 1 --memory-limit 8GB",
-    ) as cluster:
-        cluster.scale(8)
-        with cluster.get_client() as client:
-            print("Dashboard Link:", client.dashboard_link)
-            df.to_parquet(
-                f"abfs://{prefix}",
-                write_metadata_file=True,
-                storage_options=storage_options,
-            )
+        worker_command=(
+            f"dask-worker --nthreads {nthreads} --nworkers 1 --memory-limit 8GB"
+        ),
+    )
+    with executor.from_args(
+        args,
+        tasks=len(by_month),
+        threads_per_worker=nthreads,
+        max_workers=8,
+        upload=["metrics.py"],
+        kube_options=kube_options,
+    ) as client:
+        with metrics.stage("compute", files=len(urls)):
+            dask.compute(*jobs)
+        records = metrics.gather(client)
+
+    metrics.report(records)
+    metrics.write(args.metrics, records)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+"""
+Coalesced, concurrent reads of the chunks in a kerchunk reference set.
+
+Reading a selection through the reference filesystem makes one range request
+per chunk. The chunks of a variable in one NetCDF file are usually stored next
+to each other, so `plan` groups the chunks a selection needs by file and merges
+ranges separated by at most ``max_gap`` bytes into a single request. `fetch`
+makes those requests concurrently (at most ``max_concurrency`` at a time) and
+returns each chunk as a ``memoryview`` into the request's buffer.
+
+`CoalescingStore` wraps this in a read-only Zarr store. Zarr asks the store for
+all the chunks of a variable that a selection (or a Dask task) touches at once,
+so open it without Dask, or with Dask chunks spanning many Zarr chunks.
+
+>>> store = CoalescingStore(references, "abfs", {"account_name": "noaanwm"})
+>>> ds = xr.open_dataset(store, engine="zarr", consolidated=False)
+>>> ds.isel(time=0)[["streamflow", "velocity"]].load()
+>>> store.stats
+Stats(requests=2, chunks=2, bytes=..., bytes_used=..., seconds=...)
+"""
+import asyncio
+import base64
+import dataclasses
+import re
+import time
+from typing import Any, Iterable, NamedTuple
+
+import fsspec
+import fsspec.asyn
+import zarr.storage
+
+
+class Read(NamedTuple):
+    key: str
+    url: str
+    offset: int
+    size: int
+
+
+class Range(NamedTuple):
+    """A single request, covering the byte range ``[start, end)`` of ``url``."""
+
+    url: str
+    start: int
+    end: int
+    reads: list[Read]
+
+
+@dataclasses.dataclass
+class Stats:
+    """Counters for the reads made through `fetch`."""
+
+    requests: int = 0
+    chunks: int = 0
+    bytes: int = 0
+    bytes_used: int = 0
+    seconds: float = 0.0
+
+    def reset(self) -> None:
+        self.requests = self.chunks = self.bytes = self.bytes_used = 0
+        self.seconds = 0.0
+
+
+def _render(url: str, templates: dict[str, str]) -> str:
+    return re.sub(r"{{\s*(\w+)\s*}}", lambda m: templates[m.group(1)], url)
+
+
+def normalize(references: dict) -> dict[str, Any]:
+    """
+    The flat ``key: value`` references of a (version 0 or 1) kerchunk reference
+    set, with any URL templates filled in.
+    """
+    if "refs" not in references:
+        return references
+    templates = references.get("templates", {})
+    refs = {}
+    for key, value in references["refs"].items():
+        if isinstance(value, list) and templates:
+            value = [_render(value[0], templates), *value[1:]]
+        refs[key] = value
+    return refs
+
+
+def _inline(value: str | bytes) -> bytes:
+    if isinstance(value, str):
+        if value.startswith("base64:"):
+            return base64.b64decode(value[7:])
+        return value.encode()
+    return value
+
+
+def plan(
+    refs: dict[str, Any],
+    keys: Iterable[str],
+    max_gap: int = 64 * 2**10,
+    max_size: int = 64 * 2**20,
+) -> tuple[list[Range], dict[str, bytes]]:
+    """
+    Plan the requests to read ``keys``.
+
+    Parameters
+    ----------
+    refs
+        Flat references, as returned by `normalize`.
+    keys
+        The keys to read. Keys missing from ``refs`` are skipped.
+    max_gap
+        Ranges in the same file separated by at most this many bytes are read in
+        one request.
+    max_size
+        The largest merged request, in bytes. A single chunk larger than this is
+        still read in one request.
+
+    Returns
+    -------
+    ranges, inline
+        The requests to make, and the values of the keys stored inline in the
+        references.
+    """
+    by_url: dict[str, list[Read]] = {}
+    whole: list[Range] = []
+    inline = {}
+    for key in keys:
+        value = refs.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, list):
+            inline[key] = _inline(value)
+        elif len(value) == 1:
+            # A reference to a whole file. The size isn't known, so it's never
+            # merged with anything else.
+            whole.append(Range(value[0], 0, -1, [Read(key, value[0], 0, -1)]))
+        else:
+            url, offset, size = value
+            by_url.setdefault(url, []).append(Read(key, url, offset, size))
+
+    ranges = []
+    for url, reads in by_url.items():
+        reads.sort(key=lambda r: r.offset)
+        current = [reads[0]]
+        start, end = reads[0].offset, reads[0].offset + reads[0].size
+        for read in reads[1:]:
+            new_end = max(end, read.offset + read.size)
+            if read.offset - end <= max_gap and new_end - start <= max_size:
+                current.append(read)
+                end = new_end
+            else:
+                ranges.append(Range(url, start, end, current))
+                current = [read]
+                start, end = read.offset, read.offset + read.size
+        ranges.append(Range(url, start, end, current))
+    return ranges + whole, inline
+
+
+async def _fetch_range(fs, range_: Range, semaphore: asyncio.Semaphore) -> bytes:
+    start, end = (None, None) if range_.end < 0 else (range_.start, range_.end)
+    async with semaphore:
+        if fs.async_impl:
+            return await fs._cat_file(range_.url, start=start, end=end)
+        return await asyncio.to_thread(fs.cat_file, range_.url, start=start, end=end)
+
+
+async def _fetch(fs, ranges: list[Range], max_concurrency: int) -> list[bytes]:
+    semaphore = asyncio.Semaphore(max_concurrency)
+    return await asyncio.gather(*[_fetch_range(fs, r, semaphore) for r in ranges])
+
+
+def fetch(
+    fs: fsspec.AbstractFileSystem,
+    ranges: list[Range],
+    max_concurrency: int = 32,
+    stats: Stats | None = None,
+) -> dict[str, memoryview]:
+    """
+    Make the requests planned by `plan` and slice out each chunk.
+
+    The returned values are views into the buffers of the requests, not copies.
+    """
+    t0 = time.perf_counter()
+    loop = fs.loop if fs.async_impl else fsspec.asyn.get_loop()
+    buffers = fsspec.asyn.sync(loop, _fetch, fs, ranges, max_concurrency)
+
+    out = {}
+    for range_, buffer in zip(ranges, buffers):
+        view = memoryview(buffer)
+        for read in range_.reads:
+            if read.size < 0:
+                out[read.key] = view
+            else:
+                i = read.offset - range_.start
+                out[read.key] = view[i : i + read.size]
+
+    if stats is not None:
+        stats.requests += len(ranges)
+        stats.chunks += len(out)
+        stats.bytes += sum(len(b) for b in buffers)
+        stats.bytes_used += sum(len(v) for v in out.values())
+        stats.seconds += time.perf_counter() - t0
+    return out
+
+
+class CoalescingStore(zarr.storage.Store):
+    """
+    A read-only Zarr store over a kerchunk reference set that coalesces the
+    reads of each batch of chunks.
+
+    Parameters
+    ----------
+    references
+        The references, e.g. from `noaanwm.generate` or `noaanwm.read_references`.
+    protocol, storage_options
+        The filesystem holding the referenced files.
+    max_gap, max_size
+        See `plan`.
+    max_concurrency
+        The most requests in flight at once.
+    """
+
+    def __init__(
+        self,
+        references: dict,
+        protocol: str,
+        storage_options: dict[str, Any] | None = None,
+        max_gap: int = 64 * 2**10,
+        max_size: int = 64 * 2**20,
+        max_concurrency: int = 32,
+    ):
+        self.refs = normalize(references)
+        self.fs = fsspec.filesystem(protocol, **(storage_options or {}))
+        self.max_gap = max_gap
+        self.max_size = max_size
+        self.max_concurrency = max_concurrency
+        self.stats = Stats()
+
+    def __repr__(self):
+        return f"CoalescingStore<{len(self.refs)} references, {self.fs.protocol}>"
+
+    def getitems(self, keys, *, contexts=None):
+        ranges, out = plan(self.refs, keys, self.max_gap, self.max_size)
+        if ranges:
+            out.update(fetch(self.fs, ranges, self.max_concurrency, self.stats))
+        return out
+
+    def __getitem__(self, key):
+        value = self.getitems([key]).get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.refs
+
+    def __iter__(self):
+        return iter(self.refs)
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __setitem__(self, key, value):
+        raise PermissionError("CoalescingStore is read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("CoalescingStore is read-only")
@@ -1,81 +1,474 @@
-import numpy as np
+"""
+Rechunk a Zarr store, e.g. from one chunk per hour to long time-series chunks.
+
+    python rechunk_nwm.py rechunk \\
+        az://ciroh/zarr/ts/short-range-forcing-test.zarr \\
+        az://ciroh/zarr/ts/short-range-forcing-rechunked-test.zarr \\
+        --target-chunks '{"time": 168, "y": 240, "x": 288}' \\
+        --max-mem 2GB --temp az://ciroh/zarr/tmp/short-range-forcing.zarr
+
+The copy is split into independent tasks that each hold at most ``--max-mem`` of
+data. When the source and target chunks are too different to copy directly
+within that budget, the copy goes through an intermediate store. Finished tasks
+are recorded next to their output, so an interrupted run picks up where it
+stopped.
+
+With ``--shards``, the target is a Zarr v3 store whose chunks are packed into
+shards (see `sharding.py`), e.g. 32 chunks per object with
+``--shards '{"time": 168, "y": 960, "x": 2304}'``. Each task writes whole
+shards, so a shard (about 1.5GB of float32 here) must fit in ``--max-mem``.
+"""
+import argparse
+import dataclasses
+import itertools
+import json
+import math
 import os
-import zarr
 import sys
-import argparse
-import xarray as xr
-import fsspec
-import dask.distributed
-from dask_kubernetes.operator import KubeCluster
+
+import dask
 import dask.array as da
+import dask.utils
+import fsspec
+import xarray as xr
+import zarr
 
+import executor
+import metrics
+from encoding import COMPRESSORS, Profile, parse_profiles, variable_encoding
+from sharding import ShardedArray, write_group
 
-def parse_args(args=None):
-    parser = argparse.ArgumentParser()
 
-    return parser.parse_args(args)
+def _nbytes(shape, itemsize):
+    return math.prod(shape) * itemsize
 
 
-def store_chunk(x, *, target, block_info):
-    d = block_info[0]
-    slices = tuple(slice(*loc) for loc in d["array-location"])
-    target[slices] = x
-    # Rely on the broadcast trick to not blow up memory?
-    output = np.broadcast_to(np.array(1, x.dtype), x.shape)
-    return output
+def _divisors(n):
+    return [i for i in range(1, n + 1) if n % i == 0]
 
 
-def to_zarr(x, store, path, **kwargs):
-    target = zarr.open_array(store, path=path, **kwargs)
-    return da.map_blocks(store_chunk, x, target=target, meta=x._meta)
+def plan(shape, source_chunks, target_chunks, itemsize, max_mem):
+    """
+    Plan a copy from ``source_chunks`` to ``target_chunks``.
 
+    Each stage copies blocks that are aligned to the chunks it reads and writes,
+    so no chunk is written by more than one task.
 
-def main(args=None):
-    credential = os.environ["AZURE_SAS_TOKEN"]
-    storage_options = {"account_name": "noaanwm", "credential": credential}
-
-    ds = xr.open_dataset(
-        "az://ciroh/zarr/ts/short-range-forcing-test.zarr",
-        engine="zarr",
-        storage_options=storage_options,
-        chunks={},
+    Returns
+    -------
+    stages : list of (chunks, block) tuples
+        The chunks of the array each stage writes, and the shape of the block each
+        of its tasks copies. There's one stage when a block aligned to both source
+        and target chunks fits in ``max_mem``, and otherwise two stages through an
+        intermediate array.
+    """
+    source_chunks = tuple(min(c, n) for c, n in zip(source_chunks, shape))
+    target_chunks = tuple(min(c, n) for c, n in zip(target_chunks, shape))
+
+    def block(a, b):
+        return tuple(min(math.lcm(x, y), n) for x, y, n in zip(a, b, shape))
+
+    direct = block(source_chunks, target_chunks)
+    if _nbytes(direct, itemsize) <= max_mem:
+        return [(target_chunks, direct)]
+
+    if _nbytes(target_chunks, itemsize) > max_mem:
+        raise ValueError(
+            f"A single target chunk {target_chunks} doesn't fit in max_mem={max_mem}"
+        )
+
+    # The intermediate chunks evenly divide the target chunks, so the second
+    # stage copies exactly one target chunk per task. Start at the smallest
+    # intermediate chunks and grow them while the first stage's blocks fit.
+    gcd = tuple(math.gcd(s, t) for s, t in zip(source_chunks, target_chunks))
+    intermediate = list(gcd)
+    if _nbytes(block(source_chunks, intermediate), itemsize) > max_mem:
+        raise ValueError(
+            f"A single source chunk {source_chunks} doesn't fit in max_mem={max_mem}"
+        )
+
+    # Grow the dimensions the source is chunked finely along first.
+    order = sorted(range(len(shape)), key=lambda i: source_chunks[i] / target_chunks[i])
+    for i in order:
+        candidates = [d for d in _divisors(target_chunks[i]) if d % gcd[i] == 0]
+        for candidate in candidates:
+            trial = list(intermediate)
+            trial[i] = max(candidate, intermediate[i])
+            if _nbytes(block(source_chunks, trial), itemsize) > max_mem:
+                break
+            intermediate = trial
+
+    intermediate = tuple(intermediate)
+    return [
+        (intermediate, block(source_chunks, intermediate)),
+        (target_chunks, block(intermediate, target_chunks)),
+    ]
+
+
+def iter_blocks(shape, block):
+    """
+    Yield the index and slices of each block covering an array.
+    """
+    ranges = [range(math.ceil(n / b)) for n, b in zip(shape, block)]
+    for index in itertools.product(*ranges):
+        slices = tuple(
+            slice(i * b, min((i + 1) * b, n)) for i, b, n in zip(index, block, shape)
+        )
+        yield index, slices
+
+
+class Progress:
+    """
+    The finished blocks of a copy, stored as empty marker objects.
+
+    The markers are written to ``{root}/{name}`` after each block is copied, so
+    they survive a lost worker or a killed driver.
+    """
+
+    def __init__(self, root, name, storage_options=None):
+        self.url = f"{root}/{name}"
+        self.storage_options = storage_options or {}
+
+    @property
+    def mapper(self):
+        return fsspec.get_mapper(self.url, **self.storage_options)
+
+    def done(self) -> set[str]:
+        return set(self.mapper)
+
+    def mark(self, index):
+        self.mapper[".".join(map(str, index))] = b""
+
+
+def copy_block(source, target, slices, index, progress, mark=True):
+    with metrics.stage("copy_block", array=target.path):
+        target[slices] = source[slices]
+    if mark:
+        progress.mark(index)
+
+
+def copy_stage(source, target, block, progress):
+    """
+    Build the tasks copying ``source`` to ``target`` one block at a time,
+    skipping blocks that were finished by a previous run.
+
+    Blocks cut short by the end of the array, or holding only part of a
+    target chunk (e.g. of a shard longer than the array so far), aren't marked
+    as finished, so they're copied again if the source has grown since.
+    """
+    done = progress.done()
+    task = dask.delayed(copy_block, pure=False)
+    return [
+        task(
+            source,
+            target,
+            slices,
+            index,
+            progress,
+            mark=all(
+                s.stop - s.start == b and b % c == 0
+                for s, b, c in zip(slices, block, target.chunks)
+            ),
+        )
+        for index, slices in iter_blocks(source.shape, block)
+        if ".".join(map(str, index)) not in done
+    ]
+
+
+def rechunk_array(
+    source, target, max_mem, temp_store=None, progress_root=None, storage_options=None
+):
+    """
+    Copy the zarr Array ``source`` to the already created ``target``.
+
+    Returns a list of lists of tasks, one per stage. Each stage must finish
+    before the next starts.
+    """
+    name = source.basename
+    stages = plan(source.shape, source.chunks, target.chunks, source.itemsize, max_mem)
+    if len(stages) == 2 and temp_store is None:
+        raise ValueError(
+            f"Rechunking {name} needs an intermediate store within max_mem={max_mem}"
+        )
+
+    jobs = []
+    inputs = source
+    for i, (chunks, block) in enumerate(stages):
+        if i == len(stages) - 1:
+            output = target
+        else:
+            output = zarr.open_array(
+                temp_store,
+                path=name,
+                mode="a",
+                shape=source.shape,
+                chunks=chunks,
+                dtype=source.dtype,
+                compressor=source.compressor,
+                filters=source.filters,
+                fill_value=source.fill_value,
+            )
+            if output.shape != source.shape:
+                # Left by a run before the source grew
+                output.resize(*source.shape)
+        progress = Progress(progress_root, f"{name}/{i}", storage_options)
+        jobs.append(copy_stage(inputs, output, block, progress))
+        inputs = output
+    return jobs
+
+
+def make_template(ds, target_chunks, profiles=None):
+    """
+    A Dataset with the metadata of ``ds`` and lazy, empty data with
+    ``target_chunks`` for the variables to be rechunked.
+
+    With ``profiles`` (see `encoding.parse_profiles`), the rechunked variables
+    get their profile's compressor and filters. The data is copied as stored,
+    so the source's packing is kept either way.
+
+    Writing the template with ``compute=False`` creates the target arrays and
+    writes the index coordinates and any small variables.
+    """
+    template = ds.copy()
+    names = []
+    for name, v in ds.variables.items():
+        if name in ds.indexes:
+            continue
+        if not set(v.dims) & set(target_chunks):
+            template[name] = v.load()
+            continue
+        # Chunks longer than the array are kept, so the target can grow into them.
+        chunks = tuple(target_chunks.get(d, n) or 1 for d, n in v.sizes.items())
+        encoding = {
+            k: x
+            for k, x in v.encoding.items()
+            if k not in {"chunks", "preferred_chunks"}
+        }
+        encoding["chunks"] = chunks
+        if profiles is not None:
+            profile = profiles.get(name, profiles.get("*", Profile()))
+            codecs = variable_encoding(v, dataclasses.replace(profile, pack=True))
+            encoding.update(compressor=codecs["compressor"], filters=codecs["filters"])
+        template[name] = xr.Variable(
+            v.dims,
+            da.empty(v.shape, chunks=chunks, dtype=v.dtype),
+            attrs=v.attrs,
+            encoding=encoding,
+        )
+        names.append(name)
+    return template, names
+
+
+def make_sharded_target(ds, source_group, store, target_chunks, shards, profiles=None):
+    """
+    Create a Zarr v3 group in ``store`` like the Zarr v2 ``source_group``, where
+    the arrays with a dimension in ``shards`` pack chunks of ``target_chunks``
+    (by default, the source's chunks) into shards.
+
+    The other arrays are copied right away, and the sharded ones are returned
+    for copying. Sharded arrays from a previous run are resized to the source's
+    shape, keeping the chunks and shards they were created with, so the target
+    grows along with the source.
+    """
+    write_group(store, source_group.attrs.asdict())
+    arrays = {}
+    for name, source in source_group.arrays():
+        compressor = "source"
+        if profiles is not None:
+            profile = profiles.get(name, profiles.get("*", Profile()))
+            if profile.keepbits is not None:
+                raise ValueError(f"Sharded arrays can't be bit rounded ({name})")
+            compressor = COMPRESSORS[profile.compressor]
+        dims = ds.variables[name].dims
+        if name in ds.indexes or not set(dims) & set(shards):
+            small = ShardedArray.like(source, store, source.shape, None, compressor)
+            small[...] = source[...]
+            continue
+        if f"{name}/zarr.json" in store:
+            arrays[name] = ShardedArray.open(store, name).resize(source.shape)
+            continue
+        chunks = tuple(target_chunks.get(d, c) for d, c in zip(dims, source.chunks))
+        arrays[name] = ShardedArray.like(
+            source,
+            store,
+            chunks,
+            tuple(shards.get(d, c) for d, c in zip(dims, chunks)),
+            compressor,
+        )
+    return arrays
+
+
+def grow_target(source_group, target_group, names):
+    """
+    Resize the arrays of ``target_group`` that the source has outgrown since a
+    previous run, and copy the new values of the ones not being rechunked (the
+    ``names``), like the index coordinates.
+    """
+    grown = False
+    for name, source in source_group.arrays():
+        target = target_group[name]
+        if target.shape == source.shape:
+            continue
+        target.resize(*source.shape)
+        if name not in names:
+            target[...] = source[...]
+        grown = True
+    if grown:
+        zarr.consolidate_metadata(target_group.store)
+
+
+def rechunk(
+    source,
+    target,
+    target_chunks,
+    max_mem,
+    temp=None,
+    storage_options=None,
+    profiles=None,
+    shards=None,
+):
+    """
+    Build the tasks to rechunk the Zarr store at ``source`` to ``target``, a
+    sharded Zarr v3 store if ``shards`` are given.
+
+    The target's metadata is written immediately. When resuming, an existing
+    target is grown to the source's shape instead (see `grow_target`). The
+    returned stages of tasks do the copy.
+    """
+    storage_options = storage_options or {}
+    source_store = fsspec.get_mapper(source, **storage_options)
+    target_store = fsspec.get_mapper(target, **storage_options)
+    temp_store = fsspec.get_mapper(temp, **storage_options) if temp else None
+
+    ds = xr.open_dataset(source_store, engine="zarr", chunks={})
+    source_group = zarr.open_group(source_store, mode="r")
+    if shards:
+        targets = make_sharded_target(
+            ds, source_group, target_store, target_chunks, shards, profiles
+        )
+    else:
+        template, names = make_template(ds, target_chunks, profiles)
+        if ".zgroup" not in target_store:
+            template.to_zarr(target_store, mode="w", consolidated=True, compute=False)
+        target_group = zarr.open_group(target_store, mode="r+")
+        grow_target(source_group, target_group, names)
+        targets = {name: target_group[name] for name in names}
+
+    stages = [[], []]
+    for name, target_array in targets.items():
+        jobs = rechunk_array(
+            source_group[name],
+            target_array,
+            max_mem,
+            temp_store=temp_store,
+            progress_root=f"{target}/.rechunk",
+            storage_options=storage_options,
+        )
+        # Single-stage copies run along with the last stage of the others.
+        for i, tasks in enumerate(jobs[::-1]):
+            stages[-1 - i].extend(tasks)
+    return [tasks for tasks in stages if tasks]
+
+
+def get_storage_options(url):
+    if url.split("://")[0] in ("az", "abfs"):
+        return {
+            "account_name": "noaanwm",
+            "credential": os.environ["AZURE_SAS_TOKEN"],
+        }
+    return {}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rechunk = subparsers.add_parser("rechunk", help="Rechunk a Zarr store")
+    rechunk.add_argument("source")
+    rechunk.add_argument("target")
+    rechunk.add_argument(
+        "--target-chunks",
+        type=json.loads,
+        default={"time": 168, "y": 240, "x": 288},
+        help="JSON mapping of dimension name to chunk size",
+    )
+    rechunk.add_argument(
+        "--max-mem",
+        type=dask.utils.parse_bytes,
+        default="2GB",
+        help="The most data a single task holds in memory",
     )
-    target_chunks = {"time": 168, "y": 240, "x": 288}
-    store = fsspec.get_mapper(
-        "az://ciroh/zarr/ts/short-range-forcing-rechunked-test.zarr", **storage_options
+    rechunk.add_argument(
+        "--temp", default=None, help="Intermediate store for two-stage copies"
     )
+    rechunk.add_argument(
+        "--encoding",
+        type=json.loads,
+        default=None,
+        help=(
+            "JSON mapping of variable name (or '*') to encoding.Profile fields. "
+            "By default the source's codecs are kept."
+        ),
+    )
+    rechunk.add_argument(
+        "--shards",
+        type=json.loads,
+        default=None,
+        help=(
+            "JSON mapping of dimension name to shard size, a multiple of the "
+            "chunk size, to write a sharded Zarr v3 store"
+        ),
+    )
+    rechunk.add_argument(
+        "--metrics",
+        default="metrics/rechunk_nwm",
+        help="Write per-stage metrics to {metrics}.json and {metrics}.prom",
+    )
+    executor.add_arguments(rechunk)
+
+    return parser.parse_args(args)
 
-    with dask.config.set(
-        {"array.rechunk.method": "p2p", "optimization.fuse.active": False}
-    ):
-        ds2 = ds.chunk(target_chunks)
 
-    for k, v in ds2.data_vars.items():
-        v.encoding["chunks"] = tuple(target_chunks.values())
-        v.encoding["preferred_chunks"] = target_chunks
+def main(args=None):
+    args = parse_args(args)
+    storage_options = get_storage_options(args.target)
 
-    # write the metadata
-    ds2.to_zarr(store, mode="w", consolidated=True, compute=False)
+    # Annotations are attached as the tasks are built, not when they're computed.
+    with dask.annotate(retries=10):
+        stages = rechunk(
+            args.source,
+            args.target,
+            args.target_chunks,
+            args.max_mem,
+            temp=args.temp,
+            storage_options=storage_options,
+            profiles=parse_profiles(args.encoding) if args.encoding else None,
+            shards=args.shards,
+        )
 
     # copy the data
-    with KubeCluster(custom_cluster_spec="cluster.yaml") as cluster:
-        with cluster.get_client() as client:
-            print("Dashboard Link", cluster.dashboard_link)
-            client.upload_file("rechunk_nwm.py")
-            with dask.config.set(
-                {"array.rechunk.method": "p2p", "optimization.fuse.active": False}
-            ):
-                for k, v in ds2.data_vars.items():
-                    if v.dims == ("time", "y", "x"):
-                        job = to_zarr(v.data, store=store, path=k)
-                        target = zarr.open_array(store, path=k)
-                        # We can't do that.
-                        job = v.data.map_blocks(
-                            store_chunk, target=target, meta=v.data._meta
-                        )
-                        print("execute", k)
-                        job_ = job.persist()
-                        dask.distributed.wait(job_)
+    with executor.from_args(
+        args,
+        tasks=max((len(tasks) for tasks in stages), default=0),
+        upload=[
+            "metrics.py",
+            "executor.py",
+            "encoding.py",
+            "sharding.py",
+            "rechunk_nwm.py",
+        ],
+    ) as client:
+        for i, tasks in enumerate(stages):
+            print(f"stage {i}: {len(tasks)} tasks")
+            with metrics.stage(f"stage_{i}"):
+                dask.compute(*tasks)
+        records = metrics.gather(client)
+
+    metrics.report(records)
+    metrics.write(args.metrics, records)
+
+    if not args.shards:
+        zarr.consolidate_metadata(fsspec.get_mapper(args.target, **storage_options))
 
 
 if __name__ == "__main__":
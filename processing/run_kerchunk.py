@@ -1,14 +1,24 @@
 import argparse
+import dataclasses
+import hashlib
+import json
 import os
-import pathlib
 import sys
+from typing import Optional
 
-from dask_kubernetes.operator import KubeCluster
-from pangeo_forge_recipes.patterns import pattern_from_file_sequence
+import dask
+from pangeo_forge_recipes.patterns import FileType, pattern_from_file_sequence
 from pangeo_forge_recipes.recipes.reference_hdf_zarr import HDFReferenceRecipe
 from pangeo_forge_recipes.storage import StorageConfig, FSSpecTarget, MetadataTarget
 import fsspec
-import tlz
+import executor
+import features
+import inventory
+import metrics
+from manifest import Manifest
+import noaanwm
+import scanner
+import validate
 from pangeo_forge_recipes.recipes.reference_hdf_zarr import (
     ChunkKey,
     Stage,
@@ -30,29 +40,49 @@ def scan_file(chunk_key: ChunkKey, config: HDFReferenceRecipe):
         if protocol is None:
             raise ValueError("Couldn't determine protocol")
         target_url = unstrip_protocol(fname, protocol)
-        config.storage_config.metadata[ref_fname] = create_kerchunk_reference(
-            fp,
-            target_url,
-            file_type=config.file_pattern.file_type,
-            inline_threshold=config.inline_threshold,
-        )
+        if config.file_pattern.file_type == FileType.netcdf4:
+            references = scanner.shared(config.inline_threshold).scan(target_url, fp=fp)
+        else:
+            references = create_kerchunk_reference(
+                fp,
+                target_url,
+                file_type=config.file_pattern.file_type,
+                inline_threshold=config.inline_threshold,
+            )
+        config.storage_config.metadata[ref_fname] = references
+    if config.manifest is not None:
+        config.manifest.record(fname, config.etags.get(fname))
 
 
 # workaround for https://github.com/pangeo-forge/pangeo-forge-recipes/issues/515
 def hdf_reference_recipe_compiler(recipe: HDFReferenceRecipe) -> Pipeline:
+    inputs = list(recipe.iter_inputs())
+    if recipe.manifest is not None:
+        # Skip the files scanned by a previous run, unless they've changed.
+        urls = {recipe.file_pattern[key]: key for key in inputs}
+        inputs = [urls[url] for url in recipe.manifest.pending(urls, recipe.etags)]
+        print(f"Scanning {len(inputs)} new or changed files")
+
     stages = [
         Stage(
-            name="scan_file", function=scan_file, mappable=list(recipe.iter_inputs())
+            name="scan_file",
+            function=metrics.task("scan_file", scan_file),
+            mappable=inputs,
         ),
-        Stage(name="finalize", function=finalize),
+        Stage(name="finalize", function=metrics.task("finalize", finalize, files=0)),
     ]
     return Pipeline(stages=stages, config=recipe)
 
 
 # workaround for https://github.com/pangeo-forge/pangeo-forge-recipes/issues/515
+@dataclasses.dataclass
 class MyHDFReferenceRecipe(HDFReferenceRecipe):
     _compiler = hdf_reference_recipe_compiler
 
+    # Records the scanned files, to skip them when rerunning.
+    manifest: Optional[Manifest] = None
+    etags: dict = dataclasses.field(default_factory=dict)
+
 
 # Workaround https://github.com/pangeo-forge/pangeo-forge-recipes/issues/419
 class MyTarget(FSSpecTarget):
@@ -69,37 +99,288 @@ class MyMetadataTarget(MetadataTarget):
 def parse_args(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("product", choices=["channel_rt", "land", "forcing"])
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Add files newer than the existing reference.json instead of rebuilding",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "parquet"],
+        default="json",
+        help="Also write the references as a partitioned Parquet reference store",
+    )
+    parser.add_argument("--record-size", type=int, default=10_000)
+    parser.add_argument(
+        "--cube",
+        action="store_true",
+        help=(
+            "Index every cycle and lead time as a reference_time x lead_time "
+            "forecast cube, instead of the f001 time series"
+        ),
+    )
+    parser.add_argument(
+        "--range",
+        choices=["short_range", "medium_range", "long_range"],
+        default="short_range",
+        help="The forecast range to index (with --cube)",
+    )
+    parser.add_argument(
+        "--member",
+        type=int,
+        default=1,
+        help="The ensemble member of medium and long range files (with --cube)",
+    )
+    parser.add_argument(
+        "--inventory",
+        default="nwm-inventory.sqlite",
+        help="Path to the file inventory, which is refreshed before processing",
+    )
+    parser.add_argument(
+        "--route-link",
+        default=None,
+        help="NWM RouteLink file with the reach locations, for the channel_rt index",
+    )
+    parser.add_argument(
+        "--metrics",
+        default="metrics/run_kerchunk",
+        help="Write per-stage metrics to {metrics}.json and {metrics}.prom",
+    )
+    executor.add_arguments(parser, default=None)
+
+    args = parser.parse_args(args)
+    if args.executor is None:
+        # Appends scan a few files, so they run locally by default.
+        args.executor = "threads" if args.append else "kube"
+    return args
 
-    return parser.parse_args(args)
 
+def list_files(inv, product, start=None):
+    """
+    List the f001 files for a product from the inventory.
+    """
+    # nwm/nwm.20230123/forcing_short_range/nwm.t00z.short_range.forcing.f001.conus.nc  # noqa: E501
+    # nwm/nwm.20230123/short_range/nwm.t00z.short_range.channel_rt.f001.conus.nc
+    return inv.files(product="short_range", kind=product, forecast_time=1, start=start)
 
-def is_bad(f):
+
+def drop_bad(urls, inv, product):
     """
-    Check if a NetCDF file is corrupt.
+    Drop the corrupt files from ``urls``.
+
+    Files are checked once per etag, locally, and the verdicts are kept with the
+    inventory.
     """
-    import xarray as xr
+    etags = {"abfs://" + k: v for k, v in inv.etags(kind=product).items()}
+    with dask.config.set(scheduler="processes"):
+        bad = validate.find_bad(
+            urls, etags, validate.Verdicts(inv.path), {"account_name": "noaanwm"}
+        )
+    return [url for url in urls if url not in bad]
 
-    try:
-        xr.open_dataset(fsspec.open(f, account_name="noaanwm").open())
-    except Exception:
-        return f
-    else:
-        return False
 
+def append(product, target_fs, inv):
+    """
+    Update the product's reference.json with the files added since it was written.
 
-def list_day(root, product):
+    This runs locally: only the days since the last indexed time are listed and
+    only the new files are scanned.
     """
-    List the files for a product under a day prefix.
+    storage_options = {"account_name": "noaanwm"}
+    path = f"ciroh/short-range-{product}-kerchunk/reference.json"
+    with target_fs.open(path) as f:
+        references = json.load(f)
+
+    last = noaanwm.indexed_times(references, "abfs", storage_options).max()
+    file_list = list_files(inv, product, start=last.date())
+    urls = drop_bad(["abfs://" + f for f in file_list], inv, product)
+    print(f"Checking {len(urls)} files newer than {last}")
+
+    references = noaanwm.append_references(
+        references,
+        urls,
+        "abfs",
+        storage_options,
+        concat_dims=["time"],
+        identical_dims=noaanwm.IDENTICAL_DIMS[product],
+    )
+    with target_fs.open(path, "w") as f:
+        json.dump(references, f)
+    return references
+
+
+def write_feature_index(references, target_storage_options, route_link=None):
+    """
+    Write the channel_rt `features.FeatureIndex` next to its references.
     """
-    fs = fsspec.filesystem("abfs", account_name="noaanwm")
-    if product == "forcing":
-        # nwm/nwm.20230123/forcing_short_range/nwm.t00z.short_range.forcing.f001.conus.nc  # noqa: E501
-        pattern = f"{root}/forcing_short_range/nwm.t*z.short_range.forcing.f001.conus.nc"  # noqa: E501
-    else:
-        # nwm/nwm.20230123/short_range/nwm.t00z.short_range.channel_rt.f001.conus.nc
-        pattern = f"{root}/short_range/nwm.*.short_range.{product}.f001.conus.nc"
+    url = "abfs://ciroh/short-range-channel_rt-kerchunk/features.npz"
+    print("Writing the feature index to", url)
+    with metrics.stage("feature_index"):
+        storage_options = {"account_name": "noaanwm"}
+        ds = noaanwm.open_references(references, "abfs", storage_options)
+        index = features.build(ds, route_link, storage_options=storage_options)
+        index.save(url, target_storage_options)
+
+
+def write_parquet(product, references, target_storage_options, record_size, url=None):
+    url = url or f"abfs://ciroh/short-range-{product}-kerchunk/reference.parquet"
+    print("Writing parquet references to", url)
+    with metrics.stage("write_parquet"):
+        noaanwm.write_parquet_references(
+            references,
+            url,
+            storage_options=target_storage_options,
+            record_size=record_size,
+        )
+
 
-    return fs.glob(pattern)
+def cube_kind(product, forecast_range, member):
+    """The file kind of ``product`` in ``forecast_range``, e.g. ``channel_rt_1``."""
+    if forecast_range == "short_range" or product == "forcing":
+        return product
+    return f"{product}_{member}"
+
+
+def scan_cycle(url, files, etag, manifest, identical_dims, target_storage_options):
+    """
+    Build one cycle's forecast cube references, write them to ``url`` and record
+    the cycle in the manifest.
+    """
+    references = noaanwm.build_cycle(
+        files, "abfs", {"account_name": "noaanwm"}, identical_dims
+    )
+    with fsspec.open(url, "w", **target_storage_options) as f:
+        json.dump(references, f)
+    manifest.record(url, etag, files=len(files))
+    return references
+
+
+def read_cycle(url, target_storage_options):
+    """The references of a cycle written by a previous run."""
+    with fsspec.open(url, "r", **target_storage_options) as f:
+        return json.load(f)
+
+
+def write_cube(references, root, product, target_storage_options, parquet, record_size):
+    """Write the assembled cube to ``{root}/reference.json`` (and ``.parquet``)."""
+    with fsspec.open(f"{root}/reference.json", "w", **target_storage_options) as f:
+        json.dump(references, f)
+    if parquet:
+        write_parquet(
+            product,
+            references,
+            target_storage_options,
+            record_size,
+            url=f"{root}/reference.parquet",
+        )
+
+
+def cube_tasks(product, forecast_range, kind, inv, target_storage_options):
+    """
+    The (delayed) references of every cycle, by ``reference_time``, and the
+    number of cycles to scan. New or changed cycles are scanned, and the rest
+    are read from a previous run.
+
+    A cycle is rebuilt when its files change, including when more of its lead
+    times have been published since it was last built.
+    """
+    root = f"abfs://ciroh/{forecast_range.replace('_', '-')}-{kind}-cube-kerchunk"
+    files = inv.files(product=forecast_range, kind=kind)
+    urls = drop_bad(["abfs://" + f for f in files], inv, kind)
+    etags = {
+        "abfs://" + k: v
+        for k, v in inv.etags(product=forecast_range, kind=kind).items()
+    }
+    groups, times = {}, {}
+    for t, group in noaanwm.cycles(urls).items():
+        url = f"{root}/cycles/{t:%Y%m%d%H}.json"
+        groups[url], times[url] = group, t
+    cycle_etags = {
+        url: hashlib.sha256(
+            "\n".join(f"{f} {etags.get(f)}" for f in group).encode()
+        ).hexdigest()
+        for url, group in groups.items()
+    }
+    manifest = Manifest(f"{root}-manifest/", target_storage_options)
+    pending = set(manifest.pending(groups, cycle_etags))
+    print(f"Scanning {len(pending)} new or changed cycles of {len(groups)}")
+
+    identical_dims = noaanwm.IDENTICAL_DIMS[product]
+    scan = dask.delayed(metrics.task("cycle", scan_cycle), pure=False)
+    read = dask.delayed(metrics.task("read_cycle", read_cycle), pure=False)
+    cycles = {}
+    for url, group in groups.items():
+        if url in pending:
+            cycles[times[url]] = scan(
+                url,
+                group,
+                cycle_etags[url],
+                manifest,
+                identical_dims,
+                target_storage_options,
+            )
+        else:
+            cycles[times[url]] = read(url, target_storage_options)
+    return root, cycles, len(pending)
+
+
+KUBE_OPTIONS = dict(
+    image="pccomponentstest.azurecr.io/noaa-nwm:2023.4.26.0",
+    resources={
+        "requests": {"memory": "7Gi", "cpu": "0.9"},
+        "limit": {"memory": "8Gi", "cpu": "1"},
+    },
+    worker_command="dask-worker --nthreads 1 --nworkers 1 --memory-limit 8GB",
+)
+
+# In import order: each module is imported on the workers as it's uploaded.
+UPLOAD = [
+    "metrics.py",
+    "scanner.py",
+    "executor.py",
+    "inventory.py",
+    "manifest.py",
+    "validate.py",
+    "features.py",
+    "noaanwm.py",
+    "run_kerchunk.py",
+]
+
+
+def main_cube(args, inv, target_storage_options):
+    product = args.product
+    kind = cube_kind(product, args.range, args.member)
+    root, cycles, pending = cube_tasks(
+        product, args.range, kind, inv, target_storage_options
+    )
+    if not cycles:
+        print("No files to index")
+        return
+
+    # The cycles are merged by day, then by month, on the workers, and the cube
+    # is written by the last task, so it never passes through this process.
+    references = noaanwm.combine_tree(
+        cycles, "abfs", {"account_name": "noaanwm"}, noaanwm.IDENTICAL_DIMS[product]
+    )
+    write = dask.delayed(metrics.task("write_cube", write_cube), pure=False)
+    task = write(
+        references,
+        root,
+        product,
+        target_storage_options,
+        args.format == "parquet",
+        args.record_size,
+    )
+    print(f"Assembling {len(cycles)} cycles")
+    with executor.from_args(
+        args, tasks=max(pending, 1), upload=UPLOAD, kube_options=KUBE_OPTIONS
+    ) as client:
+        with metrics.stage("cube", files=len(cycles)):
+            dask.compute(task)
+        records = metrics.gather(client)
+
+    metrics.report(records)
+    metrics.write(f"{args.metrics}-cube", records)
 
 
 def main(args=None):
@@ -108,41 +389,34 @@ def main(args=None):
 
     credential = os.environ["AZURE_SAS_TOKEN"]
 
-    p = pathlib.Path(f"{product}-files.txt")
-
-    if not p.exists():
-        # there are missing days / hours, so we can't use a simple file pattern.
-        print("Listing files")
-        with KubeCluster(
-            image="pccomponentstest.azurecr.io/noaa-nwm:2023.4.26.0",
-            resources={
-                "requests": {"memory": "7Gi", "cpu": "0.9"},
-                "limit": {"memory": "8Gi", "cpu": "1"},
-            },
-            worker_command="dask-worker --nthreads 1 --nworkers 1 --memory-limit 8GB",
-        ) as cluster:
-            cluster.scale(8)
-            with cluster.get_client() as client:
-                client.upload_file("run_kerchunk.py")
-                print("Dashboard Link:", client.dashboard_link)
-
-                fs = fsspec.filesystem("abfs", account_name="noaanwm")
-                roots = fs.glob("nwm/nwm.*")  # fast, single-threaded
-                futures = client.map(list_day, roots, product=product)  # parallel
-                files_lists = client.gather(futures)
-                file_list = tlz.concat(files_lists)
-
-        p.write_text("\n".join(file_list))
-
-    file_list = p.read_text().split("\n")
-
-    bad = {
-        "nwm/nwm.20220917/short_range/nwm.t18z.short_range.channel_rt.f001.conus.nc",
-        "nwm/nwm.20220926/short_range/nwm.t16z.short_range.channel_rt.f001.conus.nc",
-        "nwm/nwm.20220913/short_range/nwm.t12z.short_range.land.f001.conus.nc",
-        "nwm/nwm.20220927/short_range/nwm.t20z.short_range.land.f001.conus.nc",
-        "nwm/nwm.20221020/forcing_short_range/nwm.t00z.short_range.forcing.f001.conus.nc",
-    }
+    target_storage_options = dict(account_name="noaanwm", credential=credential)
+
+    inv = inventory.Inventory(args.inventory, "abfs", {"account_name": "noaanwm"})
+    print("Refreshing inventory")
+    inv.refresh()
+
+    if args.cube:
+        return main_cube(args, inv, target_storage_options)
+
+    if args.append:
+        target_fs = fsspec.filesystem("abfs", **target_storage_options)
+        with executor.from_args(
+            args, upload=UPLOAD, kube_options=KUBE_OPTIONS
+        ) as client:
+            references = append(product, target_fs, inv)
+            records = metrics.gather(client, local=False)
+        if product == "channel_rt" and not target_fs.exists(
+            "ciroh/short-range-channel_rt-kerchunk/features.npz"
+        ):
+            write_feature_index(references, target_storage_options, args.route_link)
+        if args.format == "parquet":
+            write_parquet(product, references, target_storage_options, args.record_size)
+        records = metrics.collect() + records
+        metrics.report(records)
+        metrics.write(f"{args.metrics}-append", records)
+        return
+
+    file_list = list_files(inv, product)
 
     file_list = [
         x
@@ -150,35 +424,30 @@ def main(args=None):
         # https://github.com/pangeo-forge/staged-recipes/pull/215/#issuecomment-1520905668
         # filter to newer files
         if x.split("/")[1].split(".")[1] > "20220628"
-        # drop corrupt NetCDF files
-        and x not in bad
     ]
-    print(f"Processing {len(file_list)} files")
-
-    urls = ["abfs://" + f for f in file_list]
+    # drop corrupt NetCDF files
+    urls = drop_bad(["abfs://" + f for f in file_list], inv, product)
+    print(f"Processing {len(urls)} files")
 
     # Create filepattern from urls
     pattern = pattern_from_file_sequence(urls, "time")
 
-    match product:
-        case "channel_rt":
-            identical_dims = ["feature_id"]
-        case "land":
-            identical_dims = ["x", "y"]
-        case "forcing":
-            identical_dims = ["x", "y", "crs"]
-        case _:
-            raise ValueError(f"Unknown product {product}")
+    identical_dims = noaanwm.IDENTICAL_DIMS[product]
 
     # Create HDFReference recipe from pattern
+    etags = {"abfs://" + k: v for k, v in inv.etags(kind=product).items()}
     recipe = MyHDFReferenceRecipe(
         pattern,
         netcdf_storage_options={"account_name": "noaanwm"},
         identical_dims=identical_dims,
+        manifest=Manifest(
+            f"abfs://ciroh/short-range-{product}-kerchunk-manifest/",
+            target_storage_options,
+        ),
+        etags=etags,
     )
 
     # configure storage
-    target_storage_options = dict(account_name="noaanwm", credential=credential)
     target_fs = fsspec.filesystem("abfs", **target_storage_options)
     storage = StorageConfig(
         target=MyTarget(target_fs, root_path=f"ciroh/short-range-{product}-kerchunk/"),
@@ -189,19 +458,26 @@ def main(args=None):
     recipe.storage_config = storage
 
     # Run it
-    with KubeCluster(
-        image="pccomponentstest.azurecr.io/noaa-nwm:2023.4.26.0",
-        resources={
-            "requests": {"memory": "7Gi", "cpu": "0.9"},
-            "limit": {"memory": "8Gi", "cpu": "1"},
-        },
-        worker_command="dask-worker --nthreads 1 --nworkers 1 --memory-limit 8GB",
-    ) as cluster:
-        cluster.scale(64)
-        with cluster.get_client() as client:
-            client.upload_file("run_kerchunk.py")
-            print("Dashboard Link:", client.dashboard_link)
+    with executor.from_args(
+        args, tasks=len(urls), upload=UPLOAD, kube_options=KUBE_OPTIONS
+    ) as client:
+        with metrics.stage("recipe", files=len(urls)):
             recipe.to_dask().compute()
+        records = metrics.gather(client, local=False)
+
+    if args.format == "parquet" or product == "channel_rt":
+        with target_fs.open(
+            f"ciroh/short-range-{product}-kerchunk/reference.json"
+        ) as f:
+            references = json.load(f)
+    if product == "channel_rt":
+        write_feature_index(references, target_storage_options, args.route_link)
+    if args.format == "parquet":
+        write_parquet(product, references, target_storage_options, args.record_size)
+
+    records = metrics.collect() + records
+    metrics.report(records)
+    metrics.write(args.metrics, records)
 
 
 if __name__ == "__main__":
@@ -1,25 +1,38 @@
+import argparse
+import dataclasses
+import functools
+import json
 import os
 import azure.storage.blob
 import datetime
+from typing import Optional
 import pandas as pd
 import zarr
-import pathlib
 
+import dask
+import dask.utils
 import fsspec
 import xarray as xr
+import encoding
+import executor
+import inventory
+import metrics
+import rechunk_nwm
+from manifest import Manifest
+import validate
 from pangeo_forge_recipes.patterns import pattern_from_file_sequence
-from dask_kubernetes.operator import KubeCluster
-from pangeo_forge_recipes.recipes.xarray_zarr import XarrayZarrRecipe
+from pangeo_forge_recipes.recipes.xarray_zarr import (
+    ChunkKey,
+    Pipeline,
+    Stage,
+    XarrayZarrRecipe,
+    finalize_target,
+    inputs_for_chunk,
+    prepare_target,
+    store_chunk,
+)
 from pangeo_forge_recipes.storage import StorageConfig, FSSpecTarget, MetadataTarget
 
-BAD = {
-    "nwm/nwm.20220917/short_range/nwm.t18z.short_range.channel_rt.f001.conus.nc",
-    "nwm/nwm.20220926/short_range/nwm.t16z.short_range.channel_rt.f001.conus.nc",
-    "nwm/nwm.20220913/short_range/nwm.t12z.short_range.land.f001.conus.nc",
-    "nwm/nwm.20220927/short_range/nwm.t20z.short_range.land.f001.conus.nc",
-    "nwm/nwm.20221020/forcing_short_range/nwm.t00z.short_range.forcing.f001.conus.nc",
-}
-
 
 # Workaround https://github.com/pangeo-forge/pangeo-forge-recipes/issues/419
 class MyTarget(FSSpecTarget):
@@ -33,37 +46,168 @@ class MyMetadataTarget(MetadataTarget):
         pass
 
 
-def process_input(ds: xr.Dataset, filename: str) -> xr.Dataset:
+def chunk_inputs(chunk_key: ChunkKey, config: XarrayZarrRecipe) -> list[tuple]:
+    """
+    The (position, url) of each input in a chunk.
+    """
+    ninputs = config.file_pattern.dims[config.concat_dim]
+    keys = inputs_for_chunk(chunk_key, config.inputs_per_chunk, ninputs)
+    return [
+        (
+            next(d.index for d in key if d.name == config.concat_dim),
+            config.file_pattern[key],
+        )
+        for key in keys
+    ]
+
+
+def prepare_target_checkpointed(*, config: XarrayZarrRecipe) -> None:
+    with metrics.stage("prepare_target"):
+        prepare_target(config=config)
+
+
+def store_chunk_checkpointed(chunk_key: ChunkKey, *, config: XarrayZarrRecipe) -> None:
+    inputs = chunk_inputs(chunk_key, config)
+    with metrics.stage("store_chunk", files=len(inputs)):
+        store_chunk(chunk_key, config=config)
+    for position, url in inputs:
+        config.manifest.record(url, config.etags.get(url), position=position)
+
+
+def checkpointed_compiler(recipe: XarrayZarrRecipe) -> Pipeline:
+    """
+    Like ``xarray_zarr_recipe_compiler``, but skipping the chunks whose inputs
+    were stored by a previous run and haven't changed or moved since.
+    """
+    records = recipe.manifest.load()
+
+    def is_done(position, url):
+        record = records.get(url)
+        return (
+            record is not None
+            and record.get("position") == position
+            and record["etag"] == recipe.etags.get(url, record["etag"])
+        )
+
+    chunks = [
+        chunk_key
+        for chunk_key in recipe.iter_chunks()
+        if not all(is_done(*x) for x in chunk_inputs(chunk_key, recipe))
+    ]
+    print(f"Storing {len(chunks)} new or changed chunks")
+    stages = [
+        Stage(name="prepare_target", function=prepare_target_checkpointed),
+        Stage(name="store_chunk", function=store_chunk_checkpointed, mappable=chunks),
+        Stage(
+            name="finalize_target",
+            function=metrics.task("finalize_target", finalize_target, files=0),
+        ),
+    ]
+    return Pipeline(stages=stages, config=recipe)
+
+
+@dataclasses.dataclass
+class CheckpointedXarrayZarrRecipe(XarrayZarrRecipe):
+    """
+    An XarrayZarrRecipe that records each stored input in a `manifest.Manifest`,
+    so that a rerun only processes new or changed inputs.
+    """
+
+    _compiler = checkpointed_compiler
+
+    manifest: Optional[Manifest] = None
+    etags: dict = dataclasses.field(default_factory=dict)
+
+
+def process_input(
+    ds: xr.Dataset, filename: str, profiles: dict | None = None
+) -> xr.Dataset:
+    # Compress and (re)pack each variable with its `encoding.Profile`
+    ds = encoding.apply(ds, profiles)
     # https://github.com/pangeo-forge/pangeo-forge-recipes/issues/318
     # Ensure that the timestamps are correct in the output
     ds["time"].encoding["units"] = "minutes since 1970-01-01 00:00:00 UTC"
     return ds
 
 
-def main():
-    file_list = pathlib.Path("forcing-files.txt").read_text().splitlines()
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--encoding",
+        type=json.loads,
+        default={},
+        help=(
+            "JSON mapping of variable name (or '*') to encoding.Profile fields, "
+            'e.g. \'{"*": {"compressor": "blosc-zstd-bitshuffle"}}\''
+        ),
+    )
+    parser.add_argument(
+        "--shards",
+        type=json.loads,
+        default=None,
+        help=(
+            "JSON mapping of dimension name to shard size. Also copies the store "
+            "to a sharded Zarr v3 store at --sharded-target."
+        ),
+    )
+    parser.add_argument(
+        "--sharded-target",
+        default="abfs://ciroh/zarr/ts/short-range-forcing-sharded-test.zarr",
+    )
+    executor.add_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    inv = inventory.Inventory(
+        "nwm-inventory.sqlite", "abfs", {"account_name": "noaanwm"}
+    )
+    print("Refreshing inventory")
+    inv.refresh()
+    file_list = inv.files(product="short_range", kind="forcing", forecast_time=1)
     file_list = [
         x
         for x in file_list
         # https://github.com/pangeo-forge/staged-recipes/pull/215/#issuecomment-1520905668
         # filter to newer files
         if x.split("/")[1].split(".")[1] > "20220628"
-        # drop corrupt NetCDF files
-        and x not in BAD
     ]
-    print(f"Processing {len(file_list)} files")
+    product = "forcing"
+    etags = {"abfs://" + k: v for k, v in inv.etags(kind=product).items()}
 
+    # drop corrupt NetCDF files
     # fs = fsspec.filesystem("abfs", account_name="noaanwm")
     urls = ["abfs://" + f for f in file_list]
+    with dask.config.set(scheduler="processes"), metrics.stage("validate"):
+        bad = validate.find_bad(
+            urls, etags, validate.Verdicts(inv.path), {"account_name": "noaanwm"}
+        )
+    urls = [url for url in urls if url not in bad]
+    print(f"Processing {len(urls)} files")
 
     pattern = pattern_from_file_sequence(
         urls, "time", nitems_per_file=1, fsspec_open_kwargs=dict(account_name="noaanwm")
     )
-    recipe = XarrayZarrRecipe(pattern, cache_inputs=False, process_input=process_input)
     # configure storage
     credential = os.environ["AZURE_SAS_TOKEN"]
-    product = "forcing"
     target_storage_options = dict(account_name="noaanwm", credential=credential)
+
+    recipe = CheckpointedXarrayZarrRecipe(
+        pattern,
+        cache_inputs=False,
+        process_input=functools.partial(
+            process_input, profiles=encoding.parse_profiles(args.encoding)
+        ),
+        # Keep the source packing for process_input
+        delete_input_encoding=False,
+        manifest=Manifest(
+            f"abfs://ciroh/metadata/short-range-{product}-zarr-manifest/",
+            target_storage_options,
+        ),
+        etags=etags,
+    )
     target_fs = fsspec.filesystem("abfs", **target_storage_options)
     storage = StorageConfig(
         target=MyTarget(
@@ -75,14 +219,53 @@ def main():
     )
     recipe.storage_config = storage
 
-    with KubeCluster(custom_cluster_spec="cluster.yaml") as cluster:
-        with cluster.get_client() as client:
-            client.upload_file("run_zarr.py")
-            print("Dashboard Link:", client.dashboard_link)
+    upload = [
+        "metrics.py",
+        "encoding.py",
+        "scanner.py",
+        "executor.py",
+        "inventory.py",
+        "manifest.py",
+        "validate.py",
+        "noaanwm.py",
+        "sharding.py",
+        "rechunk_nwm.py",
+        "run_zarr.py",
+    ]
+    with executor.from_args(args, tasks=len(urls), upload=upload) as client:
+        with metrics.stage("recipe", files=len(urls)):
             recipe.to_dask().compute(retries=10)
-            print("Done")
+        print("Done")
+        fix_time(urls, credential)
+        if args.shards:
+            shard(
+                f"abfs://ciroh/zarr/ts/short-range-{product}-test.zarr",
+                args.sharded_target,
+                args.shards,
+                target_storage_options,
+            )
+        records = metrics.gather(client)
+
+    metrics.report(records)
+    metrics.write("metrics/run_zarr", records)
+
 
-    fix_time(urls, credential)
+def shard(source, target, shards, storage_options, max_mem="2GB"):
+    # Pack the store's chunks into shards, without rechunking. Shards already
+    # copied by a previous run are kept, and the last ones are copied again.
+    # Annotations are attached as the tasks are built, not when they're computed.
+    with dask.annotate(retries=10):
+        stages = rechunk_nwm.rechunk(
+            source,
+            target,
+            {},
+            dask.utils.parse_bytes(max_mem),
+            storage_options=storage_options,
+            shards=shards,
+        )
+    for i, tasks in enumerate(stages):
+        with metrics.stage(f"shard_{i}"):
+            dask.compute(*tasks)
 
 
 def fix_time(urls, credential):
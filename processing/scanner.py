@@ -0,0 +1,200 @@
+"""
+Fast scanning of structurally identical HDF5 files.
+
+Every file of a product has the same variables, shapes, dtypes and filters,
+but ``kerchunk.hdf.SingleHdf5ToZarr`` parses all of that metadata again for
+each one. `TemplateScanner` fully scans the first file of each product and
+schema version (the *template*) and, for every other file, only reads the
+attributes and the chunk locations of each variable, reusing the rest of the
+template's Zarr metadata:
+
+>>> scanner = TemplateScanner()
+>>> references = [scanner.scan(url, storage_options) for url in urls]
+>>> scanner.stats
+Counter({'template': 1, 'fast': 23})
+
+`shared` gives one scanner per process, so each Dask worker scans a template
+once and reuses it for every task.
+
+A file whose variables or their layout (shape, dtype, chunks, filters) differ
+from its template gets a full scan, which becomes the new template.
+"""
+import base64
+import collections
+import functools
+import json
+import threading
+from typing import Any
+
+import fsspec
+import h5py
+import kerchunk.hdf
+
+# The root attributes identifying the schema of an NWM file
+SCHEMA_ATTRS = ("model_version", "model_configuration", "model_output_type")
+
+
+def _layout(dset: h5py.Dataset) -> tuple:
+    plist = dset.id.get_create_plist()
+    filters = tuple(plist.get_filter(i)[:3] for i in range(plist.get_nfilters()))
+    return (dset.shape, dset.dtype.str, dset.chunks, plist.get_layout(), filters)
+
+
+def _chunks(dset: h5py.Dataset) -> dict[tuple[int, ...], tuple[int, int]]:
+    """The file offset and size of each chunk of ``dset``, by chunk index."""
+    dsid = dset.id
+    if dset.chunks is None:
+        if dsid.get_offset() is None:
+            return {}
+        key = (0,) * (len(dset.shape) or 1)
+        return {key: (dsid.get_offset(), dsid.get_storage_size())}
+
+    out = {}
+
+    def store(info):
+        key = tuple(a // b for a, b in zip(info.chunk_offset, dset.chunks))
+        out[key] = (info.byte_offset, info.size)
+
+    if callable(getattr(dsid, "chunk_iter", None)):
+        dsid.chunk_iter(store)
+    else:
+        for i in range(dsid.get_num_chunks()):
+            store(dsid.get_chunk_info(i))
+    return out
+
+
+def _attrs(h5obj) -> dict[str, Any]:
+    """The attributes of ``h5obj`` as `SingleHdf5ToZarr` stores them."""
+    out = {}
+    for name, value in h5obj.attrs.items():
+        if name in kerchunk.hdf._HIDDEN_ATTRS or name == "_FillValue":
+            continue
+        if isinstance(value, bytes):
+            value = value.decode("utf-8") or " "
+        elif hasattr(value, "dtype"):
+            if value.dtype.kind == "S":
+                value = value.astype(str)
+            value = value.flatten()[0].tolist() if value.size == 1 else value.tolist()
+        elif isinstance(value, h5py.Empty):
+            value = ""
+        if value != "DIMENSION_SCALE":
+            out[name] = value
+    return out
+
+
+def _dumps(attrs: dict[str, Any]) -> str:
+    return json.dumps(attrs, sort_keys=True, separators=(",", ":"))
+
+
+def _schema(f: h5py.File) -> tuple:
+    attrs = f.attrs
+    return (tuple(sorted(f)),) + tuple(
+        str(attrs[a]) if a in attrs else None for a in SCHEMA_ATTRS
+    )
+
+
+class TemplateScanner:
+    """
+    Scan HDF5 files to Kerchunk references, reusing the metadata of a fully
+    scanned template file of the same schema. Safe to use from several threads.
+
+    Parameters
+    ----------
+    inline_threshold
+        Chunks smaller than this many bytes are inlined in the references, as
+        with `SingleHdf5ToZarr`.
+    """
+
+    def __init__(self, inline_threshold: int = 500):
+        self.inline_threshold = inline_threshold
+        self.templates: dict[tuple, dict] = {}
+        self.stats: collections.Counter = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"TemplateScanner<{len(self.templates)} templates, {dict(self.stats)}>"
+
+    def scan(
+        self,
+        url: str,
+        storage_options: dict[str, Any] | None = None,
+        fp=None,
+    ) -> dict:
+        """
+        The references of the file at ``url``, read from ``fp`` if given (an
+        open binary file) or opened with ``storage_options``.
+        """
+        if fp is None:
+            with fsspec.open(url, "rb", **(storage_options or {})) as fp:
+                return self.scan(url, fp=fp)
+
+        with h5py.File(fp, mode="r") as f:
+            schema = _schema(f)
+            template = self.templates.get(schema)
+            if template is not None:
+                refs = self._from_template(template, f, fp, url)
+                if refs is not None:
+                    self._count("fast")
+                    return {"version": 1, "refs": refs}
+            self._count("fallback" if template is not None else "template")
+
+        fp.seek(0)
+        references = kerchunk.hdf.SingleHdf5ToZarr(
+            fp, url, inline_threshold=self.inline_threshold
+        ).translate()
+        with h5py.File(fp, mode="r") as f:
+            self.templates[schema] = self._template(references, f)
+        return references
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def _template(self, references: dict, f: h5py.File) -> dict:
+        refs = references["refs"]
+        arrays = [k[: -len("/.zarray")] for k in refs if k.endswith("/.zarray")]
+        metadata = {
+            k: v for k, v in refs.items() if k.rsplit("/", 1)[-1].startswith(".")
+        }
+        # The attributes Kerchunk adds to each array, e.g. _ARRAY_DIMENSIONS
+        added = {}
+        for name in arrays:
+            attrs = json.loads(refs.get(f"{name}/.zattrs", "{}"))
+            own = _attrs(f[name])
+            added[name] = {k: v for k, v in attrs.items() if k not in own}
+        return {
+            "metadata": metadata,
+            "layouts": {name: _layout(f[name]) for name in arrays},
+            "added": added,
+        }
+
+    def _from_template(self, template: dict, f, fp, url: str) -> dict | None:
+        refs = dict(template["metadata"])
+        for name, layout in template["layouts"].items():
+            dset = f[name]
+            if layout[3] == h5py.h5d.COMPACT or _layout(dset) != layout:
+                return None
+            refs[f"{name}/.zattrs"] = _dumps(
+                {**_attrs(dset), **template["added"][name]}
+            )
+            for index, (offset, size) in _chunks(dset).items():
+                if dset.fletcher32:
+                    size -= 4
+                key = f"{name}/" + ".".join(map(str, index))
+                if self.inline_threshold and size < self.inline_threshold:
+                    fp.seek(offset)
+                    data = fp.read(size)
+                    try:
+                        refs[key] = data.decode("ascii")
+                    except UnicodeDecodeError:
+                        refs[key] = "base64:" + base64.b64encode(data).decode()
+                else:
+                    refs[key] = [url, offset, size]
+        refs[".zattrs"] = _dumps(_attrs(f))
+        return refs
+
+
+@functools.cache
+def shared(inline_threshold: int = 500) -> TemplateScanner:
+    """The scanner shared by the process, so each schema is fully scanned once."""
+    return TemplateScanner(inline_threshold)
@@ -0,0 +1,620 @@
+"""
+Zarr v3 arrays whose chunks are packed into shards.
+
+A rechunked time-series store has one object per chunk and variable, and
+listing, copying and deleting it is dominated by the per-object overhead. The
+v3 ``sharding_indexed`` codec stores many *inner* chunks in each shard object,
+after an index of the offset and size of each inner chunk, so a reader still
+only fetches the inner chunks it needs, with ranged reads:
+
+>>> array = ShardedArray.create(
+...     store, "T2D", shape, "int32", chunks=(168, 240, 288), shards=(168, 960, 2304)
+... )
+>>> array[:168, :960, :2304] = values       # a task writes whole shards
+>>> array[:, 100, 100]                      # reads one inner chunk per shard
+
+Writes must cover whole shards, since a shard is written as one object.
+
+Zarr v3 readers (zarr-python 3, zarrs, tensorstore) open the store directly.
+For Zarr v2 readers, `references` gives Kerchunk references to the inner chunks
+inside the shards, e.g. for `noaanwm.open_references`:
+
+    python sharding.py references \\
+        az://ciroh/zarr/ts/short-range-forcing-sharded-test.zarr \\
+        az://ciroh/zarr/ts/short-range-forcing-sharded-test.json
+"""
+import argparse
+import base64
+import itertools
+import json
+import math
+import os
+import struct
+import sys
+from typing import Any, Iterator
+
+import fsspec
+import numcodecs
+import numpy as np
+
+# The (offset, nbytes) of an inner chunk missing from its shard
+MISSING = 2**64 - 1
+
+_SHUFFLES = {
+    numcodecs.Blosc.NOSHUFFLE: "noshuffle",
+    numcodecs.Blosc.SHUFFLE: "shuffle",
+    numcodecs.Blosc.BITSHUFFLE: "bitshuffle",
+}
+
+
+def _bytes_codec(dtype: np.dtype) -> dict:
+    if dtype.itemsize == 1:
+        return {"name": "bytes"}
+    return {"name": "bytes", "configuration": {"endian": "little"}}
+
+
+def codec_metadata(compressor, dtype: np.dtype) -> list[dict]:
+    """The v3 codecs storing chunks of ``dtype`` compressed with ``compressor``."""
+    codecs = [_bytes_codec(dtype)]
+    if compressor is None:
+        return codecs
+    config = compressor.get_config()
+    if config["id"] == "blosc":
+        shuffle = config["shuffle"]
+        if shuffle == numcodecs.Blosc.AUTOSHUFFLE:
+            shuffle = 2 if dtype.itemsize == 1 else 1
+        codecs.append(
+            {
+                "name": "blosc",
+                "configuration": {
+                    "cname": config["cname"],
+                    "clevel": config["clevel"],
+                    "shuffle": _SHUFFLES[shuffle],
+                    "typesize": dtype.itemsize,
+                    "blocksize": config["blocksize"],
+                },
+            }
+        )
+    elif config["id"] == "zstd":
+        codecs.append(
+            {
+                "name": "zstd",
+                "configuration": {"level": config["level"], "checksum": False},
+            }
+        )
+    elif config["id"] in ("zlib", "gzip"):
+        codecs.append({"name": "gzip", "configuration": {"level": config["level"]}})
+    else:
+        raise ValueError(f"No Zarr v3 codec for the {config['id']!r} compressor")
+    return codecs
+
+
+def _compressor(codecs: list[dict]):
+    for codec in codecs:
+        config = codec.get("configuration", {})
+        if codec["name"] == "blosc":
+            shuffle = {v: k for k, v in _SHUFFLES.items()}[config["shuffle"]]
+            return numcodecs.Blosc(
+                config["cname"], config["clevel"], shuffle, config["blocksize"]
+            )
+        if codec["name"] == "zstd":
+            return numcodecs.Zstd(config["level"])
+        if codec["name"] == "gzip":
+            return numcodecs.GZip(config["level"])
+    return None
+
+
+def _fill_value(value, dtype: np.dtype):
+    if dtype.kind == "S":
+        return base64.standard_b64encode(value or b"").decode()
+    if value is None:
+        return False if dtype.kind == "b" else 0
+    if dtype.kind == "f" and not np.isfinite(value):
+        return "NaN" if np.isnan(value) else ("Infinity" if value > 0 else "-Infinity")
+    return value.item() if hasattr(value, "item") else value
+
+
+def _fill_value_attribute(value, dtype: np.dtype):
+    # xarray's encoding of _FillValue attributes in v3 (see FillValueCoder)
+    if dtype.kind == "S":
+        return base64.standard_b64encode(value).decode()
+    if dtype.kind == "f":
+        return base64.standard_b64encode(struct.pack("<d", float(value))).decode()
+    return bool(value) if dtype.kind == "b" else int(value)
+
+
+def _data_type(dtype: np.dtype) -> str | dict:
+    if dtype.kind == "S":
+        # As zarr-python stores them, e.g. the |S1 ``crs`` variables
+        return {
+            "name": "null_terminated_bytes",
+            "configuration": {"length_bytes": dtype.itemsize},
+        }
+    if dtype.kind not in "biuf":
+        raise ValueError(f"No Zarr v3 data type for {dtype}")
+    return "bool" if dtype.kind == "b" else dtype.name
+
+
+def _dtype(data_type: str | dict) -> np.dtype:
+    if isinstance(data_type, dict):
+        return np.dtype(f"S{data_type['configuration']['length_bytes']}")
+    return np.dtype(data_type).newbyteorder("<")
+
+
+def write_group(store, attributes: dict[str, Any] | None = None) -> None:
+    """Write the metadata of the v3 group at the root of ``store``."""
+    store["zarr.json"] = json.dumps(
+        {"zarr_format": 3, "node_type": "group", "attributes": attributes or {}},
+        indent=2,
+    ).encode()
+
+
+class ShardedArray:
+    """
+    A Zarr v3 array in an fsspec mapper ``store``, with ``inner_chunks`` packed
+    into shards of ``chunks``.
+
+    ``chunks`` is the shard shape, so that code writing whole chunks of a Zarr
+    v2 array (like `rechunk_nwm.copy_block`) writes whole shards of this one.
+    Zero-dimensional arrays are stored as a single, unsharded chunk.
+    """
+
+    def __init__(self, store, path: str, metadata: dict):
+        self.store = store
+        self.path = path
+        self.metadata = metadata
+        self.shape = tuple(metadata["shape"])
+        self.dtype = _dtype(metadata["data_type"])
+        codecs = metadata["codecs"]
+        if codecs[0]["name"] == "sharding_indexed":
+            config = codecs[0]["configuration"]
+            self.chunks = tuple(metadata["chunk_grid"]["configuration"]["chunk_shape"])
+            self.inner_chunks = tuple(config["chunk_shape"])
+            # Shards written by other libraries may have the index at the end,
+            # followed by a CRC32C checksum
+            self.index_at_end = config.get("index_location", "end") == "end"
+            checksums = [c for c in config["index_codecs"] if c["name"] == "crc32c"]
+            self.index_nbytes = math.prod(self.grid) * 16 + 4 * len(checksums)
+            codecs = config["codecs"]
+        else:
+            self.chunks = self.inner_chunks = tuple(self.shape)
+        self.compressor = _compressor(codecs)
+        fill_value = metadata["fill_value"]
+        if self.dtype.kind == "S":
+            fill_value = base64.standard_b64decode(fill_value)
+        elif isinstance(fill_value, str):
+            fill_value = float(fill_value)
+        self.fill_value = np.array(fill_value, dtype=self.dtype)
+        self._indexes: dict[tuple, np.ndarray | None] = {}
+
+    def __repr__(self):
+        return (
+            f"ShardedArray<{self.path} {self.shape} {self.dtype}, "
+            f"chunks={self.inner_chunks}, shards={self.chunks}>"
+        )
+
+    @property
+    def basename(self) -> str:
+        return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def itemsize(self) -> int:
+        return self.dtype.itemsize
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def attrs(self) -> dict:
+        return self.metadata["attributes"]
+
+    @property
+    def grid(self) -> tuple[int, ...]:
+        """The number of inner chunks along each dimension of a shard."""
+        return tuple(s // c for s, c in zip(self.chunks, self.inner_chunks))
+
+    @classmethod
+    def create(
+        cls,
+        store,
+        path: str,
+        shape: tuple[int, ...],
+        dtype,
+        chunks: tuple[int, ...],
+        shards: tuple[int, ...] | None = None,
+        compressor=None,
+        fill_value=None,
+        attributes: dict[str, Any] | None = None,
+        dimension_names: list[str] | None = None,
+    ) -> "ShardedArray":
+        """
+        Write the metadata of a new array. ``shards`` must be multiples of
+        ``chunks``, and defaults to a single shard.
+
+        The chunks and shards may be longer than the array. They're kept as
+        given, so that shards written while the array is short are still valid
+        once it has grown (see `resize`).
+        """
+        dtype = np.dtype(dtype)
+        shape = tuple(shape)
+        codecs = codec_metadata(compressor, dtype)
+        if shape:
+            chunks = tuple(c or 1 for c in chunks)
+            if shards is None:
+                # A single shard, rounded up to whole inner chunks
+                shards = tuple(math.ceil(n / c) * c or c for n, c in zip(shape, chunks))
+            shards = tuple(shards)
+            if any(s % c for s, c in zip(shards, chunks)):
+                raise ValueError(f"Shards {shards} aren't multiples of {chunks}")
+            codecs = [
+                {
+                    "name": "sharding_indexed",
+                    "configuration": {
+                        "chunk_shape": list(chunks),
+                        "codecs": codecs,
+                        "index_codecs": [
+                            {"name": "bytes", "configuration": {"endian": "little"}}
+                        ],
+                        "index_location": "start",
+                    },
+                }
+            ]
+        else:
+            shards = ()
+        metadata = {
+            "zarr_format": 3,
+            "node_type": "array",
+            "shape": list(shape),
+            "data_type": _data_type(dtype),
+            "chunk_grid": {
+                "name": "regular",
+                "configuration": {"chunk_shape": list(shards)},
+            },
+            "chunk_key_encoding": {
+                "name": "default",
+                "configuration": {"separator": "/"},
+            },
+            "fill_value": _fill_value(fill_value, dtype),
+            "codecs": codecs,
+            "attributes": attributes or {},
+        }
+        if dimension_names is not None or not shape:
+            metadata["dimension_names"] = list(dimension_names or [])
+        store[f"{path}/zarr.json"] = json.dumps(metadata, indent=2).encode()
+        return cls(store, path, metadata)
+
+    @classmethod
+    def like(
+        cls,
+        source,
+        store,
+        chunks: tuple[int, ...],
+        shards: tuple[int, ...] | None = None,
+        compressor="source",
+    ) -> "ShardedArray":
+        """
+        Create an array with the shape, dtype, fill value and attributes of the
+        Zarr v2 array ``source``, with its compressor unless ``compressor`` is
+        given. The attributes are converted the way xarray stores them in v3.
+        """
+        attributes = dict(source.attrs)
+        dimension_names = attributes.pop("_ARRAY_DIMENSIONS", None)
+        if source.fill_value is not None:
+            attributes["_FillValue"] = _fill_value_attribute(
+                source.fill_value, source.dtype
+            )
+        return cls.create(
+            store,
+            source.path,
+            source.shape,
+            source.dtype,
+            chunks,
+            shards,
+            source.compressor if compressor == "source" else compressor,
+            source.fill_value,
+            attributes,
+            dimension_names,
+        )
+
+    @classmethod
+    def open(cls, store, path: str) -> "ShardedArray":
+        return cls(store, path, json.loads(store[f"{path}/zarr.json"]))
+
+    def resize(self, shape: tuple[int, ...]) -> "ShardedArray":
+        """
+        Rewrite the metadata with a new ``shape``, keeping the chunks, shards and
+        codecs, so the shards already written stay readable.
+        """
+        metadata = dict(self.metadata, shape=list(shape))
+        self.store[f"{self.path}/zarr.json"] = json.dumps(metadata, indent=2).encode()
+        return type(self)(self.store, self.path, metadata)
+
+    def shard_key(self, index: tuple[int, ...]) -> str:
+        return "/".join([self.path, "c", *map(str, index)])
+
+    def iter_shards(self) -> Iterator[tuple[int, ...]]:
+        return np.ndindex(*[math.ceil(n / s) for n, s in zip(self.shape, self.chunks)])
+
+    # -- writing
+
+    def _encode_chunk(self, chunk: np.ndarray) -> bytes:
+        data = np.ascontiguousarray(chunk, dtype=self.dtype).tobytes()
+        return self.compressor.encode(data) if self.compressor else data
+
+    def encode_shard(self, values: np.ndarray) -> bytes:
+        """
+        A shard holding ``values`` (at most the shard shape, from its start).
+        Inner chunks entirely of the ``_FillValue`` are left out, if there is one.
+        """
+        if not self.ndim:
+            return self._encode_chunk(values)
+        padded = np.full(self.chunks, self.fill_value, dtype=self.dtype)
+        padded[tuple(slice(0, n) for n in values.shape)] = values
+        index = np.full(self.grid + (2,), MISSING, dtype="<u8")
+        parts = []
+        offset = index.nbytes
+        for key in np.ndindex(*self.grid):
+            region = tuple(
+                slice(i * c, (i + 1) * c) for i, c in zip(key, self.inner_chunks)
+            )
+            chunk = padded[region]
+            outside = any(r.start >= n for r, n in zip(region, values.shape))
+            if outside or "_FillValue" in self.attrs and self._is_fill(chunk):
+                continue
+            data = self._encode_chunk(chunk)
+            index[key] = (offset, len(data))
+            parts.append(data)
+            offset += len(data)
+        return index.tobytes() + b"".join(parts)
+
+    def _is_fill(self, chunk: np.ndarray) -> bool:
+        if self.dtype.kind == "f" and np.isnan(self.fill_value):
+            return bool(np.isnan(chunk).all())
+        return bool((chunk == self.fill_value).all())
+
+    def __setitem__(self, key, values) -> None:
+        """
+        Write whole shards. ``key`` is a tuple of slices (or ``...``) aligned to
+        the shards, or ending at the end of the array.
+        """
+        if key is Ellipsis or not self.ndim:
+            key = tuple(slice(0, n) for n in self.shape)
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), self._shape(key))
+        ranges = []
+        for s, size, n in zip(key, self.chunks, self.shape):
+            start, stop = s.start or 0, min(n if s.stop is None else s.stop, n)
+            if start % size or (stop % size and stop != n):
+                raise ValueError(f"{key} isn't aligned to the shards {self.chunks}")
+            ranges.append(range(start // size, math.ceil(stop / size)))
+        if not self.ndim:
+            self.store[self.shard_key(())] = self.encode_shard(values)
+            return
+        origin = [s.start or 0 for s in key]
+        for index in np.ndindex(*[len(r) for r in ranges]):
+            shard = tuple(r[i] for r, i in zip(ranges, index))
+            region = tuple(
+                slice(i * c - o, min((i + 1) * c, n) - o)
+                for i, c, n, o in zip(shard, self.chunks, self.shape, origin)
+            )
+            self.store[self.shard_key(shard)] = self.encode_shard(values[region])
+            self._indexes.pop(shard, None)
+
+    def _shape(self, key) -> tuple[int, ...]:
+        return tuple(len(range(*s.indices(n))) for s, n in zip(key, self.shape))
+
+    # -- reading
+
+    def _fs_path(self, key: str) -> tuple[Any, str]:
+        return self.store.fs, f"{self.store.root}/{key}"
+
+    def indexes(self, shards: list[tuple[int, ...]]) -> dict[tuple, np.ndarray | None]:
+        """
+        The index of each of ``shards`` (``None`` for a missing shard), read with
+        one ranged read each and cached.
+        """
+        missing = [s for s in shards if s not in self._indexes]
+        if missing:
+            fs, _ = self._fs_path("")
+            paths = [self._fs_path(self.shard_key(s))[1] for s in missing]
+            starts = [0] * len(paths)
+            if self.index_at_end:
+                starts = [_size(fs, path) - self.index_nbytes for path in paths]
+            data = fs.cat_ranges(
+                paths,
+                starts,
+                [start + self.index_nbytes for start in starts],
+                on_error="return",
+            )
+            for shard, buf in zip(missing, data):
+                if isinstance(buf, FileNotFoundError):
+                    self._indexes[shard] = None
+                elif isinstance(buf, Exception):
+                    raise buf
+                else:
+                    index = np.frombuffer(buf[: math.prod(self.grid) * 16], "<u8")
+                    self._indexes[shard] = index.reshape(self.grid + (2,))
+        return {s: self._indexes[s] for s in shards}
+
+    def __getitem__(self, key) -> np.ndarray:
+        """Read a selection of slices and integers, with ranged reads of the shards."""
+        if key is Ellipsis or not self.ndim:
+            key = ()
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        drop = [i for i, k in enumerate(key) if isinstance(k, (int, np.integer))]
+        key = tuple(
+            slice(k % n, k % n + 1) if i in drop else slice(*k.indices(n)[:2])
+            for i, (k, n) in enumerate(zip(key, self.shape))
+        )
+        out = np.full(self._shape(key), self.fill_value, dtype=self.dtype)
+        if not self.ndim:
+            fs, path = self._fs_path(self.shard_key(()))
+            if fs.exists(path):
+                out[...] = self._decode_chunk(fs.cat_file(path), ())
+            return out
+
+        chunk_ranges = [
+            range(s.start // c, math.ceil(s.stop / c)) if s.stop > s.start else range(0)
+            for s, c in zip(key, self.inner_chunks)
+        ]
+        chunks = list(itertools.product(*chunk_ranges))
+        shards = sorted({self._shard_of(c) for c in chunks})
+        indexes = self.indexes(shards)
+        reads = []
+        for chunk in chunks:
+            shard = self._shard_of(chunk)
+            index = indexes[shard]
+            if index is None:
+                continue
+            local = tuple(c % g for c, g in zip(chunk, self.grid))
+            offset, nbytes = index[local]
+            if offset == MISSING:
+                continue
+            reads.append((chunk, shard, int(offset), int(nbytes)))
+        if reads:
+            fs, _ = self._fs_path("")
+            data = fs.cat_ranges(
+                [self._fs_path(self.shard_key(s))[1] for _, s, _, _ in reads],
+                [offset for _, _, offset, _ in reads],
+                [offset + nbytes for _, _, offset, nbytes in reads],
+            )
+            for (chunk, _, _, _), buf in zip(reads, data):
+                values = self._decode_chunk(buf, self.inner_chunks)
+                src, dst = [], []
+                for i, c, s in zip(chunk, self.inner_chunks, key):
+                    lo, hi = max(s.start, i * c), min(s.stop, (i + 1) * c)
+                    src.append(slice(lo - i * c, hi - i * c))
+                    dst.append(slice(lo - s.start, hi - s.start))
+                out[tuple(dst)] = values[tuple(src)]
+        return out.squeeze(axis=tuple(drop)) if drop else out
+
+    def _shard_of(self, chunk: tuple[int, ...]) -> tuple[int, ...]:
+        return tuple(c // g for c, g in zip(chunk, self.grid))
+
+    def _decode_chunk(self, data: bytes, shape: tuple[int, ...]) -> np.ndarray:
+        if self.compressor is not None:
+            data = self.compressor.decode(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    # -- Zarr v2 references
+
+    def references(self, url: str) -> dict[str, Any]:
+        """
+        Kerchunk references of this array as a Zarr v2 array chunked like the
+        inner chunks, pointing into the shards under ``url`` (the store's URL).
+        """
+        attrs = {k: v for k, v in self.attrs.items() if k != "_FillValue"}
+        if "dimension_names" in self.metadata:
+            attrs["_ARRAY_DIMENSIONS"] = self.metadata["dimension_names"]
+        refs = {f"{self.path}/.zattrs": json.dumps(attrs)}
+        grid = [math.ceil(n / c) for n, c in zip(self.shape, self.inner_chunks)]
+        shards = list(self.iter_shards()) if self.ndim else []
+        if not self.ndim and self.store.fs.exists(self._fs_path(self.shard_key(()))[1]):
+            refs[f"{self.path}/0"] = [f"{url}/{self.shard_key(())}"]
+        for shard, index in self.indexes(shards).items():
+            if index is None:
+                continue
+            for local in np.ndindex(*self.grid):
+                chunk = tuple(s * g + i for s, g, i in zip(shard, self.grid, local))
+                offset, nbytes = index[local]
+                if offset == MISSING or any(c >= n for c, n in zip(chunk, grid)):
+                    continue
+                key = f"{self.path}/" + ".".join(map(str, chunk))
+                refs[key] = [f"{url}/{self.shard_key(shard)}", int(offset), int(nbytes)]
+
+        # Zarr v2 readers take the fill value for a _FillValue, so it's only
+        # kept if the array has one, or needs one for its missing chunks
+        fill_value = self.metadata["fill_value"]
+        if "_FillValue" not in self.attrs and len(refs) - 1 == math.prod(grid):
+            fill_value = None
+        refs[f"{self.path}/.zarray"] = json.dumps(
+            {
+                "zarr_format": 2,
+                "shape": list(self.shape),
+                "chunks": list(self.inner_chunks),
+                "dtype": self.dtype.str,
+                "compressor": (
+                    self.compressor.get_config() if self.compressor else None
+                ),
+                "fill_value": fill_value,
+                "filters": None,
+                "order": "C",
+            }
+        )
+        return refs
+
+
+def _size(fs, path: str) -> int:
+    try:
+        return fs.size(path)
+    except FileNotFoundError:
+        return 0
+
+
+def arrays(store) -> list[str]:
+    """
+    The names of the arrays in the v3 group at the root of ``store``, found
+    without listing their shards.
+    """
+    root = store.root.rstrip("/")
+    out = []
+    for path in store.fs.glob(f"{root}/*/zarr.json"):
+        name = path[len(root) + 1 : -len("/zarr.json")]
+        if json.loads(store[f"{name}/zarr.json"])["node_type"] == "array":
+            out.append(name)
+    return sorted(out)
+
+
+def references(
+    url: str, storage_options: dict[str, Any] | None = None
+) -> dict[str, Any]:
+    """
+    Kerchunk references for reading the sharded v3 group at ``url`` as a Zarr
+    v2 group with Zarr v2 readers.
+    """
+    store = fsspec.get_mapper(url, **(storage_options or {}))
+    url = url.rstrip("/")
+    group = json.loads(store["zarr.json"])
+    refs = {
+        ".zgroup": json.dumps({"zarr_format": 2}),
+        ".zattrs": json.dumps(group.get("attributes", {})),
+    }
+    for path in arrays(store):
+        refs.update(ShardedArray.open(store, path).references(url))
+    return {"version": 1, "refs": refs}
+
+
+def get_storage_options(url):
+    if url.split("://")[0] in ("az", "abfs"):
+        return {
+            "account_name": "noaanwm",
+            "credential": os.environ["AZURE_SAS_TOKEN"],
+        }
+    return {}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    refs = subparsers.add_parser(
+        "references", help="Write Zarr v2 references to a sharded store"
+    )
+    refs.add_argument("store", help="The sharded Zarr v3 store")
+    refs.add_argument("output", help="Where to write the references (.json)")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    refs = references(args.store, get_storage_options(args.store))
+    with fsspec.open(args.output, "w", **get_storage_options(args.output)) as f:
+        json.dump(refs, f)
+    print(f"Wrote {len(refs['refs'])} references to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+"""
+Synthetic National Water Model files, for benchmarking the pipelines offline.
+
+The files have the variable names, dimensions, dtypes and packing of the real
+short-range ``channel_rt``, ``land``, ``forcing`` and ``reservoir`` files, laid
+out under the same ``nwm.{date}/{product}/`` paths, so `noaanwm.parse_url` and
+the pipelines treat them like the real thing. The data are random but smooth
+enough to compress like model output.
+
+``scale`` shrinks the spatial dimensions: the number of reaches and reservoirs
+is multiplied by it, and each side of the 1km grid by its square root. Chunks
+are scaled the same way.
+
+    python synthetic.py /tmp/nwm --start 2023-01-01 --cycles 3 --scale 0.01
+"""
+import argparse
+import datetime
+import math
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+PACKED = dict(dtype="int32", scale_factor=0.01, add_offset=0.0, _FillValue=-999900)
+
+PRODUCTS = {
+    "channel_rt": dict(
+        sizes={"feature_id": 2_776_738},
+        chunks={"feature_id": 139_000},
+        variables={
+            "streamflow": ("m3 s-1", PACKED),
+            "nudge": ("m3 s-1", PACKED),
+            "velocity": ("m s-1", PACKED),
+            "qSfcLatRunoff": ("m3 s-1", PACKED),
+            "qBucket": ("m3 s-1", PACKED),
+            "qBtmVertRunoff": ("m3", PACKED),
+        },
+    ),
+    "land": dict(
+        sizes={"y": 3840, "x": 4608},
+        chunks={"y": 768, "x": 922},
+        variables={
+            "ACCET": ("mm", PACKED),
+            "SNOWT_AVG": ("K", dict(PACKED, scale_factor=0.1)),
+            "SOILSAT_TOP": ("1", dict(PACKED, scale_factor=0.001)),
+            "FSNO": ("1", dict(PACKED, scale_factor=0.001)),
+            "SNOWH": ("m", dict(PACKED, scale_factor=0.001)),
+            "SNEQV": ("kg m-2", dict(PACKED, scale_factor=1.0)),
+        },
+    ),
+    "forcing": dict(
+        sizes={"y": 3840, "x": 4608},
+        chunks={"y": 768, "x": 922},
+        variables={
+            "U2D": ("m s-1", dict(PACKED, scale_factor=0.001)),
+            "V2D": ("m s-1", dict(PACKED, scale_factor=0.001)),
+            "LWDOWN": ("W m-2", dict(PACKED, scale_factor=0.001)),
+            "RAINRATE": ("mm s^-1", dict(dtype="float32", _FillValue=-999.0)),
+            "T2D": ("K", dict(PACKED, scale_factor=0.01)),
+            "Q2D": ("kg kg-1", dict(PACKED, scale_factor=1e-6)),
+            "PSFC": ("Pa", dict(PACKED, scale_factor=0.1)),
+            "SWDOWN": ("W m-2", dict(PACKED, scale_factor=0.001)),
+        },
+    ),
+    "reservoir": dict(
+        sizes={"feature_id": 5783},
+        chunks={"feature_id": 5783},
+        variables={
+            "reservoir_type": ("1", dict(dtype="int32", _FillValue=-2147483647)),
+            "reservoir_assimilated_value": ("m3 s-1", dict(dtype="float32")),
+            "latitude": ("degrees_north", dict(dtype="float32")),
+            "longitude": ("degrees_east", dict(dtype="float32")),
+            "water_sfc_elev": ("m", dict(dtype="float32", _FillValue=-9999.0)),
+            "inflow": ("m3 s-1", PACKED),
+            "outflow": ("m3 s-1", PACKED),
+        },
+    ),
+}
+
+# The directory each kind lives in, under nwm.{date}/
+DIRECTORIES = {
+    "channel_rt": "short_range",
+    "land": "short_range",
+    "reservoir": "short_range",
+    "forcing": "forcing_short_range",
+}
+
+TIME_ENCODING = dict(units="minutes since 1970-01-01 00:00:00 UTC", dtype="int32")
+
+
+def scaled(kind: str, scale: float) -> tuple[dict[str, int], dict[str, int]]:
+    """The dimension sizes and chunks of ``kind`` at ``scale``."""
+    spec = PRODUCTS[kind]
+    factor = scale if "feature_id" in spec["sizes"] else math.sqrt(scale)
+    sizes = {d: max(1, round(n * factor)) for d, n in spec["sizes"].items()}
+    chunks = {
+        d: min(sizes[d], max(1, round(n * factor))) for d, n in spec["chunks"].items()
+    }
+    return sizes, chunks
+
+
+def _field(rng: np.random.Generator, shape: tuple[int, ...]) -> np.ndarray:
+    # Smooth along every axis, like model output, so it compresses realistically.
+    data = rng.standard_normal(shape)
+    for axis in range(len(shape)):
+        data = np.cumsum(data, axis=axis)
+    data -= data.min()
+    return data / max(data.max(), 1) * 100
+
+
+def make_dataset(
+    kind: str,
+    reference_time: pd.Timestamp,
+    forecast_time: int = 1,
+    scale: float = 0.01,
+    seed: int = 0,
+) -> xr.Dataset:
+    """
+    A synthetic dataset for one output file.
+
+    The static coordinates (``feature_id``, ``x``, ``y``, reservoir locations)
+    only depend on ``seed``, so they're identical across the files of a run.
+    """
+    spec = PRODUCTS[kind]
+    sizes, _ = scaled(kind, scale)
+    static = np.random.default_rng(seed)
+    rng = np.random.default_rng([seed, int(reference_time.timestamp()), forecast_time])
+    time = reference_time + pd.Timedelta(hours=forecast_time)
+
+    coords = {
+        "time": ("time", [time], {"long_name": "valid output time"}),
+        "reference_time": (
+            "reference_time",
+            [reference_time],
+            {"long_name": "model initialization time"},
+        ),
+    }
+    if "feature_id" in sizes:
+        n = sizes["feature_id"]
+        ids = np.sort(static.choice(1_200_000_000, n, replace=False)).astype("int32")
+        coords["feature_id"] = ("feature_id", ids, {"long_name": "Reach ID"})
+        dims = ("feature_id",)
+    else:
+        coords["y"] = ("y", 1_919_500 - 1000.0 * np.arange(sizes["y"])[::-1])
+        coords["x"] = ("x", -2_303_500 + 1000.0 * np.arange(sizes["x"]))
+        dims = ("time", "y", "x")
+
+    data_vars = {}
+    for name, (units, encoding) in spec["variables"].items():
+        attrs = {"units": units, "grid_mapping": "crs"}
+        shape = tuple(1 if d == "time" else sizes[d] for d in dims)
+        if name == "reservoir_type":
+            values = static.integers(1, 3, shape).astype("int32")
+        elif name == "latitude":
+            values = static.uniform(25, 50, shape).astype("float32")
+        elif name == "longitude":
+            values = static.uniform(-125, -67, shape).astype("float32")
+        else:
+            values = _field(rng, shape)
+        data_vars[name] = (dims, values, attrs)
+    data_vars["crs"] = ((), np.array(0, dtype="S1"), {"grid_mapping_name": "latlon"})
+
+    ds = xr.Dataset(data_vars, coords=coords)
+    ds.attrs = {
+        "model_initialization_time": f"{reference_time:%Y-%m-%d_%H:%M:%S}",
+        "model_output_valid_time": f"{time:%Y-%m-%d_%H:%M:%S}",
+        "model_output_type": kind,
+    }
+    return ds
+
+
+def encoding(kind: str, ds: xr.Dataset, scale: float = 0.01) -> dict[str, dict]:
+    """The netCDF4 encoding of ``ds``: packing, chunks and zlib compression."""
+    _, chunks = scaled(kind, scale)
+    out = {"time": TIME_ENCODING, "reference_time": TIME_ENCODING}
+    for name, (_, enc) in PRODUCTS[kind]["variables"].items():
+        v = ds[name]
+        out[name] = dict(
+            enc,
+            zlib=True,
+            complevel=2,
+            chunksizes=tuple(1 if d == "time" else chunks[d] for d in v.dims),
+        )
+    return out
+
+
+def write_file(
+    root: str,
+    kind: str,
+    reference_time: pd.Timestamp,
+    forecast_time: int = 1,
+    scale: float = 0.01,
+    seed: int = 0,
+) -> str:
+    """Write one synthetic file under ``root`` and return its path."""
+    directory = DIRECTORIES[kind]
+    path = os.path.join(
+        root,
+        f"nwm.{reference_time:%Y%m%d}",
+        directory,
+        f"nwm.t{reference_time:%H}z.short_range.{kind}.f{forecast_time:0>3d}.conus.nc",
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds = make_dataset(kind, reference_time, forecast_time, scale, seed)
+    ds.to_netcdf(path, engine="h5netcdf", encoding=encoding(kind, ds, scale))
+    return path
+
+
+def write_files(
+    root: str,
+    start: datetime.date | str = "2023-01-01",
+    cycles: int = 3,
+    kinds: tuple[str, ...] = ("channel_rt", "land", "forcing", "reservoir"),
+    forecast_times: tuple[int, ...] = (1,),
+    scale: float = 0.01,
+    seed: int = 0,
+) -> list[str]:
+    """
+    Write the files for ``cycles`` hourly cycles starting at ``start``.
+
+    Returns the paths, ordered by kind, cycle and forecast hour.
+    """
+    start = pd.Timestamp(start)
+    return [
+        write_file(root, kind, start + pd.Timedelta(hours=i), f, scale, seed)
+        for kind in kinds
+        for i in range(cycles)
+        for f in forecast_times
+    ]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Write synthetic NWM files")
+    parser.add_argument("root")
+    parser.add_argument("--start", default="2023-01-01")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument(
+        "--kinds", nargs="+", default=list(PRODUCTS), choices=list(PRODUCTS)
+    )
+    parser.add_argument("--forecast-times", type=int, nargs="+", default=[1])
+    parser.add_argument("--scale", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    paths = write_files(
+        args.root,
+        args.start,
+        args.cycles,
+        tuple(args.kinds),
+        tuple(args.forecast_times),
+        args.scale,
+        args.seed,
+    )
+    print(f"Wrote {len(paths)} files to {args.root}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
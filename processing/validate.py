@@ -0,0 +1,195 @@
+"""
+Cheap checks for corrupt NetCDF4 / HDF5 files.
+
+Rather than opening the whole file with xarray, `check` makes a few small ranged
+reads: the HDF5 signature and superblock, the root group, and the chunk index of
+each variable, verifying that every chunk it points to lies within the file.
+Verdicts are stored in SQLite keyed by path and etag, so each version of a file
+is only checked once.
+
+>>> verdicts = Verdicts("nwm-inventory.sqlite")
+>>> bad = find_bad(urls, etags, verdicts, {"account_name": "noaanwm"})
+"""
+import argparse
+import sqlite3
+import sys
+import time
+from typing import Any, Sequence
+
+import dask
+import fsspec
+import h5py
+
+SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    path TEXT PRIMARY KEY,
+    etag TEXT,
+    ok INTEGER NOT NULL,
+    reason TEXT,
+    checked REAL
+);
+"""
+
+
+def _check_dataset(dset: h5py.Dataset, size: int) -> str | None:
+    if dset.chunks is None:
+        offset = dset.id.get_offset()
+        if offset is not None and offset + dset.id.get_storage_size() > size:
+            return f"{dset.name}: data extends past the end of the file"
+        return None
+
+    # The first and last entries of the chunk index
+    n = dset.id.get_num_chunks()
+    for i in sorted({0, n - 1}) if n else []:
+        info = dset.id.get_chunk_info(i)
+        if info.byte_offset + info.size > size:
+            return f"{dset.name}: chunk {info.chunk_offset} past the end of the file"
+    return None
+
+
+def check(url: str, storage_options: dict[str, Any] | None = None) -> str | None:
+    """
+    Check whether an HDF5 file looks readable.
+
+    Returns
+    -------
+    None if the file looks fine, otherwise a description of the problem.
+
+    Errors reading the file (connection, timeout, permission, throttling, ...)
+    are raised rather than returned, since they say nothing about the file.
+    """
+    fs, path = fsspec.core.url_to_fs(url, **(storage_options or {}))
+    try:
+        size = fs.size(path)
+        with fs.open(path, block_size=2**16, cache_type="readahead") as f:
+            if f.read(8) != SIGNATURE:
+                return "missing HDF5 signature"
+            f.seek(0)
+            with h5py.File(f, "r") as h5:
+                datasets = []
+                h5.visititems(
+                    lambda name, obj: datasets.append(obj)
+                    if isinstance(obj, h5py.Dataset)
+                    else None
+                )
+                for dset in datasets:
+                    if reason := _check_dataset(dset, size):
+                        return reason
+    except OSError as e:
+        # h5py raises a plain OSError for a damaged file, and re-raises the
+        # errors of the file object (subclasses like ConnectionError) as is.
+        if type(e) is not OSError:
+            raise
+        return f"OSError: {e}"
+    return None
+
+
+def _try_check(url, storage_options):
+    # (reason, None) from `check`, or (None, error) if reading the file failed
+    try:
+        return check(url, storage_options), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+class Verdicts:
+    """
+    The results of `check`, keyed by path and etag.
+    """
+
+    def __init__(self, path: str = "nwm-inventory.sqlite"):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def get(self, path: str, etag: str | None) -> tuple[bool, str | None] | None:
+        row = self.connection.execute(
+            "SELECT ok, reason FROM verdicts WHERE path = ? AND etag IS ?",
+            (path, etag),
+        ).fetchone()
+        if row is None:
+            return None
+        return bool(row[0]), row[1]
+
+    def set_many(self, rows: Sequence[tuple[str, str | None, str | None]]) -> None:
+        """Store ``(path, etag, reason)`` rows, with ``reason=None`` for good files."""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)",
+                [(p, etag, reason is None, reason, now) for p, etag, reason in rows],
+            )
+
+    def bad(self) -> dict[str, str]:
+        rows = self.connection.execute("SELECT path, reason FROM verdicts WHERE NOT ok")
+        return dict(rows.fetchall())
+
+
+def find_bad(
+    urls: Sequence[str],
+    etags: dict[str, str | None],
+    verdicts: Verdicts,
+    storage_options: dict[str, Any] | None = None,
+) -> set[str]:
+    """
+    Check the files that haven't been checked at their current etag, and return
+    the URLs of all the bad ones.
+
+    Files that couldn't be read (see `check`) are skipped too, but their verdict
+    isn't stored, so the next run checks them again.
+
+    The checks run with the current Dask scheduler.
+    """
+    pending = [url for url in urls if verdicts.get(url, etags.get(url)) is None]
+    bad = set()
+    if pending:
+        print(f"Validating {len(pending)} files")
+        check_ = dask.delayed(_try_check, pure=True)
+        results = dask.compute(*[check_(url, storage_options) for url in pending])
+        verdicts.set_many(
+            [
+                (url, etags.get(url), reason)
+                for url, (reason, error) in zip(pending, results)
+                if error is None
+            ]
+        )
+        for url, (_, error) in zip(pending, results):
+            if error is not None:
+                print(f"Skipping {url} for now: {error}")
+                bad.add(url)
+
+    for url in urls:
+        if url in bad:
+            continue
+        ok, reason = verdicts.get(url, etags.get(url))
+        if not ok:
+            print(f"Skipping {url}: {reason}")
+            bad.add(url)
+    return bad
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Check NetCDF files for corruption")
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--verdicts", default="nwm-inventory.sqlite")
+    parser.add_argument("--account-name", default=None)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    storage_options = {}
+    if args.account_name:
+        storage_options["account_name"] = args.account_name
+    verdicts = Verdicts(args.verdicts)
+    # h5py holds a global lock, so use processes for concurrency.
+    with dask.config.set(scheduler="processes"):
+        bad = find_bad(args.urls, {}, verdicts, storage_options)
+    return 1 if bad else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""
+Area-weighted zonal statistics of the 1km land and forcing grids.
+
+Rasterizing each polygon for each query (e.g. with ``ds.rio.clip``) is slow, and
+reads the whole bounding box of every polygon. Instead, `build` computes once
+which grid cells each polygon covers and by what fraction, as a sparse table of
+``(zone, cell, weight)`` rows sorted by zone:
+
+    python zonal.py weights \\
+        az://ciroh/zarr/ts/short-range-forcing-rechunked-test.zarr \\
+        counties.parquet counties-weights.parquet --id-column GEOID
+
+`zonal_mean` then reduces every zone at once, reading each chunk of the data
+once. The per-zone sums are a single `numpy.add.reduceat` over the weighted
+values of the covered cells.
+
+    python zonal.py mean \\
+        az://ciroh/zarr/ts/short-range-forcing-rechunked-test.zarr \\
+        counties-weights.parquet az://ciroh/zarr/zonal/counties-forcing.zarr
+"""
+import argparse
+import json
+import os
+import sys
+
+import dask
+import dask.array as da
+import fsspec
+import geopandas
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyproj
+import shapely
+import xarray as xr
+
+import executor
+import metrics
+
+
+def _edges(centers: np.ndarray) -> tuple[np.ndarray, bool]:
+    """The ascending cell edges of evenly spaced ``centers``, and if they descend."""
+    descending = len(centers) > 1 and centers[1] < centers[0]
+    c = centers[::-1] if descending else centers
+    step = c[1] - c[0] if len(c) > 1 else 1.0
+    return np.concatenate([c - step / 2, [c[-1] + step / 2]]), descending
+
+
+def build(
+    geometries: geopandas.GeoSeries, x: np.ndarray, y: np.ndarray, crs
+) -> pd.DataFrame:
+    """
+    The cells of the grid with cell centers ``x`` and ``y`` covered by each of
+    ``geometries``.
+
+    Returns
+    -------
+    DataFrame with columns ``zone`` (the position of the geometry), ``cell`` (the
+    flat index of the cell in a ``(y, x)`` array) and ``weight`` (the fraction of
+    the cell covered), sorted by zone and cell.
+    """
+    geometries = geometries.to_crs(crs)
+    x_edges, x_descending = _edges(np.asarray(x))
+    y_edges, y_descending = _edges(np.asarray(y))
+    nx, ny = len(x), len(y)
+    area = (x_edges[1] - x_edges[0]) * (y_edges[1] - y_edges[0])
+
+    frames = []
+    for zone, geometry in enumerate(geometries.values):
+        if geometry is None or geometry.is_empty:
+            continue
+        xmin, ymin, xmax, ymax = geometry.bounds
+        i0, i1 = np.searchsorted(x_edges, [xmin, xmax])
+        j0, j1 = np.searchsorted(y_edges, [ymin, ymax])
+        i0, j0 = max(i0 - 1, 0), max(j0 - 1, 0)
+        i1, j1 = min(i1, nx), min(j1, ny)
+        if i0 >= i1 or j0 >= j1:
+            continue
+        jj, ii = np.mgrid[j0:j1, i0:i1]
+        jj, ii = jj.ravel(), ii.ravel()
+        boxes = shapely.box(x_edges[ii], y_edges[jj], x_edges[ii + 1], y_edges[jj + 1])
+        shapely.prepare(geometry)
+        inside = shapely.contains_properly(geometry, boxes)
+        weight = inside.astype("float64")
+        edge = ~inside & shapely.intersects(geometry, boxes)
+        weight[edge] = shapely.area(shapely.intersection(geometry, boxes[edge])) / area
+        keep = weight > 0
+        rows = (ny - 1 - jj[keep]) if y_descending else jj[keep]
+        cols = (nx - 1 - ii[keep]) if x_descending else ii[keep]
+        frames.append(
+            pd.DataFrame(
+                {
+                    "zone": np.full(keep.sum(), zone, dtype="int32"),
+                    "cell": rows.astype("int64") * nx + cols,
+                    "weight": weight[keep],
+                }
+            )
+        )
+    if not frames:
+        return pd.DataFrame(
+            {
+                "zone": np.array([], "int32"),
+                "cell": np.array([], "int64"),
+                "weight": np.array([], "float64"),
+            }
+        )
+    return pd.concat(frames, ignore_index=True).sort_values(["zone", "cell"])
+
+
+def grid_crs(ds: xr.Dataset) -> pyproj.CRS:
+    """The CRS of an NWM grid, from its ``crs`` variable."""
+    return pyproj.CRS.from_cf(ds["crs"].attrs)
+
+
+def write_weights(
+    weights: pd.DataFrame,
+    zones: list,
+    shape: tuple[int, int],
+    path: str,
+    storage_options: dict | None = None,
+) -> None:
+    """
+    Write the table from `build` to a Parquet file, with the zone labels and
+    grid shape in its metadata.
+    """
+    table = pa.Table.from_pandas(weights, preserve_index=False)
+    meta = {"shape": list(shape), "zones": [str(z) for z in zones]}
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, b"zonal": json.dumps(meta).encode()}
+    )
+    fs, path = fsspec.core.url_to_fs(path, **(storage_options or {}))
+    with fs.open(path, "wb") as f:
+        pq.write_table(table, f)
+
+
+def read_weights(
+    path: str, storage_options: dict | None = None
+) -> tuple[pd.DataFrame, list[str], tuple[int, int]]:
+    """The weights, zone labels and grid shape written by `write_weights`."""
+    fs, path = fsspec.core.url_to_fs(path, **(storage_options or {}))
+    with fs.open(path, "rb") as f:
+        table = pq.read_table(f)
+    meta = json.loads(table.schema.metadata[b"zonal"])
+    return table.to_pandas(), meta["zones"], tuple(meta["shape"])
+
+
+def _block_sums(block, block_weights, nzones):
+    # The weighted sums of the valid values, and of their weights, per zone.
+    cells, zones, weights = block_weights
+    values = block.reshape(block.shape[0], -1)[:, cells]
+    valid = ~np.isnan(values)
+    weighted = np.where(valid, values, 0) * weights
+    starts = np.flatnonzero(np.r_[True, zones[1:] != zones[:-1]])
+    sums = np.zeros((block.shape[0], nzones))
+    totals = np.zeros((block.shape[0], nzones))
+    if len(starts):
+        sums[:, zones[starts]] = np.add.reduceat(weighted, starts, axis=1)
+        totals[:, zones[starts]] = np.add.reduceat(valid * weights, starts, axis=1)
+    return sums, totals
+
+
+def _ratio(parts):
+    sums = sum(p[0] for p in parts)
+    totals = sum(p[1] for p in parts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (sums / totals).astype("float32")
+
+
+def zonal_mean(
+    array: xr.DataArray, weights: pd.DataFrame, zones: list[str]
+) -> xr.DataArray:
+    """
+    The area-weighted mean of ``array`` (dimensions ``time``, ``y``, ``x``) over
+    each zone, as a lazy ``(time, zone)`` DataArray.
+
+    Each chunk of ``array`` is read at most once, and chunks that no zone covers
+    aren't read at all. Missing values are left out of the mean.
+    """
+    array = array.transpose("time", "y", "x")
+    data = array.data
+    if not isinstance(data, da.Array):
+        data = da.from_array(data, chunks=(-1, -1, -1))
+    nx = array.sizes["x"]
+    nzones = len(zones)
+
+    rows, cols = np.divmod(weights["cell"].to_numpy(), nx)
+    y_bounds = np.cumsum((0,) + data.chunks[1])
+    x_bounds = np.cumsum((0,) + data.chunks[2])
+    block_y = np.searchsorted(y_bounds, rows, side="right") - 1
+    block_x = np.searchsorted(x_bounds, cols, side="right") - 1
+
+    # The weights of each spatial block, with cells relative to the block. Each
+    # is one task in the graph, shared by the block's tasks at every time chunk.
+    blocks = {}
+    table = weights.assign(block_y=block_y, block_x=block_x, row=rows, col=cols)
+    for (by, bx), group in table.groupby(["block_y", "block_x"], sort=False):
+        group = group.sort_values("zone", kind="stable")
+        width = data.chunks[2][bx]
+        local = (group["row"] - y_bounds[by]) * width + (group["col"] - x_bounds[bx])
+        blocks[by, bx] = dask.delayed(
+            (local.to_numpy(), group["zone"].to_numpy(), group["weight"].to_numpy()),
+            pure=True,
+        )
+
+    delayed = data.to_delayed()
+    block_sums = dask.delayed(_block_sums, pure=True)
+    ratio = dask.delayed(_ratio, pure=True)
+    columns = []
+    for t, nt in enumerate(data.chunks[0]):
+        parts = [
+            block_sums(delayed[t, by, bx], block_weights, nzones)
+            for (by, bx), block_weights in blocks.items()
+        ]
+        columns.append(
+            da.from_delayed(ratio(parts), shape=(nt, nzones), dtype="float32")
+        )
+    result = da.concatenate(columns, axis=0) if columns else da.empty((0, nzones))
+    return xr.DataArray(
+        result,
+        dims=("time", "zone"),
+        coords={"time": array["time"], "zone": zones},
+        name=array.name,
+        attrs=array.attrs,
+    )
+
+
+def get_storage_options(url):
+    if url.split("://")[0] in ("az", "abfs"):
+        return {
+            "account_name": "noaanwm",
+            "credential": os.environ["AZURE_SAS_TOKEN"],
+        }
+    return {}
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    weights = subparsers.add_parser(
+        "weights", help="Compute the cell weights of a set of polygons"
+    )
+    weights.add_argument("grid", help="A Zarr store with the land or forcing grid")
+    weights.add_argument("polygons", help="A file geopandas can read")
+    weights.add_argument("output", help="The Parquet file to write")
+    weights.add_argument(
+        "--id-column", default=None, help="The column labelling each zone"
+    )
+
+    mean = subparsers.add_parser("mean", help="Compute zonal means of a Zarr store")
+    mean.add_argument("source", help="The Zarr store")
+    mean.add_argument("weights", help="The weights from 'weights'")
+    mean.add_argument("output", help="The Zarr store to write")
+    mean.add_argument("--variables", nargs="+", default=None)
+    mean.add_argument(
+        "--metrics",
+        default="metrics/zonal",
+        help="Write per-stage metrics to {metrics}.json and {metrics}.prom",
+    )
+    executor.add_arguments(mean)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    if args.command == "weights":
+        storage_options = get_storage_options(args.grid)
+        ds = xr.open_dataset(
+            fsspec.get_mapper(args.grid, **storage_options), engine="zarr"
+        )
+        if args.polygons.endswith(".parquet"):
+            df = geopandas.read_parquet(args.polygons)
+        else:
+            df = geopandas.read_file(args.polygons)
+        zones = df[args.id_column] if args.id_column else df.index
+        weights = build(df.geometry, ds.x.values, ds.y.values, grid_crs(ds))
+        write_weights(
+            weights,
+            list(zones),
+            (ds.sizes["y"], ds.sizes["x"]),
+            args.output,
+            get_storage_options(args.output),
+        )
+        print(f"Wrote {len(weights)} weights for {len(df)} zones to {args.output}")
+        return
+
+    storage_options = get_storage_options(args.source)
+    ds = xr.open_dataset(
+        fsspec.get_mapper(args.source, **storage_options), engine="zarr", chunks={}
+    )
+    weights, zones, shape = read_weights(
+        args.weights, get_storage_options(args.weights)
+    )
+    if shape != (ds.sizes["y"], ds.sizes["x"]):
+        raise ValueError(f"The weights are for a {shape} grid, not {dict(ds.sizes)}")
+    names = args.variables or [
+        name for name, v in ds.data_vars.items() if v.dims == ("time", "y", "x")
+    ]
+    out = xr.Dataset({name: zonal_mean(ds[name], weights, zones) for name in names})
+    target = fsspec.get_mapper(args.output, **get_storage_options(args.output))
+
+    with executor.from_args(
+        args, upload=["metrics.py", "executor.py", "zonal.py"]
+    ) as client:
+        with metrics.stage("zonal_mean", variables=names):
+            out.to_zarr(target, mode="w", consolidated=True)
+        records = metrics.gather(client)
+
+    metrics.report(records)
+    metrics.write(args.metrics, records)
+
+
+if __name__ == "__main__":
+    sys.exit(main())